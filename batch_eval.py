@@ -0,0 +1,294 @@
+"""
+Lock-step batch evaluation through OpenAI Batch-API files.
+
+Each evaluation session (one simulated user) keeps its ordinary sequential
+code — `run_simulator(sim)`, `conversational_search(meta, …, llm)` — but runs
+in its own pool thread with a `BatchProxyChatModel` as its LLM. A proxy call only
+records the request and blocks. Once every live session is blocked (or
+finished), `LockstepRunner` writes all pending prompts to one Batch-API input
+file, hands it to a backend, reads the results file and wakes the sessions
+with their answers. So one turn of N sessions costs one batch round trip, not
+N sequential requests.
+
+Backends share the same file formats:
+
+* `OpenAIBatchBackend` – uploads the file to the OpenAI Batch API and polls
+* `LocalBatchBackend`  – answers the file with a local chat model
+  (`llm_backends.make_llm`); useful offline and for testing
+
+    runner = LockstepRunner(LocalBatchBackend(), MODEL_NAME, TEMPERATURE)
+    results = runner.run([lambda llm, m=m: evaluate_one(m, llm) for m in metas])
+"""
+from __future__ import annotations
+
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from llm_backends import make_llm
+
+# ──────────────────────────────────────────────────
+# Config
+# ──────────────────────────────────────────────────
+BATCH_DIR = Path("batch_runs")        # per-round input/output files are kept here
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_POLL_S = 30                     # OpenAI batch status poll interval
+LOCAL_BATCH_WORKERS = 16              # concurrent requests in LocalBatchBackend
+LOCKSTEP_MAX_SESSIONS = 256           # live sessions (threads) per lock-step run; the rest queue
+
+_ROLES = {"human": "user", "ai": "assistant", "system": "system"}
+
+
+# ──────────────────────────────────────────────────
+# Batch-API file formats
+# ──────────────────────────────────────────────────
+def write_batch_input(path: Path, requests: dict[str, list[dict]], model_name: str, temperature: float):
+    """requests = {custom_id: [{"role": …, "content": …}, …]}"""
+    with open(path, "w", encoding="utf-8") as f:
+        for custom_id, messages in requests.items():
+            line = {
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": {"model": model_name, "messages": messages, "temperature": temperature},
+            }
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+
+def read_batch_output(path: Path) -> dict[str, dict]:
+    """custom_id → {"content": str, "usage": dict} or {"error": str}"""
+    results = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            response = row.get("response") or {}
+            if row.get("error") or response.get("status_code", 200) != 200:
+                results[row["custom_id"]] = {"error": str(row.get("error") or response.get("body"))}
+                continue
+            body = response["body"]
+            results[row["custom_id"]] = {
+                "content": body["choices"][0]["message"]["content"],
+                "usage": body.get("usage", {}),
+            }
+    return results
+
+
+# ──────────────────────────────────────────────────
+# Backends: input file → output file
+# ──────────────────────────────────────────────────
+class LocalBatchBackend:
+    """Answers a Batch-API input file with a local chat model, writing the
+    output file in the Batch-API results format."""
+
+    def __init__(self, llm=None, backend: str = "template", workers: int = LOCAL_BATCH_WORKERS):
+        self.llm = llm or make_llm("", 0.0, backend=backend)
+        self.workers = workers
+
+    def _answer(self, line: dict) -> dict:
+        messages = [(m["role"], m["content"]) for m in line["body"]["messages"]]
+        msg = self.llm.invoke(messages)
+        usage = (msg.response_metadata or {}).get("token_usage", {})
+        return {
+            "id": f"batch_req_{line['custom_id']}",
+            "custom_id": line["custom_id"],
+            "response": {
+                "status_code": 200,
+                "request_id": line["custom_id"],
+                "body": {
+                    "object": "chat.completion",
+                    "model": line["body"]["model"],
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": msg.content}}],
+                    "usage": usage,
+                },
+            },
+            "error": None,
+        }
+
+    def submit(self, input_path: Path, output_path: Path) -> Path:
+        with open(input_path, "r", encoding="utf-8") as f:
+            lines = [json.loads(l) for l in f if l.strip()]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            rows = list(pool.map(self._answer, lines))
+        with open(output_path, "w", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        return output_path
+
+
+class OpenAIBatchBackend:
+    """Uploads the input file to the OpenAI Batch API and downloads the results."""
+
+    def __init__(self, poll_s: float = BATCH_POLL_S, completion_window: str = "24h"):
+        from openai import OpenAI
+        self.client = OpenAI()
+        self.poll_s = poll_s
+        self.completion_window = completion_window
+
+    def submit(self, input_path: Path, output_path: Path) -> Path:
+        with open(input_path, "rb") as f:
+            batch_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=self.completion_window,
+        )
+        print(f"[batch] submitted {batch.id} ({input_path.name})")
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(self.poll_s)
+            batch = self.client.batches.retrieve(batch.id)
+        if batch.status != "completed":
+            raise RuntimeError(f"Batch {batch.id} ended with status {batch.status}")
+
+        with open(output_path, "w", encoding="utf-8") as f:
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if file_id:
+                    f.write(self.client.files.content(file_id).text)
+        return output_path
+
+
+# ──────────────────────────────────────────────────
+# Lock-step driver
+# ──────────────────────────────────────────────────
+class BatchProxyChatModel(BaseChatModel):
+    """Chat model handed to a session: each call waits for the next batch round."""
+
+    runner: Any = None
+    session_id: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "psa-batch-proxy"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        payload = [{"role": _ROLES.get(m.type, "user"), "content": str(m.content)} for m in messages]
+        result = self.runner.request(self.session_id, payload)
+        message = AIMessage(content=result["content"], response_metadata={"token_usage": result["usage"]})
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+@dataclass
+class SessionFailed:
+    """Placeholder returned by `LockstepRunner.run` for a session that raised."""
+    index: int
+    error: str
+
+
+class LockstepRunner:
+    """Runs sessions in lock-step, sending each round of LLM calls as one batch file.
+
+    At most `max_sessions` sessions are live at once (a bounded thread pool);
+    a queued session starts when a slot frees and joins the next round.
+    A round whose batch fails (e.g. a failed or expired OpenAI batch) fails
+    only its own requests. If `run` itself is interrupted, every waiting
+    session gets an error, so no session thread is left blocked.
+    """
+
+    def __init__(self, backend, model_name: str, temperature: float, work_dir: Path = BATCH_DIR,
+                 max_sessions: int = LOCKSTEP_MAX_SESSIONS):
+        self.backend = backend
+        self.max_sessions = max_sessions
+        self.model_name = model_name
+        self.temperature = temperature
+        self.work_dir = Path(work_dir) / time.strftime("%Y%m%d-%H%M%S")
+        self._cv = threading.Condition()
+        self._pending: dict[str, list[dict]] = {}
+        self._results: dict[str, dict] = {}
+        self._calls: dict[int, int] = {}
+        self._active = 0       # sessions running (not queued)
+        self._remaining = 0    # sessions not finished yet
+        self._closed = False   # run() has exited; requests fail instead of waiting
+        self.rounds = 0
+        self.failures: list[SessionFailed] = []
+
+    def request(self, session_id: int, messages: list[dict]) -> dict:
+        with self._cv:
+            n = self._calls.get(session_id, 0)
+            self._calls[session_id] = n + 1
+            custom_id = f"s{session_id}-c{n}"
+            self._pending[custom_id] = messages
+            self._cv.notify_all()
+            while custom_id not in self._results and not self._closed:
+                self._cv.wait()
+            result = self._results.pop(custom_id, {"error": "lock-step run aborted"})
+        if "error" in result:
+            raise RuntimeError(f"Batch request {custom_id} failed: {result['error']}")
+        return result
+
+    def _session(self, session_id: int, fn: Callable, out: list):
+        with self._cv:
+            self._active += 1
+        llm = BatchProxyChatModel(runner=self, session_id=session_id)
+        try:
+            out[session_id] = fn(llm)
+        except Exception as e:  # 한 세션 실패가 전체 배치를 멈추지 않도록 (결과에 SessionFailed 로 남김)
+            print(f"[batch] session {session_id} failed: {e!r}")
+            out[session_id] = SessionFailed(session_id, repr(e))
+        finally:
+            with self._cv:
+                self._active -= 1
+                self._remaining -= 1
+                self._cv.notify_all()
+
+    def _flush(self, requests: dict[str, list[dict]]) -> dict[str, dict]:
+        self.rounds += 1
+        input_path = self.work_dir / f"round_{self.rounds:03d}_input.jsonl"
+        output_path = self.work_dir / f"round_{self.rounds:03d}_output.jsonl"
+        write_batch_input(input_path, requests, self.model_name, self.temperature)
+        self.backend.submit(input_path, output_path)
+        results = read_batch_output(output_path)
+        for custom_id in requests.keys() - results.keys():
+            results[custom_id] = {"error": "missing from batch output"}
+        return results
+
+    def run(self, sessions: List[Callable[[BaseChatModel], Any]]) -> list:
+        """Run `session(llm)` for every session; returns their results in order,
+        with a `SessionFailed` for each session that raised (also in `self.failures`)."""
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        out: list = [None] * len(sessions)
+        self._remaining = len(sessions)
+        self._closed = False
+        pool = ThreadPoolExecutor(max_workers=max(1, min(self.max_sessions, len(sessions))),
+                                  thread_name_prefix="lockstep")
+        for i, fn in enumerate(sessions):
+            pool.submit(self._session, i, fn, out)
+
+        try:
+            while True:
+                with self._cv:
+                    # 실행 중인 세션이 모두 LLM 응답을 기다릴 때까지 대기 (대기열 세션은 다음 라운드에 합류)
+                    while self._remaining and (not self._active or len(self._pending) < self._active):
+                        self._cv.wait()
+                    if not self._remaining:
+                        break
+                    requests, self._pending = self._pending, {}
+                print(f"[batch] round {self.rounds + 1}: {len(requests)} requests")
+                try:
+                    results = self._flush(requests)
+                except Exception as e:  # 배치 실패 / 만료 → 이번 라운드 요청만 실패 (해당 세션은 SessionFailed)
+                    print(f"[batch] round {self.rounds} failed: {e!r}")
+                    results = {custom_id: {"error": repr(e)} for custom_id in requests}
+                with self._cv:
+                    self._results.update(results)
+                    self._cv.notify_all()
+        finally:
+            with self._cv:
+                # 예외로 빠져나가도 응답을 기다리는 세션이 깨어나 끝나도록
+                self._closed = True
+                self._cv.notify_all()
+            pool.shutdown(cancel_futures=True)
+        self.failures = [r for r in out if isinstance(r, SessionFailed)]
+        print(f"[batch] {len(sessions)} sessions finished in {self.rounds} rounds "
+              f"({len(self.failures)} failed) → {self.work_dir}")
+        return out
@@ -0,0 +1,387 @@
+"""
+One pipeline engine for every runner and category.
+
+A `Profile` names a category configuration: where its documents come from
+(source), where its BM25 / vector indexes live, the per-round pool sizes and
+which implementation to use for each stage:
+
+    source      → documents for building the index        SOURCES
+    retriever   → (query, k, mask) → [(pid, text, score)]  RETRIEVERS
+    fusion      → BM25 + semantic hits → top-k              FUSIONS
+    rewrite     → first user message → search query        REWRITERS
+    refine      → dialogue so far → next search query      REFINERS
+    question    → pool + dialogue → clarifying question    QUESTIONERS
+    summarizer  → final pool → summary text                SUMMARIZERS
+
+Stages are plain functions in those registries; `@register(stage, name)`
+adds one. An `Engine` loads each category's indexes once (keyed by their
+directories) and hands out `Pipeline`s, so one process can serve or evaluate
+several categories and configurations against the same loaded indexes:
+
+    engine = Engine()
+    toys = engine.pipeline("toys", llm)
+    hits = toys.search("wooden train set", 10)
+    bm25_only = engine.pipeline("toys", llm, retriever="bm25")   # same indexes
+    session = toys.session()                                      # ConversationSession
+"""
+from __future__ import annotations
+
+import threading
+from collections import defaultdict
+from dataclasses import dataclass, field, replace
+from functools import partial
+from pathlib import Path
+from typing import Callable, Iterator, List, Tuple
+
+import numpy as np
+from datasets import load_dataset
+
+from llm_backends import template_question
+from tracing import span
+from utils import (EVAL_SAMPLE_PATHS, HYBRID_WEIGHT, INDEX_DIR, MAX_PRODUCTS, SEM_K_FACTOR, TOP_KS, VEC_DIR,
+                   AttributeStore, ConversationSession, _build_or_load_attribute_store, _fuse_scores,
+                   _iter_products, _template_summary, ask_after_questions, ask_disambiguation,
+                   ask_free_form_question, bm25_search, cascade_search,
+                   load_indexes_async, ranked_search, reformulate_query, rewrite_query, semantic_search,
+                   summarise_docs, target_rank)
+
+Hit = Tuple[str, str, float]
+DATASET = "McAuley-Lab/Amazon-Reviews-2023"
+
+
+# ──────────────────────────────────────────────────
+# Stage registries
+# ──────────────────────────────────────────────────
+SOURCES: dict[str, Callable] = {}
+RETRIEVERS: dict[str, Callable] = {}
+FUSIONS: dict[str, Callable] = {}
+REWRITERS: dict[str, Callable] = {}
+REFINERS: dict[str, Callable] = {}
+QUESTIONERS: dict[str, Callable] = {}
+SUMMARIZERS: dict[str, Callable] = {}
+
+STAGES = {
+    "source": SOURCES,
+    "retriever": RETRIEVERS,
+    "fusion": FUSIONS,
+    "rewrite": REWRITERS,
+    "refine": REFINERS,
+    "question": QUESTIONERS,
+    "summarizer": SUMMARIZERS,
+}
+
+
+def register(stage: str, name: str):
+    """Decorator adding a stage implementation under `name`."""
+    def deco(fn):
+        STAGES[stage][name] = fn
+        return fn
+    return deco
+
+
+# ── sources: (category, limit) → iterator of {"id", "text", …} ──
+def _meta_text(row, *extra: str) -> str:
+    features = " ".join(row.get("features", [])) if row.get("features") else ""
+    parts = [str(row.get("title") or ""), str(features), str(row.get("description") or ""), *extra]
+    return " ".join(filter(None, parts))
+
+
+@register("source", "meta")
+def iter_meta(category: str, limit: int | None = None) -> Iterator[dict]:
+    """Title + features + description."""
+    ds = load_dataset(DATASET, f"raw_meta_{category}", split="full", trust_remote_code=True)
+    for i, row in enumerate(ds):
+        if limit and i >= limit:
+            break
+        text = _meta_text(row)
+        if text:
+            yield {"id": row["parent_asin"], "text": text}
+
+
+@register("source", "meta_reviews")
+def iter_meta_reviews(category: str, limit: int | None = None) -> Iterator[dict]:
+    """Title + features + description + every review's title and text."""
+    review_ds = load_dataset(DATASET, f"raw_review_{category}", split="full", trust_remote_code=True)
+    reviews_by_pid: dict[str, list[str]] = defaultdict(list)
+    for row in review_ds:
+        rv = f"{row.get('title') or ''} {row.get('text') or ''}".strip()
+        if rv:
+            reviews_by_pid[row["parent_asin"]].append(rv)
+
+    meta_ds = load_dataset(DATASET, f"raw_meta_{category}", split="full", trust_remote_code=True)
+    for i, row in enumerate(meta_ds):
+        if limit and i >= limit:
+            break
+        pid = row["parent_asin"]
+        text = _meta_text(row, " ".join(reviews_by_pid.get(pid, [])))
+        if text:
+            yield {"id": pid, "text": text}
+
+
+@register("source", "product_card")
+def iter_product_cards(category: str, limit: int | None = None) -> Iterator[dict]:
+    """Generated product cards with structured attributes (utils._iter_products)."""
+    return _iter_products(limit, category)
+
+
+# ── fusion: (bm25_hits, sem_hits, idx_tuple, k, w) → top-k hits ──
+register("fusion", "minmax")(_fuse_scores)
+
+
+@register("fusion", "rrf")
+def reciprocal_rank_fusion(bm25_hits, sem_hits, idx_tuple, k: int, w: float, c: int = 60) -> List[Hit]:
+    """Weighted reciprocal-rank fusion; ignores score scales entirely."""
+    scores: dict[str, float] = defaultdict(float)
+    for rank, (pid, _, _) in enumerate(bm25_hits):
+        scores[pid] += w / (c + rank + 1)
+    for rank, (pid, _) in enumerate(sem_hits):
+        scores[pid] += (1 - w) / (c + rank + 1)
+    text = {pid: t for pid, t, _ in bm25_hits}
+    top = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)[:k]
+    missing = {pid for pid, _ in top} - text.keys()
+    if missing:
+        text.update({d["id"]: d["text"] for d in idx_tuple[0] if d["id"] in missing})
+    return [(pid, text.get(pid, ""), s) for pid, s in top]
+
+
+# ── retrievers: (pipeline, query, k, mask) → hits ──
+@register("retriever", "ranked")
+def _ranked(p: "Pipeline", query: str, k: int, mask=None) -> List[Hit]:
+    """utils.ranked_search: HYBRID_MODE / RERANK from the utils config."""
+    return ranked_search(query, p.index.bm25, p.index.vec, k, mask=mask)
+
+
+@register("retriever", "hybrid")
+def _hybrid(p: "Pipeline", query: str, k: int, mask=None) -> List[Hit]:
+    bm25_hits = bm25_search(query, p.index.bm25, k * SEM_K_FACTOR, mask)
+    sem_hits = semantic_search(query, p.index.vec, k * SEM_K_FACTOR, mask)
+    with span("fusion", method=p.profile.fusion):
+        return FUSIONS[p.profile.fusion](bm25_hits, sem_hits, p.index.bm25, k, p.profile.hybrid_weight)
+
+
+@register("retriever", "cascade")
+def _cascade(p: "Pipeline", query: str, k: int, mask=None) -> List[Hit]:
+    return cascade_search(query, p.index.bm25, p.index.vec, k, p.profile.hybrid_weight, mask)
+
+
+@register("retriever", "bm25")
+def _bm25(p: "Pipeline", query: str, k: int, mask=None) -> List[Hit]:
+    return bm25_search(query, p.index.bm25, k, mask)
+
+
+@register("retriever", "semantic")
+def _semantic(p: "Pipeline", query: str, k: int, mask=None) -> List[Hit]:
+    return [(pid, p.index.text(pid), s) for pid, s in semantic_search(query, p.index.vec, k, mask)]
+
+
+def _turns(qa_turns) -> list:
+    # qa_turns: [(q, a), …] 또는 ConversationState (COMPRESS_HISTORY) — 최근 턴만 있으면 충분
+    return list(getattr(qa_turns, "recent", qa_turns))
+
+
+# ── rewrite: (pipeline, user_input) → query ──
+register("rewrite", "llm")(lambda p, text: rewrite_query(p.llm, text, p.index.bm25[1]))
+register("rewrite", "none")(lambda p, text: text)
+
+# ── refine: (pipeline, query, qa_turns) → query ──
+register("refine", "llm")(lambda p, query, turns: reformulate_query(p.llm, turns))
+register("refine", "append")(lambda p, query, turns: f"{query} {_turns(turns)[-1][1]}".strip())
+
+# ── question: (pipeline, docs, qa_turns) → question (None → nothing left to ask) ──
+register("question", "llm")(lambda p, docs, turns: ask_disambiguation(p.llm, docs, turns))
+register("question", "free_form")(lambda p, docs, turns: ask_free_form_question(p.llm, docs, turns))
+register("question", "previous_questions")(
+    lambda p, docs, turns: ask_after_questions(p.llm, docs, [q for q, _ in _turns(turns)]))
+register("question", "template")(
+    lambda p, docs, turns: template_question([t for _, t, _ in docs],
+                                             exclude={w for q, _ in _turns(turns) for w in q.lower().split()}))
+
+# ── summarizer: (pipeline, [(pid, text)]) → summary ──
+register("summarizer", "llm")(lambda p, docs: summarise_docs(p.llm, docs))
+register("summarizer", "template")(lambda p, docs: _template_summary(docs))
+
+
+# ──────────────────────────────────────────────────
+# Profiles
+# ──────────────────────────────────────────────────
+@dataclass(frozen=True)
+class Profile:
+    name: str
+    category: str                          # Amazon-Reviews-2023 category (raw_meta_<category>)
+    index_dir: Path
+    vec_dir: Path
+    source: str = "meta_reviews"
+    top_ks: Tuple[int, ...] = tuple(TOP_KS)
+    eval_paths: Tuple[Path, ...] = ()
+    max_products: int | None = MAX_PRODUCTS
+    retriever: str = "hybrid"
+    fusion: str = "minmax"
+    hybrid_weight: float = HYBRID_WEIGHT
+    rewrite: str = "llm"
+    refine: str = "llm"
+    question: str = "llm"
+    summarizer: str = "llm"
+
+    def __post_init__(self):
+        for stage, registry in STAGES.items():
+            if getattr(self, stage) not in registry:
+                raise ValueError(f"{self.name}: unknown {stage} {getattr(self, stage)!r} "
+                                 f"(choose from {sorted(registry)})")
+
+
+PROFILES: dict[str, Profile] = {
+    "cellphones": Profile(
+        "cellphones", "Cell_Phones_and_Accessories",
+        Path("cellphones_bm25s_index"), Path("cellphones_faiss"),
+        source="meta", top_ks=(10, 10, 10, 10, 10, 10),     # 5 questions, then the final top-10
+        eval_paths=(Path("./sample_data/cellphone_sample.jsonl"),),
+        rewrite="none", refine="append", question="previous_questions",
+    ),
+    "toys": Profile(
+        "toys", "Toys_and_Games",
+        Path("toys_bm25s_index"), Path("toys_faiss"),
+        top_ks=(10, 10, 10, 10),
+        eval_paths=(Path("./sample_data/toy_sample.jsonl"),),
+        question="free_form",
+    ),
+    "magazines": Profile(
+        "magazines", "Magazine_Subscriptions",
+        INDEX_DIR, VEC_DIR,
+        source="product_card", retriever="ranked",
+        eval_paths=tuple(EVAL_SAMPLE_PATHS),
+    ),
+}
+
+
+def get_profile(profile: str | Profile, **overrides) -> Profile:
+    """Profile by name (or as given), with stage / field overrides applied."""
+    base = PROFILES[profile] if isinstance(profile, str) else profile
+    return replace(base, **overrides) if overrides else base
+
+
+# ──────────────────────────────────────────────────
+# Loaded indexes and pipelines
+# ──────────────────────────────────────────────────
+@dataclass
+class CategoryIndex:
+    bm25: tuple                            # (corpus, tokenizer, retriever)
+    vec: tuple                             # utils.VectorIndex: (index, id_map, model) + vec_dir
+    attributes: AttributeStore
+    _text: dict[str, str] = field(default_factory=dict, repr=False)
+
+    def text(self, pid: str) -> str:
+        if not self._text:
+            self._text.update((d["id"], d["text"]) for d in self.bm25[0])
+        return self._text.get(pid, "")
+
+
+@dataclass
+class Pipeline:
+    """A profile bound to its loaded indexes and an LLM."""
+    profile: Profile
+    index: CategoryIndex
+    llm: object = None
+
+    @property
+    def top_ks(self) -> List[int]:
+        return list(self.profile.top_ks)
+
+    def using(self, llm) -> "Pipeline":
+        """Same profile and indexes with another LLM (e.g. a batch proxy)."""
+        return replace(self, llm=llm)
+
+    def search(self, query: str, k: int, mask: np.ndarray | None = None) -> List[Hit]:
+        retriever = RETRIEVERS[self.profile.retriever]
+        if self.profile.retriever == "ranked":
+            return retriever(self, query, k, mask)   # hybrid_search 가 이미 retrieval span 을 엶
+        with span("retrieval", mode=self.profile.retriever) as sp:
+            hits = retriever(self, query, k, mask)
+            sp.set(candidates=len(hits))
+        return hits
+
+    def target_rank(self, query: str, target_pid: str, mask: np.ndarray | None = None) -> dict:
+        """Exact catalog rank of `target_pid` under BM25 / semantic / hybrid (utils.target_rank)."""
+        return target_rank(query, target_pid, self.index.bm25, self.index.vec, self.profile.hybrid_weight, mask)
+
+    def rewrite(self, user_input: str) -> str:
+        return REWRITERS[self.profile.rewrite](self, user_input)
+
+    def refine(self, query: str, qa_turns) -> str:
+        return REFINERS[self.profile.refine](self, query, qa_turns)
+
+    def ask(self, docs, qa_turns) -> str:
+        return QUESTIONERS[self.profile.question](self, docs, qa_turns)
+
+    def summarise(self, docs: List[Tuple[str, str]]) -> str:
+        return SUMMARIZERS[self.profile.summarizer](self, docs)
+
+    def session(self, stream: bool = False, summarise: bool = True, turn_budget: bool = False) -> ConversationSession:
+        """A step-wise `ConversationSession` over this profile's indexes, rounds, retriever and stages.
+
+        "llm" stages are the session's own (streaming, turn-budget snippets);
+        any other choice is passed in as a stage override. `turn_budget=True`
+        (session_server) enables the per-turn deadline; evaluation leaves it off.
+        """
+        stages = {stage: partial(registry[choice], self)
+                  for stage, registry, choice in (("rewrite", REWRITERS, self.profile.rewrite),
+                                                  ("refine", REFINERS, self.profile.refine),
+                                                  ("question", QUESTIONERS, self.profile.question),
+                                                  ("summarizer", SUMMARIZERS, self.profile.summarizer))
+                  if choice != "llm"}
+        return ConversationSession(self.llm, self.index.bm25, self.index.vec, self.index.attributes,
+                                   stream=stream, top_ks=self.top_ks, search=self.search, stages=stages,
+                                   summarise=summarise, turn_budget=turn_budget)
+
+
+class Engine:
+    """Loads each category's indexes once and builds pipelines over them."""
+
+    def __init__(self):
+        self._indexes: dict[tuple[Path, Path], CategoryIndex] = {}
+        self._lock = threading.Lock()
+
+    def load(self, profile: str | Profile) -> CategoryIndex:
+        profile = get_profile(profile)
+        key = (profile.index_dir, profile.vec_dir)
+        with self._lock:
+            if key not in self._indexes:
+                products = lambda limit: SOURCES[profile.source](profile.category, limit)
+                bm25_fut, vec_fut = load_indexes_async(profile.max_products, profile.index_dir,
+                                                       profile.vec_dir, products)
+                bm25 = bm25_fut.result()
+                self._indexes[key] = CategoryIndex(
+                    bm25, vec_fut.result(), _build_or_load_attribute_store(bm25[0], profile.index_dir))
+            return self._indexes[key]
+
+    def pipeline(self, profile: str | Profile, llm=None, **overrides) -> Pipeline:
+        profile = get_profile(profile, **overrides)
+        return Pipeline(profile, self.load(profile), llm)
+
+
+def run_dialogue(pipeline: Pipeline, raw_input: str, answer_fn: Callable[[str], str],
+                 on_hits: Callable[[List[Hit], int], None] | None = None,
+                 summarise: bool = True) -> dict:
+    """Run one clarification dialogue through `pipeline.session()` with `answer_fn` as the user.
+
+    The session applies filters, early stopping and local option resolution
+    exactly as in the server, but without the turn budget, so scores do not
+    depend on LLM latency. Each round's pool is reported to `on_hits(hits, k)`,
+    the final pool included (k = the last round's pool size, `session.final_k`).
+    The last round asks no question. Returns {"query", "qa_turns", "hits",
+    "summary"}; "hits" is the final pool, its first 4 are the summarised ones.
+    """
+    session = pipeline.session(summarise=summarise, turn_budget=False)
+    step = session.start(raw_input)
+    while True:
+        if on_hits is not None:
+            if step.get("stop_reason") == "no_question":
+                # 질문 단계가 [END] 로 끝낸 라운드도 그 pool 을 평가 (쿼리가 같으므로 최종 pool 의 앞부분)
+                k = session.top_ks[session.round_idx - 1]
+                on_hits(session.docs_k[:k], k)
+            k = session.final_k if step["done"] else session.top_ks[session.round_idx - 1]
+            on_hits(session.docs_k, k)
+        if step["done"]:
+            break
+        step = session.answer(answer_fn(step["question"]))
+    return {"query": session.search_query, "qa_turns": session.qa_turns, "hits": session.docs_k,
+            "summary": step.get("summary")}
@@ -0,0 +1,213 @@
+"""
+Parallel, resumable evaluation.
+
+`EvalRunner` runs an evaluation task over many samples on a thread pool. The
+indexes and the LLM client are shared read-only, and the work is mostly
+waiting on LLM calls. Each finished sample is appended straight away as one
+line of a JSONL checkpoint:
+
+    {"id": "B07…", "hits": [false, true, …], "rr": [0.0, 0.5, …], "turns": 4, "latency_s": 12.3}
+
+A failed sample is written with an "error" field and is retried on the next
+run. A restarted run skips every id that already has a result, so a long
+evaluation can be interrupted (Ctrl-C, crash, lost quota) and resumed
+without redoing finished work.
+
+    runner = EvalRunner(task, EVAL_DIR / "toy_sample.jsonl", workers=8)
+    records = runner.run(metas)           # previous + new results
+    print_retrieval_summary(records)
+
+Results are only comparable under one configuration. With `config=` (see
+`run_config()`), the runner writes to a checkpoint whose name carries a short
+fingerprint of that config, e.g. `toy_sample.3f9a0c12de.jsonl`, next to a
+`.config.json` describing it. Every record is tagged with the fingerprint,
+and a checkpoint holding records of another fingerprint is refused rather
+than merged. Changing a knob therefore starts a fresh checkpoint.
+
+    runner = EvalRunner(task, EVAL_DIR / "toy_sample.jsonl", config=run_config(model=MODEL_NAME))
+
+With `run(samples, lockstep=LockstepRunner(…))` the pending samples run as
+lock-step batch sessions instead (batch_eval.py). The task is then called as
+`task(sample, llm)` with each session's batch proxy LLM.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Callable, Iterable, List
+
+from tqdm import tqdm
+
+from batch_eval import SessionFailed
+from metrics import BOOTSTRAP_SAMPLES, CI_LEVEL, METRIC_KS, format_metrics, ranks_from_rr, retrieval_metrics
+
+# ──────────────────────────────────────────────────
+# Config
+# ──────────────────────────────────────────────────
+EVAL_DIR = Path(os.getenv("PSA_EVAL_DIR", "eval_runs"))      # one checkpoint JSONL per evaluation set
+EVAL_WORKERS = int(os.getenv("PSA_EVAL_WORKERS", "8"))       # samples evaluated concurrently
+# utils 의 검색 / 대화 설정 중 결과에 영향을 주는 것 → 체크포인트 fingerprint 에 포함
+CONFIG_KNOBS = ("EMBED_MODEL_NAME", "SEM_K_FACTOR", "HYBRID_WEIGHT", "VEC_STORAGE", "MULTI_VECTOR",
+                "HYBRID_MODE", "CASCADE_CANDIDATES", "RERANK", "RERANK_MODEL_NAME", "RERANK_POOL_FACTOR",
+                "FUSED_TURN", "REWRITE_FAST_PATH", "COMPRESS_HISTORY", "RESOLVE_OPTIONS_LOCALLY",
+                "SPECULATE_OPTIONS", "EARLY_STOP", "STOP_MIN_ROUNDS", "STOP_SCORE_GAP", "STOP_MAX_ENTROPY",
+                "STOP_ENTROPY_TEMP", "STOP_STABLE_ROUNDS")
+
+
+def run_config(**extra) -> dict:
+    """Current values of CONFIG_KNOBS plus the caller's own settings (model, profile, …)."""
+    import utils   # 지연 import: 체크포인트만 읽을 때는 인덱스 / 모델 의존성이 필요 없음
+
+    config = {name: getattr(utils, name) for name in CONFIG_KNOBS}
+    config.update(extra)
+    return config
+
+
+def config_fingerprint(config: dict) -> str:
+    """Short stable hash of a run config (key order does not matter)."""
+    blob = json.dumps(config, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(blob.encode("utf-8")).hexdigest()[:10]
+
+
+def sample_ids(samples: List[dict], key: str = "parent_asin") -> List[str]:
+    """Stable id per sample: `sample[key]`, with "#n" appended to repeats."""
+    seen: dict[str, int] = {}
+    ids = []
+    for i, sample in enumerate(samples):
+        base = str(sample.get(key) or f"row{i}")
+        n = seen.get(base, 0)
+        seen[base] = n + 1
+        ids.append(base if n == 0 else f"{base}#{n}")
+    return ids
+
+
+def load_checkpoint(path: Path, fingerprint: str | None = None) -> dict[str, dict]:
+    """id → latest successful record (a torn last line from a crash is ignored).
+
+    With a `fingerprint`, any record written under a different config (or
+    without one) raises ValueError instead of being mixed into the results.
+    """
+    done: dict[str, dict] = {}
+    if not path.exists():
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if fingerprint is not None and rec.get("config") != fingerprint:
+                raise ValueError(f"{path} holds results of config {rec.get('config')!r}, not {fingerprint!r}; "
+                                 f"refusing to mix them (move the file or use its own config)")
+            if "error" not in rec:
+                done[rec["id"]] = rec
+    return done
+
+
+class EvalRunner:
+    """Runs `task(sample) -> dict` over samples with a JSONL checkpoint (per config, if given)."""
+
+    def __init__(self, task: Callable[[dict], dict], checkpoint: Path, workers: int = EVAL_WORKERS,
+                 id_key: str = "parent_asin", config: dict | None = None):
+        self.task = task
+        self.checkpoint = Path(checkpoint)
+        self.workers = workers
+        self.id_key = id_key
+        self.config = config
+        self.fingerprint = config_fingerprint(config) if config is not None else None
+        if self.fingerprint is not None:
+            self.checkpoint = self.checkpoint.with_name(
+                f"{self.checkpoint.stem}.{self.fingerprint}{self.checkpoint.suffix}")
+        self._lock = threading.Lock()
+
+    def _write_config(self):
+        """`<checkpoint>.config.json`: the settings behind the fingerprint, for humans."""
+        path = self.checkpoint.with_suffix(".config.json")
+        if self.config is not None and not path.exists():
+            path.write_text(json.dumps({"fingerprint": self.fingerprint, **self.config}, indent=2,
+                                       ensure_ascii=False, default=str), encoding="utf-8")
+
+    def _append(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False, default=float) + "\n"
+        with self._lock:
+            with open(self.checkpoint, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _run_one(self, sample_id: str, sample: dict, *task_args) -> dict:
+        t0 = time.perf_counter()
+        try:
+            record = {"id": sample_id, **self.task(sample, *task_args)}
+        except Exception as e:  # 한 샘플 실패가 전체 평가를 멈추지 않도록 (다음 실행에서 재시도)
+            record = {"id": sample_id, "error": repr(e)}
+        record["latency_s"] = round(time.perf_counter() - t0, 3)
+        if self.fingerprint is not None:
+            record["config"] = self.fingerprint
+        self._append(record)
+        return record
+
+    def run(self, samples: Iterable[dict], desc: str | None = None, lockstep=None) -> List[dict]:
+        """Evaluate the samples without a checkpointed result; returns all successful records."""
+        samples = list(samples)
+        ids = sample_ids(samples, self.id_key)
+        self.checkpoint.parent.mkdir(parents=True, exist_ok=True)
+        self._write_config()
+        done = load_checkpoint(self.checkpoint, self.fingerprint)
+        todo = [(sid, s) for sid, s in zip(ids, samples) if sid not in done]
+        if len(todo) < len(samples):
+            print(f"[eval] {len(samples) - len(todo)}/{len(samples)} samples already in {self.checkpoint}")
+
+        if lockstep is not None:
+            sessions = [lambda llm, sid=sid, s=s: self._run_one(sid, s, llm) for sid, s in todo]
+            new = []
+            for (sid, _), r in zip(todo, lockstep.run(sessions)):
+                if isinstance(r, SessionFailed):   # _run_one 자체가 실패 (예: 체크포인트 기록) → 실패로 집계
+                    r = {"id": sid, "error": r.error}
+                new.append(r)
+            failed = sum("error" in r for r in new)
+            done.update((r["id"], r) for r in new if "error" not in r)
+            if failed:
+                print(f"[eval] {failed} samples failed; rerun to retry them")
+            return [done[sid] for sid in ids if sid in done]
+
+        failed = 0
+        pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="eval")
+        try:
+            futures = [pool.submit(self._run_one, sid, s) for sid, s in todo]
+            for fut in tqdm(as_completed(futures), total=len(futures), desc=desc or self.checkpoint.stem):
+                record = fut.result()
+                if "error" in record:
+                    failed += 1
+                    print(f"[eval] {record['id']} failed: {record['error']}")
+                else:
+                    done[record["id"]] = record
+        except KeyboardInterrupt:
+            print(f"\n[eval] interrupted — finished samples are in {self.checkpoint}; rerun to resume")
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        pool.shutdown()
+        if failed:
+            print(f"[eval] {failed} samples failed; rerun to retry them")
+        return [done[sid] for sid in ids if sid in done]
+
+
+def print_retrieval_summary(records: List[dict], ks=METRIC_KS, n_boot: int = BOOTSTRAP_SAMPLES):
+    """Per-turn Hit@k / NDCG@k / MRR with bootstrap CIs over records with an "rr" list."""
+    if not records:
+        print("No results.")
+        return
+    # rr 는 풀 전체에서의 역순위 → 정확한 순위로 환산 (0 = 풀 밖)
+    metrics = retrieval_metrics(ranks_from_rr([r["rr"] for r in records]), ks=ks, n_boot=n_boot)
+    names = [f"hit@{k}" for k in ks] + [f"ndcg@{ks[-1]}", "mrr"]
+    print(f"\n===== Mean performance across {len(records)} samples "
+          f"({CI_LEVEL:.0%} bootstrap CI) =====")
+    print(format_metrics(metrics, names))
+    latency = sorted(r["latency_s"] for r in records if "latency_s" in r)
+    if latency:
+        print(f"Latency per sample: p50 = {latency[len(latency) // 2]:.1f}s   |   max = {latency[-1]:.1f}s")
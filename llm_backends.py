@@ -0,0 +1,173 @@
+"""
+Pluggable chat-model backends.
+
+Every pipeline step only relies on the LangChain chat-model contract
+(`.invoke(prompt).content`, `.stream(prompt)`, and `prompt | llm` chains), so
+any `BaseChatModel` can stand in for `ChatOpenAI`. `make_llm` picks one:
+
+* ``openai``   – `ChatOpenAI` (default, needs OPENAI_API_KEY)
+* ``template`` – `TemplateChatModel`, a deterministic rule/template model that
+  recognises this repo's prompts; no network, no weights
+* ``llamacpp`` – a local GGUF model via llama.cpp (`LLAMA_CPP_MODEL_PATH`)
+
+The local backends accept a simulated latency so pipeline overhead and
+end-to-end timings can be benchmarked on air-gapped CPU machines.
+"""
+from __future__ import annotations
+
+import json
+import os
+import re
+import time
+from collections import Counter
+from typing import Any, Iterator, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+LLM_BACKEND = os.getenv("PSA_LLM_BACKEND", "openai")              # "openai" | "template" | "llamacpp"
+LOCAL_LLM_LATENCY = float(os.getenv("PSA_LOCAL_LLM_LATENCY", "0"))  # seconds added per call
+LOCAL_LLM_TOKEN_LATENCY = float(os.getenv("PSA_LOCAL_LLM_TOKEN_LATENCY", "0"))  # seconds per streamed word
+LLAMA_CPP_MODEL_PATH = os.getenv("LLAMA_CPP_MODEL_PATH", "")
+
+_STOPWORDS = {
+    "a", "an", "the", "and", "or", "for", "with", "of", "to", "in", "on", "by", "is", "are",
+    "i", "im", "i'm", "me", "my", "want", "need", "looking", "some", "something", "that", "this",
+    "it", "its", "be", "can", "you", "your", "what", "which", "who", "how", "do", "does", "any",
+}
+
+
+def _content_words(text: str) -> List[str]:
+    return [w for w in re.findall(r"[a-z0-9][a-z0-9'\-]*", text.lower()) if w not in _STOPWORDS]
+
+
+def _options(text: str) -> List[str]:
+    return re.findall(r"^\s*\d+\.\s*(.+)$", text, re.M)
+
+
+def template_question(texts: List[str], exclude: set[str] = frozenset()) -> str:
+    """Multiple-choice question over the words that split `texts` best (no LLM)."""
+    doc_words = [set(_content_words(t)) - exclude for t in texts]
+    # 일부 상품에만 등장하는 단어가 상품을 가장 잘 가르는 후보
+    df = Counter(w for words in doc_words for w in words)
+    split = [w for w, n in df.most_common() if 1 < n < len(doc_words) and not w.isdigit()]
+    options = (split or [w for w, _ in df.most_common()])[:4]
+    if not options:
+        return "Question: What matters most to you in this product?"
+    return "Question: Which of these best describes what you want?\n" + \
+        "\n".join(f"{i}. {w}" for i, w in enumerate(options, 1))
+
+
+class TemplateChatModel(BaseChatModel):
+    """Deterministic stand-in for `ChatOpenAI` driven by the repo's prompt templates.
+
+    Each known prompt (rewrite, reformulate, clarifying question, fused turn,
+    summary, user-simulator and product-info prompts) is answered by a small
+    rule; anything else gets a short echo. Output depends only on the prompt,
+    so runs are reproducible. Token usage is reported as word counts.
+    """
+
+    latency_s: float = LOCAL_LLM_LATENCY
+    token_latency_s: float = LOCAL_LLM_TOKEN_LATENCY
+
+    @property
+    def _llm_type(self) -> str:
+        return "psa-template"
+
+    # ── LangChain hooks ──────────────────────────────
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        prompt = "\n".join(str(m.content) for m in messages)
+        text = self.respond(prompt)
+        time.sleep(self.latency_s + self.token_latency_s * len(text.split()))
+        usage = {"prompt_tokens": len(prompt.split()), "completion_tokens": len(text.split())}
+        message = AIMessage(content=text, response_metadata={"token_usage": usage, "model_name": self._llm_type})
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Any = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        prompt = "\n".join(str(m.content) for m in messages)
+        time.sleep(self.latency_s)
+        for piece in re.findall(r"\S+\s*|\s+", self.respond(prompt)):
+            time.sleep(self.token_latency_s)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=piece))
+            if run_manager:
+                run_manager.on_llm_new_token(piece, chunk=chunk)
+            yield chunk
+
+    # ── Rules ────────────────────────────────────────
+    def respond(self, prompt: str) -> str:
+        if "Return ONLY a JSON object" in prompt and '"query"' in prompt:
+            return json.dumps({"query": self._refined_query(prompt), "question": self._question(prompt)})
+        if "Search‑query:" in prompt or "Search-query:" in prompt:
+            return self._rewrite(prompt)
+        if "refining a product" in prompt:
+            return self._refined_query(prompt)
+        if "Summarise the following" in prompt:
+            return self._summary(prompt)
+        if "Products (id · snippet)" in prompt:
+            return self._question(prompt)
+        if "You are a user who is looking for a product" in prompt:
+            return self._simulated_user(prompt)
+        if "Complexity:" in prompt:
+            return "medium"
+        if "Comparisons:" in prompt:
+            return json.dumps({"similar_to": [], "better_than": [], "worse_than": []})
+        if "Target Audiences:" in prompt or "Unique Features:" in prompt:
+            return ""
+        return " ".join(prompt.split()[:30])
+
+    @staticmethod
+    def _rewrite(prompt: str) -> str:
+        m = re.search(r"^User:\s*(.*)$", prompt, re.M)
+        return " ".join(_content_words(m.group(1) if m else prompt)[:6])
+
+    @staticmethod
+    def _refined_query(prompt: str) -> str:
+        # 번호 답변은 해당 질문의 옵션 텍스트로 치환해서 이어 붙임
+        terms = []
+        for q, a in re.findall(r"Q:\s*(.*?)\s*A:\s*(.*?)(?=\s*Q:|\n\n|$)", prompt, re.S):
+            opts = _options(q)
+            a = a.strip()
+            if a.isdigit() and 1 <= int(a) <= len(opts):
+                a = opts[int(a) - 1]
+            terms.extend(_content_words(a))
+        return " ".join(dict.fromkeys(terms)) or "product"
+
+    @staticmethod
+    def _question(prompt: str) -> str:
+        return template_question(re.findall(r"^\S+ · (.*)$", prompt, re.M))
+
+    @staticmethod
+    def _summary(prompt: str) -> str:
+        blocks = re.findall(r"^\[([^\]\n]+)\]\n(.*?)(?=\n\n\[|\n\nStart with|\n\nReturn|\Z)", prompt, re.M | re.S)
+        return "\n".join(f"- {pid}: {' '.join(text.split()[:30])}" for pid, text in blocks)
+
+    @staticmethod
+    def _simulated_user(prompt: str) -> str:
+        m = re.search(r"product title is (.*?) and (?:the )?features", prompt, re.S)
+        title_words = _content_words(m.group(1) if m else "")
+        if "option number" in prompt:
+            opts = _options(prompt)
+            if not opts:
+                return "1"
+            overlap = [len(set(_content_words(o)) & set(title_words)) for o in opts]
+            return str(overlap.index(max(overlap)) + 1)
+        return " ".join(title_words[:4])
+
+
+def make_llm(model_name: str, temperature: float, streaming: bool = False, backend: str = LLM_BACKEND):
+    """Build the chat model for `backend` (see module docstring)."""
+    if backend == "openai":
+        from langchain_community.chat_models import ChatOpenAI
+        return ChatOpenAI(model_name=model_name, temperature=temperature, streaming=streaming)
+    if backend == "template":
+        return TemplateChatModel()
+    if backend == "llamacpp":
+        from langchain_community.chat_models import ChatLlamaCpp
+        if not LLAMA_CPP_MODEL_PATH:
+            raise ValueError("LLAMA_CPP_MODEL_PATH must point to a GGUF model for the llamacpp backend")
+        return ChatLlamaCpp(model_path=LLAMA_CPP_MODEL_PATH, temperature=temperature,
+                            n_ctx=8192, max_tokens=256, streaming=streaming, verbose=False)
+    raise ValueError(f"Unknown LLM backend: {backend!r}")
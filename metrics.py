@@ -0,0 +1,140 @@
+"""
+Vectorized retrieval metrics over simulated sessions.
+
+Input is an integer array of target ranks, shape (samples, turns) or
+(samples, turns, targets) when a session has several relevant items:
+
+    r > 0   the target is at rank r (1-based)
+    r = 0   the target was not retrieved at this turn
+    r = -1  padding: the session ended before this turn (or has fewer targets)
+
+`retrieval_metrics(ranks, ks=(1, 4, 10))` computes per turn, in one pass,
+Hit@k, Recall@k and NDCG@k for every k, plus MRR. Each metric comes with a
+bootstrap confidence interval (sessions resampled with replacement).
+Replicates are processed in blocks: each block is a (block × samples) matrix
+of draw counts times the (samples × turns·metrics) value matrix, so memory
+stays bounded at 100k+ sessions.
+
+    ranks = ranks_from_rr(reciprocal_ranks)           # from user_simulator results
+    print(format_metrics(retrieval_metrics(ranks)))
+"""
+from __future__ import annotations
+
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+# ──────────────────────────────────────────────────
+# Config
+# ──────────────────────────────────────────────────
+METRIC_KS = (1, 4, 10)
+BOOTSTRAP_SAMPLES = 1000
+BOOTSTRAP_BLOCK = 50             # replicates per matmul block
+CI_LEVEL = 0.95
+
+NOT_FOUND = 0
+PADDING = -1
+
+
+# ──────────────────────────────────────────────────
+# Building rank arrays
+# ──────────────────────────────────────────────────
+def pad_turns(rows: Sequence[Sequence[float]], fill: float = PADDING, dtype=np.float64) -> np.ndarray:
+    """Ragged per-sample lists → (samples, max_turns) array; the inputs are not modified."""
+    width = max((len(r) for r in rows), default=0)
+    out = np.full((len(rows), width), fill, dtype=dtype)
+    for i, r in enumerate(rows):
+        out[i, :len(r)] = r
+    return out
+
+
+def ranks_from_rr(reciprocal_ranks: Sequence[Sequence[float]]) -> np.ndarray:
+    """Per-turn reciprocal ranks (0 = not found) → (samples, turns) int rank array."""
+    rr = pad_turns(reciprocal_ranks, fill=np.nan)
+    ranks = np.full(rr.shape, PADDING, dtype=np.int32)
+    present = ~np.isnan(rr)
+    found = present & (rr > 0)
+    ranks[present] = NOT_FOUND
+    ranks[found] = np.rint(1.0 / rr[found]).astype(np.int32)
+    return ranks
+
+
+# ──────────────────────────────────────────────────
+# Metrics
+# ──────────────────────────────────────────────────
+def _per_sample(ranks: np.ndarray, ks: Sequence[int]):
+    """Per (sample, turn) metric values, shape (S, T, M), and the present mask (S, T)."""
+    if ranks.ndim == 2:
+        ranks = ranks[:, :, None]
+    present_target = ranks >= 0
+    present = present_target.any(axis=2)
+    n_targets = present_target.sum(axis=2)
+    found = ranks > 0
+    rank_f = np.where(found, ranks, np.inf).astype(np.float64)
+
+    best = rank_f.min(axis=2)
+    columns = {"mrr": np.where(np.isfinite(best), 1.0 / best, 0.0)}
+    gain = np.where(found, 1.0 / np.log2(rank_f + 1), 0.0)
+    ideal_cum = np.cumsum(1.0 / np.log2(np.arange(2, ranks.shape[2] + 2)))
+    for k in ks:
+        within = found & (ranks <= k)
+        columns[f"hit@{k}"] = within.any(axis=2).astype(np.float64)
+        columns[f"recall@{k}"] = within.sum(axis=2) / np.maximum(n_targets, 1)
+        ideal = ideal_cum[np.clip(np.minimum(n_targets, k), 1, None) - 1]
+        columns[f"ndcg@{k}"] = np.where(within, gain, 0.0).sum(axis=2) / ideal
+    names = list(columns)
+    values = np.stack([np.where(present, columns[n], 0.0) for n in names], axis=2)
+    return names, values, present
+
+
+def retrieval_metrics(ranks, ks: Sequence[int] = METRIC_KS, n_boot: int = BOOTSTRAP_SAMPLES,
+                      level: float = CI_LEVEL, seed: int = 0) -> Dict[str, dict]:
+    """Per-turn mean and bootstrap CI of Hit@k, Recall@k, NDCG@k (each k) and MRR.
+
+    Returns {"n": counts per turn, name: {"mean": (T,), "lo": (T,), "hi": (T,)}, …}.
+    Turns average over the sessions that reached them. `n_boot=0` skips the CIs.
+    """
+    ranks = np.asarray(ranks)
+    names, values, present = _per_sample(ranks, ks)
+    S, T, M = values.shape
+    counts = present.sum(axis=0)
+    denom = np.maximum(counts, 1)
+    means = values.sum(axis=0) / denom[:, None]
+
+    out: Dict[str, dict] = {"n": counts}
+    lo = hi = np.full((T, M), np.nan)
+    if n_boot and S:
+        flat = values.reshape(S, T * M)
+        pres = present.astype(np.float64)
+        rng = np.random.default_rng(seed)
+        reps = []
+        for start in range(0, n_boot, BOOTSTRAP_BLOCK):
+            # 복원 추출 → 샘플별 뽑힌 횟수 (block × S), bincount 한 번으로
+            b = min(BOOTSTRAP_BLOCK, n_boot - start)
+            draws = rng.integers(0, S, size=(b, S)) + (np.arange(b) * S)[:, None]
+            w = np.bincount(draws.ravel(), minlength=b * S).reshape(b, S).astype(np.float64)
+            num = (w @ flat).reshape(-1, T, M)
+            den = (w @ pres)[:, :, None]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                reps.append(np.where(den > 0, num / den, np.nan))   # 그 턴의 세션이 하나도 뽑히지 않은 복제본은 제외
+        reps = np.concatenate(reps)
+        alpha = (1 - level) / 2
+        lo, hi = np.nanquantile(reps, [alpha, 1 - alpha], axis=0)
+    for m, name in enumerate(names):
+        out[name] = {"mean": means[:, m], "lo": lo[:, m], "hi": hi[:, m]}
+    return out
+
+
+def format_metrics(metrics: Dict[str, dict], names: List[str] | None = None) -> str:
+    """Table with one row per turn: n and `mean [lo, hi]` per metric."""
+    names = names or [n for n in metrics if n != "n"]
+    header = f"{'turn':<6}{'n':>8}" + "".join(f"{n:>22}" for n in names)
+    lines = [header, "─" * len(header)]
+    for t, n in enumerate(metrics["n"]):
+        cells = []
+        for name in names:
+            m = metrics[name]
+            ci = "" if np.isnan(m["lo"][t]) else f" [{m['lo'][t]:.3f},{m['hi'][t]:.3f}]"
+            cells.append(f"{m['mean'][t]:.4f}{ci}".rjust(22))
+        lines.append(f"{t + 1:<6}{int(n):>8}" + "".join(cells))
+    return "\n".join(lines)
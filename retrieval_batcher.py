@@ -0,0 +1,166 @@
+"""
+Micro-batching of retrieval across concurrent sessions.
+
+Concurrent sessions each call `bm25_search_rows` / `semantic_search` with a
+single query. While a `RetrievalBatcher` is installed, those calls are queued
+instead. A worker thread collects the requests that arrive within
+`BATCH_WINDOW_MS` (or until `BATCH_MAX` are waiting) and serves them with one
+batched `model.encode`, one FAISS `search` and one `ret.retrieve`. Each caller
+then gets its own slice of the result. A lone request waits at most one
+window.
+
+Filtered requests (with an attribute mask) still share the batched encode.
+Their index searches run one by one, since each mask selects different rows.
+If a batch raises, its unanswered requests are retried one by one, so only
+the request that actually fails gets the exception.
+
+    batcher = RetrievalBatcher(bm25_idx, vec_idx).start()
+    set_retrieval_batcher(batcher)      # utils now routes retrieval through it
+"""
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from utils import _index_search, _row_ids, bm25_search_rows
+
+# ──────────────────────────────────────────────────
+# Config
+# ──────────────────────────────────────────────────
+BATCH_WINDOW_MS = 5.0        # collect requests for at most this long after the first one
+BATCH_MAX = 32               # … or until this many are waiting
+
+
+@dataclass
+class _Request:
+    kind: str                # "bm25" | "semantic" | "encode"
+    query: str
+    k: int = 0
+    mask: np.ndarray | None = None
+    future: Future = field(default_factory=Future)
+
+
+class RetrievalBatcher:
+    def __init__(self, idx_tuple, vec_tuple, window_ms: float = BATCH_WINDOW_MS, max_batch: int = BATCH_MAX):
+        self.idx_tuple = idx_tuple
+        self.vec_tuple = vec_tuple
+        self.window_s = window_ms / 1000
+        self.max_batch = max_batch
+        self._queue: queue.Queue[_Request | None] = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, name="retrieval-batcher", daemon=True)
+        self.batches = 0
+        self.requests = 0
+
+    def start(self) -> "RetrievalBatcher":
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def serves(self, idx) -> bool:
+        """Whether a call on `idx` should be routed here (never from the worker itself)."""
+        return (idx is self.idx_tuple or idx is self.vec_tuple) and threading.current_thread() is not self._thread
+
+    # ── caller side ─────────────────────────────────
+    def _submit(self, req: _Request):
+        self._queue.put(req)
+        return req.future.result()
+
+    def bm25_rows(self, query: str, k: int, mask: np.ndarray | None = None):
+        """Same result as `bm25_search_rows(query, idx_tuple, k, mask)`."""
+        return self._submit(_Request("bm25", query, k, mask))
+
+    def semantic(self, query: str, k: int, mask: np.ndarray | None = None):
+        """(scores, ids) of shape (1, ≤k), as `_index_search` on the encoded query."""
+        return self._submit(_Request("semantic", query, k, mask))
+
+    def encode(self, query: str) -> np.ndarray:
+        return self._submit(_Request("encode", query))
+
+    # ── worker side ─────────────────────────────────
+    def _loop(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.perf_counter() + self.window_s
+            stop = False
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    req = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if req is None:
+                    stop = True
+                    break
+                batch.append(req)
+            self._run(batch)
+            if stop:
+                return
+
+    def _run(self, batch: list[_Request]):
+        self.batches += 1
+        self.requests += len(batch)
+        bm25 = [r for r in batch if r.kind == "bm25"]
+        vec = [r for r in batch if r.kind != "bm25"]
+        for reqs, fn in ((bm25, self._bm25_batch), (vec, self._vector_batch)):
+            if not reqs:
+                continue
+            try:
+                fn(reqs)
+            except Exception as e:
+                pending = [r for r in reqs if not r.future.done()]
+                if len(reqs) == 1:
+                    for r in pending:
+                        r.future.set_exception(e)
+                    continue
+                # 배치 실패 → 남은 요청을 하나씩 다시 실행해 문제의 요청만 실패하도록
+                for r in pending:
+                    try:
+                        fn([r])
+                    except Exception as e_one:
+                        if not r.future.done():
+                            r.future.set_exception(e_one)
+
+    def _bm25_batch(self, reqs: list[_Request]):
+        corpus, tok, ret = self.idx_tuple
+        plain = [r for r in reqs if r.mask is None]
+        for r in reqs:
+            if r.mask is not None:
+                r.future.set_result(bm25_search_rows(r.query, self.idx_tuple, r.k, r.mask))
+        if not plain:
+            return
+        q_tokens = tok.tokenize([r.query for r in plain], update_vocab=False)
+        k_max = min(max(r.k for r in plain), len(corpus))
+        rows, scores = ret.retrieve(q_tokens, corpus=_row_ids(len(corpus)), k=k_max)
+        for i, r in enumerate(plain):
+            k = min(r.k, len(corpus))
+            r.future.set_result((rows[i, :k], scores[i, :k]))
+
+    def _vector_batch(self, reqs: list[_Request]):
+        index, _, model = self.vec_tuple
+        embs = model.encode([r.query for r in reqs], normalize_embeddings=True).astype("float32")
+        plain = []
+        for r, emb in zip(reqs, embs):
+            if r.kind == "encode":
+                r.future.set_result(emb)
+            elif r.mask is not None:
+                r.future.set_result(_index_search(index, emb[None, :], r.k, r.mask))
+            else:
+                plain.append((r, emb))
+        if not plain:
+            return
+        scores, idxs = _index_search(index, np.stack([e for _, e in plain]), max(r.k for r, _ in plain))
+        for i, (r, _) in enumerate(plain):
+            r.future.set_result((scores[i:i + 1, :r.k], idxs[i:i + 1, :r.k]))
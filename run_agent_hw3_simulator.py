@@ -1,15 +1,21 @@
 import os
 import json
+import threading
 import numpy as np
 from pathlib import Path
 from collections import defaultdict
 from datasets import load_dataset
 import bm25s
-from langchain_community.chat_models import ChatOpenAI
 from langchain.prompts import PromptTemplate
 from utils import *
-from utils import _build_or_load_bm25_index, rewrite_query, reformulate_query, bm25_search, MODEL_NAME, TEMPERATURE, ask_disambiguation
+from utils import _build_or_load_bm25_index, rewrite_query, reformulate_query, bm25_search, MODEL_NAME, TEMPERATURE, ask_disambiguation, ConversationState, COMPRESS_HISTORY, rewrite_skip_rate, \
+    resolve_option_answer, append_constraint, RESOLVE_OPTIONS_LOCALLY, bm25_score_vector
 from user_simulator_hw3 import user_simulator
+from llm_backends import make_llm
+from batch_eval import LockstepRunner, make_batch_backend
+from tracing import TRACE_DIR, instrument, latency_table, span, trace_session
+from eval_runner import EVAL_DIR, EVAL_WORKERS, EvalRunner, run_config
+from session_store import SESSION_DB, SessionState, SessionStore, decode_turns, encode_turns, pid_rows
 
 
 # -- Assumes the following functions are defined earlier in this module:
@@ -20,23 +26,56 @@ MAX_TURNS = 10
 TOP_K = 100          # Initial pool size for asking questions
 THRESHOLD = 1.0      # BM25 score threshold for including in recommendations
 N_REC = 10            # Number of items to satisfy before switching to recommendation phase
+BATCH_BACKEND = os.getenv("PSA_BATCH_BACKEND", "")  # "openai" | "template" | … → lock-step Batch-API mode
+CHECKPOINT_SESSIONS = True  # checkpoint every turn to SESSION_DB; a rerun resumes unfinished sessions
 
 # Simulator loop implementing ask/recommend logic
 
-def run_simulator(sim: user_simulator):
+def run_simulator(sim: user_simulator, bm25_idx=None, store: SessionStore | None = None, verbose: bool = True,
+                  session_tag: str = "hw3"):
+    """Ask/recommend loop for one simulated user; returns the number of turns.
+
+    With a `store`, the agent-side state is checkpointed after every turn and
+    an unfinished session for the same user resumes from its last checkpoint
+    (the simulator's own dynamic profile starts fresh). Checkpoints are keyed
+    by `session_tag` and the user, so a run under another config (another tag)
+    never resumes them. `verbose=False` silences the per-turn transcript
+    (parallel runs would interleave it).
+    """
+    say = print if verbose else (lambda *args, **kwargs: None)
     # Build or load BM25 index
-    bm25_idx = _build_or_load_bm25_index()
+    bm25_idx = bm25_idx or _build_or_load_bm25_index()
     llm = sim.llm
-
-    disrec = set()           # IDs the simulator dislikes
-    rec_list: list[tuple[str, str]] = []  # (id, text)
-    history: list[tuple[str, str]] = []   # (question, answer)
-    action = 'ask'
-    turn = 0
-
-    # Initial user query from simulator
-    raw_query = sim.initial_ambiguous_query()
-    current_query = rewrite_query(llm, raw_query)
+    corpus = bm25_idx[0]
+    session_id = f"{session_tag}:{sim.parent_asin}"
+
+    state = store.load(session_id) if store is not None else None
+    if state is not None and not state.done:
+        # 이전 실행의 체크포인트에서 이어서 진행
+        raw_query, current_query = state.raw_query, state.query
+        history = decode_turns(state.turns)
+        action, turn = state.action, state.turn
+        disrec = {corpus[r]["id"] for r in state.disrec}
+        rec_list = [(corpus[r]["id"], corpus[r]["text"]) for r in state.rec]
+        say(f"Resuming {session_id} at turn {turn}")
+    else:
+        disrec = set()           # IDs the simulator dislikes
+        rec_list: list[tuple[str, str]] = []  # (id, text)
+        action = 'ask'
+        turn = 0
+
+        # Initial user query from simulator
+        raw_query = sim.initial_ambiguous_query()
+        # (question, answer) 목록 — COMPRESS_HISTORY면 요약 상태로 대체해 프롬프트 크기 고정
+        history: list[tuple[str, str]] | ConversationState = ConversationState(raw_query) if COMPRESS_HISTORY else []
+        current_query = rewrite_query(llm, raw_query, bm25_idx[1])
+
+    def checkpoint():
+        rows = pid_rows(corpus)
+        store.save(SessionState(session_id, kind="hw3", query=current_query, turns=encode_turns(history),
+                                raw_query=raw_query, action=action, turn=turn,
+                                disrec=sorted(rows[pid] for pid in disrec),
+                                rec=[rows[pid] for pid, _ in rec_list]))
 
     while turn < MAX_TURNS:
         turn += 1
@@ -44,34 +83,31 @@ def run_simulator(sim: user_simulator):
             # Retrieve top-K for question generation
             hits = bm25_search(current_query, bm25_idx, TOP_K)
             question = ask_disambiguation(llm, hits, history)
-            print(f"Agent: {question}")
+            say(f"Agent: {question}")
 
-            answer = sim.answer_clarification_question(question)
-            print(f"Simulator: {answer}")
+            with span("simulator"):
+                answer = sim.answer_clarification_question(question)
+            say(f"Simulator: {answer}")
             history.append((question, answer))
 
-            # Reformulate query based on history
-            current_query = reformulate_query(llm, history)
-
-            # Full BM25 scoring to filter by threshold
-            all_scores = bm25_search(current_query, bm25_idx, len(bm25_idx[0]))
-
-            scores = [score for _, _, score in all_scores]
-            min_score = min(scores)
-            max_score = max(scores)
-
-            def min_max_scale(score, min_s, max_s):
-                if max_s == min_s:
-                    return 0.0
-                return (score - min_s) / (max_s - min_s)
-
-            scaled_scores = [
-                (pid, txt, min_max_scale(score, min_score, max_score)) 
-                for pid, txt, score in all_scores
-            ]
-
-            rec_list = [(pid, txt) for pid, txt, score in scaled_scores if score > 0.6]
-            print(f"Number of items after filtering: {len(rec_list)}")
+            # 번호/옵션 답변은 로컬로 제약 추가, 자유 답변만 LLM 으로 재구성
+            constraint = resolve_option_answer(question, answer) if RESOLVE_OPTIONS_LOCALLY else None
+            if constraint is not None:
+                current_query = append_constraint(current_query, constraint)
+            else:
+                current_query = reformulate_query(llm, history)
+
+            # Full BM25 scoring to filter by threshold: min-max 스케일은 점수 벡터에서 바로 계산
+            # (전체 코퍼스를 정렬해 (pid, text, score) 튜플로 만들지 않음)
+            scores = bm25_score_vector(current_query, bm25_idx)
+            min_score, max_score = scores.min(), scores.max()
+            if max_score == min_score:
+                keep = np.empty(0, dtype=np.int64)
+            else:
+                keep = np.flatnonzero((scores - min_score) / (max_score - min_score) > 0.6)
+            keep = keep[np.argsort(-scores[keep], kind="stable")]   # 점수 내림차순 (이전과 같은 순서)
+            rec_list = [(corpus[r]["id"], corpus[r]["text"]) for r in keep]
+            say(f"Number of items after filtering: {len(rec_list)}")
 
             # 더 적극적인 추천 전환: 아이템이 15개 이하거나 3턴 이상이면 추천
             if len(rec_list) - len(disrec) <= 15 or turn >= 3:
@@ -82,16 +118,17 @@ def run_simulator(sim: user_simulator):
 
         else:  # action == 'rec'
             to_show = [(pid, txt) for pid, txt in rec_list if pid not in disrec]
-            print("Agent recommendations:")
+            say("Agent recommendations:")
             for pid, txt in to_show:
-                print(f"- {pid}: {txt.split('Descriptions: ')[0]}")
+                say(f"- {pid}: {txt.split('Descriptions: ')[0]}")
 
-            selection = sim.choose_item([pid for pid, _ in to_show])
-            print(f"Simulator selection: {selection}")
+            with span("simulator"):
+                selection = sim.choose_item([pid for pid, _ in to_show])
+            say(f"Simulator selection: {selection}")
 
             # 동적 프로필 업데이트 반영
             if selection in {pid for pid, _ in to_show}:
-                print(f"Simulator selected target: {selection}")
+                say(f"Simulator selected target: {selection}")
                 sim.user_profile.update_from_interaction("selected", selection, "positive")
                 break
             else:
@@ -102,40 +139,79 @@ def run_simulator(sim: user_simulator):
                 action = 'ask'
                 action = 'ask'
 
+        if store is not None:
+            checkpoint()
 
-    print("Session ended after {} turns.".format(turn))
+    if store is not None:
+        store.delete(session_id)
+    say("Session ended after {} turns.".format(turn))
 
     return turn
 
 
+def run_traced_simulator(sim: user_simulator, bm25_idx=None, store: SessionStore | None = None,
+                         verbose: bool = True, session_tag: str = "hw3"):
+    """`run_simulator` inside a trace session (spans → TRACE_PATH)."""
+    with trace_session(sim.parent_asin, sink=TRACE_PATH):
+        return run_simulator(sim, bm25_idx, store, verbose, session_tag)
+
 
 # 시뮬레이터 파일 경로
 SIMULATOR_JSONL_PATH = "./sample_data/books_users.jsonl"
+TRACE_PATH = TRACE_DIR / "hw3_simulator.jsonl"
 
 # LLM 세팅
-llm = ChatOpenAI(
-    model_name=MODEL_NAME, 
-    temperature=TEMPERATURE,
-)
+llm = instrument(make_llm(MODEL_NAME, TEMPERATURE))
 
 # 모든 시뮬레이터 수행
-def run_all_simulators():
+def run_all_simulators(batch_backend: str = BATCH_BACKEND, workers: int = EVAL_WORKERS):
     with open(SIMULATOR_JSONL_PATH, "r") as f:
-        all_turns = []
-        for idx, line in enumerate(f, start=1):
-            data = json.loads(line)
-            parent_asin = data["parent_asin"]
-            meta = data["metadata"]
-            review = data["reviews"]
-
-            print(f"\n=== Running simulator {idx}: {parent_asin} ===\n")
-
-            sim = user_simulator(parent_asin=parent_asin, meta=meta, review=review, llm=llm)
-            turn = run_simulator(sim)
-            all_turns.append(turn)
-        
-        print(all_turns)
-        print(f"Average: {np.mean(all_turns)}")
+        rows = [json.loads(line) for line in f]
+
+    bm25_idx = _build_or_load_bm25_index()
+    # 병렬 실행이면 턴별 대화 로그가 뒤섞이므로 끔 (결과는 체크포인트 / 요약으로 확인)
+    verbose = workers <= 1 and not batch_backend
+    # SessionStore 는 스레드마다 하나 (SQLite 연결 하나를 모든 워커가 공유하지 않도록)
+    local, stores = threading.local(), []
+
+    def thread_store() -> SessionStore | None:
+        if not CHECKPOINT_SESSIONS:
+            return None
+        if not hasattr(local, "store"):
+            local.store = SessionStore(SESSION_DB)
+            stores.append(local.store)
+        return local.store
+
+    def simulate(data, session_llm=llm):
+        if verbose:
+            print(f"\n=== Running simulator: {data['parent_asin']} ===\n")
+        sim = user_simulator(parent_asin=data["parent_asin"], meta=data["metadata"],
+                             review=data["reviews"], llm=instrument(session_llm))
+        return {"turns": run_traced_simulator(sim, bm25_idx, thread_store(), verbose, session_tag)}
+
+    # 사용자별 결과는 바로 체크포인트에 기록 → 다시 실행하면 끝난 사용자는 건너뜀
+    # (설정 fingerprint 가 파일 이름에 들어가므로 설정을 바꾸면 새 체크포인트에서 시작)
+    config = run_config(model=MODEL_NAME, temperature=TEMPERATURE, max_turns=MAX_TURNS, top_k=TOP_K,
+                        threshold=THRESHOLD, n_rec=N_REC, users=SIMULATOR_JSONL_PATH)
+    runner = EvalRunner(simulate, EVAL_DIR / f"hw3-{Path(SIMULATOR_JSONL_PATH).stem}.jsonl", workers=workers,
+                        config=config)
+    # 에이전트 체크포인트도 같은 fingerprint 로 구분 → 설정을 바꾸면 이전 설정의 세션 상태를 이어받지 않음
+    session_tag = f"hw3-{runner.fingerprint}"
+    if batch_backend:
+        # 남은 세션을 lock-step 으로 진행: 턴마다 대기 중인 프롬프트를 배치 파일 하나로 처리
+        lockstep = LockstepRunner(make_batch_backend(batch_backend), MODEL_NAME, TEMPERATURE)
+        records = runner.run(rows, "hw3", lockstep=lockstep)
+    else:
+        records = runner.run(rows, "hw3")
+    for store in stores:
+        store.close()
+    all_turns = [r["turns"] for r in records]
+
+    print(all_turns)
+    print(f"Average: {np.mean(all_turns)}")
+    print(f"Rewrite LLM calls skipped: {rewrite_skip_rate():.1%}")
+    print(f"\nPer-stage latency (traces → {TRACE_PATH})")
+    print(latency_table())
 
 
 if __name__ == "__main__":
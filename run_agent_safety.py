@@ -37,6 +37,7 @@ from dotenv import load_dotenv
 
 
 import bm25s
+import numpy as np
 from datasets import load_dataset
 from langchain_community.chat_models import ChatOpenAI
 from langchain.prompts import PromptTemplate
@@ -53,6 +54,8 @@ TEMPERATURE = 0.2
 INDEX_DIR = Path("toys_bm25s_index")
 TOP_KS = [64, 32, 16, 8, 4]        # pool sizes per round
 MAX_PRODUCTS = None                # None → full split; set small for demo
+NARROW_POOL = True                 # later rounds re-score the previous pool instead of the whole corpus
+NARROW_RECALL_GUARD = 0.35         # …unless the pool's best score < this × the query's per-term upper bound
 
 FORBIDDEN_PATTERNS = [
     r"\b\d{3}-\d{3,4}-\d{4}\b",      # 전화번호 패턴
@@ -136,6 +139,80 @@ def bm25_search(query: str, idx_tuple: Tuple[List[Dict[str, Any]], Any, Any], k:
     docs, scores = docs_mat[0], scores_mat[0]
     return [(d["id"], d["text"], float(s)) for d, s in zip(docs, scores)]
 
+
+class CandidatePool:
+    """BM25 pool carried from round to round (64 → 32 → … → 4).
+
+    `search` re-scores only the previous round's pool against the updated
+    query, reading each query term's per-document scores for the pool rows
+    out of the retriever's sparse score matrix. Term vectors are cached, so
+    a round only pays for the terms the last answer added. Scores match a
+    full-corpus BM25 search restricted to the pool. If the pool's best score
+    falls below `NARROW_RECALL_GUARD` × the sum of the per-term maxima over
+    the corpus (an upper bound on any document's score), the pool is
+    probably missing what the user now asks for, and a full-corpus search
+    runs instead.
+    """
+
+    def __init__(self, idx_tuple):
+        self.corpus, self.tok, self.ret = idx_tuple
+        self.rows = np.empty(0, dtype=np.int64)
+        self._term_scores: dict[int, np.ndarray] = {}   # token id → scores of self.rows
+        self._term_max: dict[int, float] = {}
+        self.full_searches = 0
+
+    def _token_ids(self, query: str) -> List[int]:
+        # Tokenizer id 가 곧 점수 행렬의 열 번호 (ret.retrieve 도 그대로 사용)
+        return [int(t) for t in self.tok.tokenize([query], update_vocab=False, show_progress=False)[0]]
+
+    def _term_column(self, t: int):
+        sc = self.ret.scores
+        start, end = int(sc["indptr"][t]), int(sc["indptr"][t + 1])
+        return sc["indices"][start:end], sc["data"][start:end]
+
+    def _term_vector(self, t: int) -> np.ndarray:
+        if t not in self._term_scores:
+            docs, data = self._term_column(t)
+            # 열(term)마다 문서 번호가 오름차순으로 저장되어 있어 이진 탐색 가능
+            pos = np.searchsorted(docs, self.rows)
+            hit = pos < len(docs)
+            hit[hit] = docs[pos[hit]] == self.rows[hit]
+            vec = np.zeros(len(self.rows), dtype=np.float32)
+            vec[hit] = data[pos[hit]]
+            self._term_scores[t] = vec
+        return self._term_scores[t]
+
+    def _upper_bound(self, q_ids: List[int]) -> float:
+        for t in q_ids:
+            if t not in self._term_max:
+                data = self._term_column(t)[1]
+                self._term_max[t] = float(data.max()) if len(data) else 0.0
+        return sum(self._term_max[t] for t in q_ids)
+
+    def _hits(self, rows: np.ndarray, scores: np.ndarray) -> List[Tuple[str, str, float]]:
+        docs = [self.corpus[int(r)] for r in rows]
+        return [(d["id"], d["text"], float(s)) for d, s in zip(docs, scores)]
+
+    def search(self, query: str, k: int) -> List[Tuple[str, str, float]]:
+        q_ids = self._token_ids(query)
+        if len(self.rows) and q_ids:
+            scores = np.zeros(len(self.rows), dtype=np.float32)
+            for t in q_ids:
+                scores += self._term_vector(t)
+            if scores.max() >= NARROW_RECALL_GUARD * self._upper_bound(q_ids):
+                top = np.argsort(-scores, kind="stable")[:k]
+                self.rows = self.rows[top]
+                self._term_scores = {t: v[top] for t, v in self._term_scores.items()}
+                return self._hits(self.rows, scores[top])
+
+        # 첫 라운드 또는 recall guard 실패 → 전체 코퍼스 검색
+        self.full_searches += 1
+        q_tokens = self.tok.tokenize([query], update_vocab=False)
+        k = min(k, len(self.corpus))
+        rows_mat, scores_mat = self.ret.retrieve(q_tokens, corpus=np.arange(len(self.corpus)), k=k)
+        self.rows, self._term_scores = rows_mat[0].astype(np.int64), {}
+        return self._hits(self.rows, scores_mat[0])
+
 # ──────────────────────────────────────────────────
 # LLM prompt helper
 # ──────────────────────────────────────────────────
@@ -181,8 +258,9 @@ def interactive_loop():
     if not user_query or user_query.startswith("/exit"):
         return
 
+    pool = CandidatePool(idx_tuple)
     for k in TOP_KS:
-        hits = bm25_search(user_query, idx_tuple, k)
+        hits = pool.search(user_query, k) if NARROW_POOL else bm25_search(user_query, idx_tuple, k)
         if k == 4:
             break  # final pool ready
         q = ask_disambiguation(llm, hits)
@@ -0,0 +1,245 @@
+"""
+Long-lived conversational search service.
+
+Loads the BM25 / FAISS indexes and the attribute store once, then serves many
+concurrent `ConversationSession`s over a newline-delimited JSON protocol on a
+TCP (or Unix) socket. One JSON object per line in each direction:
+
+    → {"op": "start",  "query": "wireless earbuds under $50", "profile": "toys"}
+    ← {"session_id": "…", "question": "…", "done": false}
+    → {"op": "answer", "session_id": "…", "answer": "2"}
+    ← {"session_id": "…", "question": "…", "done": false}   (or the summary)
+    → {"op": "finish", "session_id": "…"}
+    ← {"session_id": "…", "summary": "…", "products": […], "done": true}
+
+"profile" (optional) picks one of the loaded engine profiles; it defaults to
+the first one. Errors come back as {"error": "…"}. Session steps are blocking (LLM calls,
+retrieval) and run on a thread pool; a per-session lock keeps each session's
+steps in order. Each step runs under the per-turn deadline `TURN_BUDGET_MS`
+(utils.TurnBudget); evaluation runs never do. Idle sessions are dropped from
+memory after SESSION_TTL_S.
+
+With PERSIST_SESSIONS, every step is checkpointed to a shared SQLite
+`SessionStore` (session_store.py). A session id this process has not seen
+(another worker's, or one from before a restart) is restored from there.
+Each checkpoint carries a version. Before a step, a worker reloads its
+in-memory copy when the stored version is newer, and drops it when the
+checkpoint is gone (finished elsewhere). The step's own checkpoint is a
+compare-and-set on the version it started from. If another worker got
+there first, the step is rejected ("retry") instead of overwriting newer
+state.
+
+    python session_server.py                 # 127.0.0.1:8765
+    python session_server.py --profiles magazines toys
+    printf '{"op":"start","query":"mystery novel"}\\n' | nc 127.0.0.1 8765
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from engine import Engine, Pipeline
+from llm_backends import make_llm
+from tracing import TRACE_DIR, instrument, trace_session
+from retrieval_batcher import RetrievalBatcher
+from session_store import SESSION_DB, SessionStore, StaleSessionError, restore_session, snapshot_session
+from utils import MODEL_NAME, TEMPERATURE, ConversationSession, set_retrieval_batcher
+
+# ──────────────────────────────────────────────────
+# Config
+# ──────────────────────────────────────────────────
+HOST = "127.0.0.1"
+PORT = 8765
+WORKERS = 16                 # threads running session steps
+SESSION_TTL_S = 30 * 60      # idle sessions are dropped after this
+MAX_LINE_BYTES = 1 << 20
+TRACE_PATH = TRACE_DIR / "session_server.jsonl"
+MICRO_BATCH = True           # batch concurrent retrieval requests of the default profile (retrieval_batcher.py)
+PROFILES = ("magazines",)    # engine profiles loaded at startup; the first is the default
+PERSIST_SESSIONS = True      # checkpoint every step so any worker can resume the session
+STORE_TTL_S = 24 * 60 * 60   # checkpoints untouched this long are pruned
+
+
+class SessionGone(LookupError):
+    """The session finished (or expired) on another worker."""
+
+
+class SessionServer:
+    def __init__(self, workers: int = WORKERS, ttl_s: float = SESSION_TTL_S, profiles=PROFILES):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.ttl_s = ttl_s
+        self.profiles = tuple(profiles)
+        self.sessions: dict[str, ConversationSession] = {}
+        self.locks: dict[str, asyncio.Lock] = {}
+        self.last_seen: dict[str, float] = {}
+        self.profile_of: dict[str, str] = {}
+        self.versions: dict[str, int] = {}       # checkpoint version each in-memory session reflects
+        self.engine = Engine()
+        self.pipelines: dict[str, Pipeline] = {}
+        self.store = SessionStore(SESSION_DB) if PERSIST_SESSIONS else None
+
+    def load(self):
+        """Load every profile's indexes and the LLM once for all sessions."""
+        llm = instrument(make_llm(MODEL_NAME, TEMPERATURE))
+        for name in self.profiles:
+            pipeline = self.pipelines[name] = self.engine.pipeline(name, llm)
+            print(f"[✓] {name}: indexes ready ({len(pipeline.index.bm25[0]):,} docs)")
+        if MICRO_BATCH:
+            default = self.pipelines[self.profiles[0]].index
+            set_retrieval_batcher(RetrievalBatcher(default.bm25, default.vec).start())
+
+    # ── session steps (run on the thread pool) ──────
+    def _sync(self, session_id: str):
+        """Bring the in-memory session up to its latest checkpoint (another worker may have moved it)."""
+        stored = self.store.version(session_id)
+        if stored is None:
+            raise SessionGone(session_id)
+        if stored != self.versions[session_id]:
+            state = self.store.load(session_id)
+            if state is None or state.done:
+                raise SessionGone(session_id)
+            self.sessions[session_id] = restore_session(state, self.pipelines[state.profile].session(turn_budget=True))
+            self.versions[session_id] = state.version
+
+    def _step(self, session_id: str, op: str, *args) -> dict:
+        if self.store is not None and op != "start":
+            self._sync(session_id)
+        session = self.sessions[session_id]
+        with trace_session(session_id, sink=TRACE_PATH, collect=False, op=op):   # 장기 실행: sink 에만 기록
+            out = getattr(session, op)(*args)
+        if self.store is not None:
+            version = self.versions[session_id]
+            if out.get("done"):
+                if version:      # version 0: 체크포인트가 한 번도 저장되지 않음 (start 에서 바로 끝난 세션)
+                    self.store.delete(session_id, expected_version=version)
+            else:
+                self.store.save(snapshot_session(session, session_id, self.profile_of[session_id], version + 1),
+                                expected_version=version)
+                self.versions[session_id] = version + 1
+        return out
+
+    async def _run(self, session_id: str, op: str, *args) -> dict:
+        loop = asyncio.get_running_loop()
+        try:
+            async with self.locks[session_id]:
+                self.last_seen[session_id] = time.monotonic()
+                out = await loop.run_in_executor(self.executor, self._step, session_id, op, *args)
+        except SessionGone:
+            self._drop(session_id)
+            return {"session_id": session_id, "error": "session already finished or expired"}
+        except StaleSessionError:
+            # 다른 워커가 먼저 이 세션을 진행함 → 이번 결과는 버리고, 다음 요청에서 최신 상태로 다시 로드
+            return {"session_id": session_id, "error": "session was advanced by another request; retry"}
+        if out.get("done"):
+            self._drop(session_id)
+        return {"session_id": session_id, **out}
+
+    async def handle(self, msg: dict) -> dict:
+        op = msg.get("op")
+        if op == "start":
+            query = str(msg.get("query") or "").strip()
+            if not query:
+                return {"error": "start needs a non-empty 'query'"}
+            profile = msg.get("profile") or self.profiles[0]
+            pipeline = self.pipelines.get(profile)
+            if pipeline is None:
+                return {"error": f"unknown profile {profile!r} (loaded: {list(self.pipelines)})"}
+            session_id = uuid.uuid4().hex
+            self._add(session_id, profile, pipeline.session(turn_budget=True))
+            return await self._run(session_id, op, query)
+        if op not in ("answer", "finish"):
+            return {"error": f"unknown op {op!r}"}
+
+        session_id = msg.get("session_id")
+        session = self.sessions.get(session_id) or await self._resume(session_id)
+        if session is None:
+            return {"error": f"unknown session_id {session_id!r}"}
+        if op == "answer":
+            return await self._run(session_id, op, str(msg.get("answer") or "").strip())
+        return await self._run(session_id, op)
+
+    def _add(self, session_id: str, profile: str, session: ConversationSession, version: int = 0):
+        self.sessions[session_id] = session
+        self.profile_of[session_id] = profile
+        self.versions[session_id] = version
+        self.locks[session_id] = asyncio.Lock()
+        self.last_seen[session_id] = time.monotonic()
+
+    async def _resume(self, session_id) -> ConversationSession | None:
+        """Restore a checkpointed session (another worker's, or from before a restart)."""
+        if self.store is None or not isinstance(session_id, str):
+            return None
+        state = await asyncio.get_running_loop().run_in_executor(self.executor, self.store.load, session_id)
+        if state is None or state.done or state.profile not in self.pipelines:
+            return None
+        if session_id not in self.sessions:      # 동시에 같은 세션을 복원한 요청이 없을 때만
+            self._add(session_id, state.profile, restore_session(state, self.pipelines[state.profile].session(turn_budget=True)),
+                      state.version)
+        return self.sessions[session_id]
+
+    def _drop(self, session_id: str):
+        self.sessions.pop(session_id, None)
+        self.profile_of.pop(session_id, None)
+        self.versions.pop(session_id, None)
+        self.locks.pop(session_id, None)
+        self.last_seen.pop(session_id, None)
+
+    async def _reap_idle(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(min(self.ttl_s, 60))
+            cutoff = time.monotonic() - self.ttl_s
+            for session_id in [s for s, t in self.last_seen.items() if t < cutoff]:
+                if not self.locks[session_id].locked():
+                    self._drop(session_id)      # 체크포인트는 남아 있어 나중에 복원 가능
+            if self.store is not None:
+                await loop.run_in_executor(self.executor, self.store.prune, STORE_TTL_S)
+
+    # ── connection handling ─────────────────────────
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                try:
+                    msg = json.loads(line)
+                    reply = await self.handle(msg) if isinstance(msg, dict) else {"error": "expected an object"}
+                except json.JSONDecodeError as e:
+                    reply = {"error": f"invalid JSON: {e}"}
+                except Exception as e:  # 한 요청 실패가 연결/서버를 끊지 않도록
+                    reply = {"error": repr(e)}
+                writer.write((json.dumps(reply, ensure_ascii=False) + "\n").encode())
+                await writer.drain()
+        except (ConnectionResetError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = HOST, port: int = PORT, unix_path: str | None = None):
+        await asyncio.get_running_loop().run_in_executor(None, self.load)
+        if unix_path:
+            server = await asyncio.start_unix_server(self._client, path=unix_path, limit=MAX_LINE_BYTES)
+            print(f"[✓] Listening on {unix_path}")
+        else:
+            server = await asyncio.start_server(self._client, host, port, limit=MAX_LINE_BYTES)
+            print(f"[✓] Listening on {host}:{port}")
+        reaper = asyncio.create_task(self._reap_idle())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            reaper.cancel()
+            self.executor.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Conversational product-search session server")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--unix", default=None, help="serve on a Unix socket path instead of TCP")
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--profiles", nargs="+", default=list(PROFILES), help="engine profiles to load")
+    args = parser.parse_args()
+    asyncio.run(SessionServer(workers=args.workers, profiles=args.profiles).serve(args.host, args.port, args.unix))
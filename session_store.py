@@ -0,0 +1,235 @@
+"""
+Checkpointing of in-flight conversations.
+
+`SessionState` is a compact, JSON-serializable snapshot of one dialogue. It
+holds the query, the Q/A turns (or the `ConversationState` digest), the
+filters, and the current pool as corpus row numbers with their scores.
+Product texts are not stored; they are read back from the corpus on restore.
+A `SessionStore` keeps one zlib-compressed row per session in SQLite (WAL
+mode), so every worker process sharing the file can pick up any session.
+
+    store = SessionStore()
+    store.save(snapshot_session(session, session_id, profile="magazines"))
+    …                                             # crash / other worker
+    session = restore_session(store.load(session_id), pipeline.session())
+
+The same state also covers `run_agent_hw3_simulator.run_simulator`
+(kind="hw3": ask/recommend action, turn counter, rejected and candidate rows).
+Speculative prefetches and the turn budget are not persisted; a resumed
+session simply recomputes them.
+"""
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from dataclasses import asdict, dataclass, field, fields
+from pathlib import Path
+from typing import List
+
+from utils import ConversationSession, ConversationState, SearchFilters, TerminationPolicy, pid_rows
+
+# ──────────────────────────────────────────────────
+# Config
+# ──────────────────────────────────────────────────
+SESSION_DB = Path(os.getenv("PSA_SESSION_DB", "sessions.sqlite3"))
+
+
+@dataclass
+class SessionState:
+    session_id: str
+    kind: str = "conversation"             # "conversation" (ConversationSession) | "hw3" (run_simulator)
+    profile: str | None = None             # engine profile the session runs on
+    query: str = ""                        # current search query
+    turns: list | dict = field(default_factory=list)   # [[q, a], …] or a ConversationState digest
+    round_idx: int = 0
+    question: str | None = None            # open question, if any
+    docs: List[list] = field(default_factory=list)     # current pool as [[row, score], …]
+    filters: dict = field(default_factory=dict)
+    pending_question: str | None = None    # fused mode
+    pending_pool: List[int] = field(default_factory=list)
+    policy: dict | None = None             # TerminationPolicy counters
+    done: bool = False
+    version: int = 0                       # bumped on every checkpoint (optimistic concurrency)
+    # run_simulator (kind="hw3")
+    raw_query: str = ""
+    action: str = "ask"
+    turn: int = 0
+    disrec: List[int] = field(default_factory=list)
+    rec: List[int] = field(default_factory=list)
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self), ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, raw: str) -> "SessionState":
+        data = json.loads(raw)
+        known = {f.name for f in fields(cls)}
+        return cls(**{k: v for k, v in data.items() if k in known})
+
+
+# ──────────────────────────────────────────────────
+# Encoding helpers (corpus rows ↔ pids / hits)
+# ──────────────────────────────────────────────────
+def encode_hits(corpus, hits) -> List[list]:
+    rows = pid_rows(corpus)
+    return [[rows[pid], round(float(score), 6)] for pid, _, score in hits if pid in rows]
+
+
+def decode_hits(corpus, docs: List[list]) -> list[tuple[str, str, float]]:
+    return [(corpus[r]["id"], corpus[r]["text"], s) for r, s in docs]
+
+
+def encode_turns(turns) -> list | dict:
+    if isinstance(turns, ConversationState):
+        return {"initial_query": turns.initial_query, "constraints": list(turns.constraints.items()),
+                "recent": [list(t) for t in turns.recent], "n_turns": turns.n_turns}
+    return [list(t) for t in turns]
+
+
+def decode_turns(data) -> list[tuple[str, str]] | ConversationState:
+    if isinstance(data, dict):
+        state = ConversationState(data["initial_query"])
+        state.constraints.update((f, v) for f, v in data["constraints"])
+        state.recent.extend(tuple(t) for t in data["recent"])
+        state.n_turns = data["n_turns"]
+        return state
+    return [tuple(t) for t in data]
+
+
+# ──────────────────────────────────────────────────
+# ConversationSession ↔ SessionState
+# ──────────────────────────────────────────────────
+def snapshot_session(session: ConversationSession, session_id: str, profile: str | None = None,
+                     version: int = 0) -> SessionState:
+    corpus = session.bm25_idx[0]
+    rows = pid_rows(corpus)
+    policy = None
+    if session.policy is not None:
+        prev = session.policy._prev_top
+        policy = {"rounds": session.policy.rounds, "stable": session.policy.stable,
+                  "prev_top": None if prev is None else [rows[pid] for pid in prev]}
+    return SessionState(
+        session_id=session_id,
+        profile=profile,
+        query=session.search_query,
+        turns=encode_turns(session.qa_turns),
+        round_idx=session.round_idx,
+        question=session.question,
+        docs=encode_hits(corpus, session.docs_k),
+        filters=asdict(session.filters),
+        pending_question=session.pending_question,
+        pending_pool=sorted(rows[pid] for pid in session.pending_pool if pid in rows),
+        policy=policy,
+        done=session.done,
+        version=version,
+    )
+
+
+def restore_session(state: SessionState, session: ConversationSession) -> ConversationSession:
+    """Load `state` into a fresh `session` built over the same indexes (e.g. `pipeline.session()`)."""
+    corpus = session.bm25_idx[0]
+    session.search_query = state.query
+    session.qa_turns = decode_turns(state.turns)
+    session.round_idx = state.round_idx
+    session.question = state.question
+    session.docs_k = decode_hits(corpus, state.docs)
+    session.filters = SearchFilters(**state.filters)
+    session.pending_question = state.pending_question
+    session.pending_pool = {corpus[r]["id"] for r in state.pending_pool}
+    session.done = state.done
+    if state.policy is not None:
+        session.policy = session.policy or TerminationPolicy()
+        session.policy.rounds = state.policy["rounds"]
+        session.policy.stable = state.policy["stable"]
+        prev = state.policy["prev_top"]
+        session.policy._prev_top = None if prev is None else tuple(corpus[r]["id"] for r in prev)
+    return session
+
+
+# ──────────────────────────────────────────────────
+# Store
+# ──────────────────────────────────────────────────
+class StaleSessionError(RuntimeError):
+    """The checkpoint moved on (another worker saved or finished the session) since it was read."""
+
+
+class SessionStore:
+    """session_id → compressed `SessionState` in SQLite (WAL, shared by worker processes).
+
+    `save(state, expected_version=v)` only succeeds while the stored version
+    is still `v` (0 = not stored yet), so two workers holding the same session
+    cannot overwrite each other's newer checkpoint.
+    """
+
+    def __init__(self, path: Path | str = SESSION_DB):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                               "session_id TEXT PRIMARY KEY, kind TEXT, state BLOB, updated REAL, "
+                               "version INTEGER NOT NULL DEFAULT 0)")
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(sessions)")}
+            if "version" not in columns:      # 이전 스키마의 DB
+                self._conn.execute("ALTER TABLE sessions ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+    def save(self, state: SessionState, expected_version: int | None = None):
+        """Write `state`; with `expected_version`, raise `StaleSessionError` unless the stored version matches."""
+        blob = zlib.compress(state.to_json().encode("utf-8"))
+        row = (state.kind, blob, time.time(), state.version)
+        with self._lock:
+            if expected_version is None:
+                self._conn.execute("INSERT OR REPLACE INTO sessions (kind, state, updated, version, session_id) "
+                                   "VALUES (?, ?, ?, ?, ?)", (*row, state.session_id))
+                return
+            if expected_version == 0:
+                cur = self._conn.execute("INSERT OR IGNORE INTO sessions (kind, state, updated, version, session_id) "
+                                         "VALUES (?, ?, ?, ?, ?)", (*row, state.session_id))
+            else:
+                cur = self._conn.execute("UPDATE sessions SET kind = ?, state = ?, updated = ?, version = ? "
+                                         "WHERE session_id = ? AND version = ?",
+                                         (*row, state.session_id, expected_version))
+        if cur.rowcount == 0:
+            raise StaleSessionError(f"session {state.session_id} changed since version {expected_version}")
+
+    def version(self, session_id: str) -> int | None:
+        """Stored checkpoint version, or None when there is none (finished, pruned or never saved)."""
+        with self._lock:
+            row = self._conn.execute("SELECT version FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def load(self, session_id: str) -> SessionState | None:
+        with self._lock:
+            row = self._conn.execute("SELECT state FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return None if row is None else SessionState.from_json(zlib.decompress(row[0]).decode("utf-8"))
+
+    def delete(self, session_id: str, expected_version: int | None = None):
+        with self._lock:
+            if expected_version is None:
+                self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+                return
+            cur = self._conn.execute("DELETE FROM sessions WHERE session_id = ? AND version = ?",
+                                     (session_id, expected_version))
+        if cur.rowcount == 0:
+            raise StaleSessionError(f"session {session_id} changed since version {expected_version}")
+
+    def prune(self, max_age_s: float) -> int:
+        """Drop sessions not checkpointed for `max_age_s`; returns how many."""
+        with self._lock:
+            cur = self._conn.execute("DELETE FROM sessions WHERE updated < ?", (time.time() - max_age_s,))
+        return cur.rowcount
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
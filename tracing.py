@@ -0,0 +1,223 @@
+"""
+Lightweight per-stage tracing for the conversational pipeline.
+
+    with trace_session("B00X…", sink=TRACE_DIR / "hw3.jsonl"):
+        with span("bm25") as sp:
+            rows, scores = …
+            sp.set(candidates=len(rows))
+
+Spans record wall time plus free-form attributes (candidate counts, cache
+hits, …). LLM token usage is added to the enclosing span by the
+`TokenUsageHandler` callback that `instrument(llm)` attaches. State lives in
+context variables, so concurrent sessions (threads) keep separate traces, and
+outside a `trace_session` every call is a cheap no-op.
+
+Finished sessions are appended to a JSONL sink (one line per span) and, unless
+`collect=False`, kept in memory for `latency_table()`, the p50/p95 summary
+printed after an evaluation run. The in-memory buffer keeps only the latest
+COLLECT_MAX_SPANS spans; a long-lived server passes `collect=False` and relies
+on the sink (`latency_table(load_records(path))`).
+"""
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from pathlib import Path
+from typing import Any, Iterator
+
+import numpy as np
+from langchain_core.callbacks import BaseCallbackHandler
+
+TRACE_DIR = Path(os.getenv("PSA_TRACE_DIR", "traces"))
+COLLECT_MAX_SPANS = 200_000          # in-memory span records kept for latency_table (oldest dropped first)
+
+_trace: ContextVar["Trace | None"] = ContextVar("psa_trace", default=None)
+_span: ContextVar["Span | None"] = ContextVar("psa_span", default=None)
+
+_COLLECTED: deque[dict] = deque(maxlen=COLLECT_MAX_SPANS)   # 완료된 span 레코드 (latency_table 용)
+_LOCK = threading.Lock()
+
+
+class Span:
+    __slots__ = ("name", "parent", "start", "wall_ms", "attrs")
+
+    def __init__(self, name: str, parent: str | None, attrs: dict):
+        self.name = name
+        self.parent = parent
+        self.start = time.perf_counter()
+        self.wall_ms = 0.0
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def add(self, **counters):
+        for key, n in counters.items():
+            self.attrs[key] = self.attrs.get(key, 0) + n
+
+
+class _NullSpan:
+    def set(self, **attrs):
+        pass
+
+    def add(self, **counters):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Trace:
+    def __init__(self, session_id: str, meta: dict):
+        self.session_id = session_id
+        self.meta = meta
+        self.start = time.perf_counter()
+        self.spans: list[Span] = []
+
+    def records(self) -> list[dict]:
+        return [{
+            "session": self.session_id,
+            "span": sp.name,
+            "parent": sp.parent,
+            "t_ms": round((sp.start - self.start) * 1000, 3),
+            "wall_ms": round(sp.wall_ms, 3),
+            **self.meta,
+            **sp.attrs,
+        } for sp in self.spans]
+
+
+@contextmanager
+def trace_session(session_id: str, sink: Path | None = None, collect: bool = True, **meta) -> Iterator[Trace]:
+    """Collect the spans of one session; on exit append them to `sink` (JSONL)
+    and, with `collect`, to the in-memory buffer behind `latency_table()`."""
+    trace = Trace(str(session_id), meta)
+    token = _trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _trace.reset(token)
+        records = trace.records()
+        with _LOCK:
+            if collect:
+                _COLLECTED.extend(records)
+            if sink is not None:
+                sink = Path(sink)
+                sink.parent.mkdir(parents=True, exist_ok=True)
+                with open(sink, "a", encoding="utf-8") as f:
+                    for rec in records:
+                        f.write(json.dumps(rec, ensure_ascii=False, default=str) + "\n")
+
+
+@contextmanager
+def span(name: str, **attrs) -> Iterator[Span | _NullSpan]:
+    trace = _trace.get()
+    if trace is None:
+        yield _NULL_SPAN
+        return
+    parent = _span.get()
+    sp = Span(name, parent.name if parent else None, attrs)
+    token = _span.set(sp)
+    try:
+        yield sp
+    finally:
+        sp.wall_ms = (time.perf_counter() - sp.start) * 1000
+        _span.reset(token)
+        trace.spans.append(sp)
+
+
+def event(name: str, **attrs):
+    """Zero-length span marking a decision point (e.g. an early stop)."""
+    with span(name, **attrs):
+        pass
+
+
+def traced(name: str):
+    """Decorator form of `span`."""
+    def deco(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+
+def current_span() -> Span | _NullSpan:
+    return _span.get() or _NULL_SPAN
+
+
+# ──────────────────────────────────────────────────
+# LLM token usage
+# ──────────────────────────────────────────────────
+class TokenUsageHandler(BaseCallbackHandler):
+    """Adds prompt/completion tokens of every LLM call to the current span."""
+
+    def on_llm_end(self, response, **kwargs: Any) -> None:
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        if not usage and response.generations and response.generations[0]:
+            message = getattr(response.generations[0][0], "message", None)
+            if message is not None:
+                usage = (message.response_metadata or {}).get("token_usage") \
+                    or getattr(message, "usage_metadata", None) or {}
+        current_span().add(
+            llm_calls=1,
+            prompt_tokens=int(usage.get("prompt_tokens", usage.get("input_tokens", 0)) or 0),
+            completion_tokens=int(usage.get("completion_tokens", usage.get("output_tokens", 0)) or 0),
+        )
+
+
+_HANDLER = TokenUsageHandler()
+
+
+def instrument(llm):
+    """Attach the token-usage callback to a LangChain chat model (idempotent)."""
+    callbacks = list(llm.callbacks or [])
+    if _HANDLER not in callbacks:
+        llm.callbacks = callbacks + [_HANDLER]
+    return llm
+
+
+# ──────────────────────────────────────────────────
+# Aggregation
+# ──────────────────────────────────────────────────
+def load_records(path: Path) -> list[dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def latency_table(records: list[dict] | None = None) -> str:
+    """p50/p95 wall time per span name, plus mean candidates and token/cache totals.
+
+    Spans nest (e.g. `bm25` inside `retrieval`), so rows do not add up.
+    """
+    if records is None:
+        with _LOCK:
+            records = list(_COLLECTED)
+    by_name: dict[str, list[dict]] = {}
+    for rec in records:
+        by_name.setdefault(rec["span"], []).append(rec)
+
+    header = f"{'stage':<14}{'n':>7}{'p50 ms':>10}{'p95 ms':>10}{'cand':>8}{'tok in':>10}{'tok out':>9}{'cache':>7}"
+    lines = [header, "─" * len(header)]
+    for name, recs in sorted(by_name.items(), key=lambda kv: -sum(r["wall_ms"] for r in kv[1])):
+        wall = np.array([r["wall_ms"] for r in recs])
+        cand = [r["candidates"] for r in recs if "candidates" in r]
+        lines.append(
+            f"{name:<14}{len(recs):>7}{np.percentile(wall, 50):>10.1f}{np.percentile(wall, 95):>10.1f}"
+            f"{(f'{np.mean(cand):.0f}' if cand else '-'):>8}"
+            f"{sum(r.get('prompt_tokens', 0) for r in recs):>10}"
+            f"{sum(r.get('completion_tokens', 0) for r in recs):>9}"
+            f"{sum(r.get('cache_hits', 0) for r in recs):>7}"
+        )
+    return "\n".join(lines)
+
+
+def reset():
+    with _LOCK:
+        _COLLECTED.clear()
@@ -1,16 +1,21 @@
 import random
 import json
+from collections import Counter
 from typing import Dict, List, Any
 from langchain.chat_models import ChatOpenAI
 from langchain.prompts import PromptTemplate
+import numpy as np
 import pandas as pd
 
+from metrics import pad_turns
+
 class user_simulator:
     def __init__(self, meta, llm):
         self.meta = meta
         self.llm = llm
         self.retrieval_result = []
         self.retrieval_reciprocal_rank = []
+        self.retrieval_rank = []
 
     def initial_ambiguous_query(self):
         """
@@ -65,30 +70,23 @@ class user_simulator:
         evaluates the retrieval result
         """
         # retrieval_result is a list of tuples, where each tuple contains the id, the description, and the retrieval score
-        # we need to first sort the list by the retrieval score
-        retrieved_items = sorted(
-            retrieved_items, key=lambda x: x[2], reverse=True
-        )
-
-        # first check the rank for MRR
-        found = False
-        for i, item in enumerate(retrieved_items):
-            if item[0] == self.meta["parent_asin"]:
-                self.retrieval_reciprocal_rank.append(1/(i + 1))
-                found = True
-                break
-        if not found:
-            self.retrieval_reciprocal_rank.append(0)
-
+        # the rank of the target is 1 + (number of items scored above it); items tied with it
+        # count only if they come first, which matches a stable sort by score without sorting
+        target = self.meta["parent_asin"]
+        pos = next((i for i, item in enumerate(retrieved_items) if item[0] == target), None)
+        if pos is None:
+            rank = 0
+        else:
+            t_score = retrieved_items[pos][2]
+            rank = 1 + sum(1 for i, item in enumerate(retrieved_items)
+                           if item[2] > t_score or (item[2] == t_score and i < pos))
+
+        # rank is kept for metrics.retrieval_metrics (0 = not retrieved)
+        self.retrieval_rank.append(rank)
+        self.retrieval_reciprocal_rank.append(1 / rank if rank else 0)
         # we only check the top k items(to compute Hit@k)
         # in this prototype, we use k=10
-        retrieved_items = retrieved_items[:k]
-
-        for item in retrieved_items:
-            if item[0] == self.meta["parent_asin"]:
-                self.retrieval_result.append(True)
-                return
-        self.retrieval_result.append(False)
+        self.retrieval_result.append(0 < rank <= k)
         return
 
     def get_result(self):
@@ -97,6 +95,12 @@ class user_simulator:
         """
         return self.retrieval_result, self.retrieval_reciprocal_rank
 
+    def get_ranks(self):
+        """
+        returns the target rank per turn (0 = not retrieved)
+        """
+        return self.retrieval_rank
+
 
 def accumulate_retrieval_result(retrieval_result_list, retrieval_reciprocal_rank_list):
     """
@@ -108,65 +112,16 @@ def accumulate_retrieval_result(retrieval_result_list, retrieval_reciprocal_rank
 
     # first, count the lengths of each retrieval result
     # this is used to evaluate the performance of 'early stopping'
-    retrieval_result_length = {}
-    for retrieval_result in retrieval_result_list:
-        # if a given length is not in the dictionary, we add it by setting it to 1
-        # otherwise, we increment the count of that length by 1
-        retrieval_result_length[len(retrieval_result)] = retrieval_result_length.get(
-            len(retrieval_result), 0
-        ) + 1
+    retrieval_result_length = dict(Counter(len(r) for r in retrieval_result_list))
 
     # now, we want to compute hit@k (k = 4 by default in our implementation) for each retrieval turn
-    # for example, we check the first turn from all retrieval results, and aggregate them
-
-    # we need to find the maximum length of the retrieval result
-    max_length = max(retrieval_result_length.keys())
-
-    # we pad the retrieval result list with None
-    # so that all retrieval results have the same length
-    for retrieval_result in retrieval_result_list:
-        retrieval_result.extend([None] * (max_length - len(retrieval_result)))
-
-    for reciprocal_rank in retrieval_reciprocal_rank_list:
-        reciprocal_rank.extend([None] * (max_length - len(reciprocal_rank)))
-
-    # now, we need to aggregate the retrieval results per turn
-    # each turn may contain a different number of retrieval results(so we need to ignore None and only count True/False)
-    hitmiss = [[0, 0] for _ in range(max_length)]
-    # hitmiss[i][0] is the number of True for the i-th retrieval turn
-    # hitmiss[i][1] is the number of False for the i-th retrieval turn
-
-    for retrieval_result in retrieval_result_list:
-        for i in range(max_length):
-            if retrieval_result[i] is None:
-                continue
-
-            if retrieval_result[i]:
-                hitmiss[i][0] += 1
-            else:
-                hitmiss[i][1] += 1
-
-    hit_at_k_for_each_turn = [0.0 for _ in range(max_length)]
-
-    for i in range(max_length):
-        # it is guaranteed that hitmiss[i][0] + hitmiss[i][1] > 0
-        hit_at_k_for_each_turn[i] = hitmiss[i][0] / (hitmiss[i][0] + hitmiss[i][1])
-
-
-    # We also compute MRR for each turn
-    MRR_per_turn = [0.0 for _ in range(max_length)]
-    MRR_count = [0 for _ in range(max_length)]
-
-    for reciprocal_rank in retrieval_reciprocal_rank_list:
-        for i in range(max_length):
-            if reciprocal_rank[i] is None:
-                continue
-            else:
-                MRR_per_turn[i] += reciprocal_rank[i]
-                MRR_count[i] += 1
-
-    for i in range(max_length):
-        # it is guaranteed that MRR_count[i] > 0
-        MRR_per_turn[i] /= MRR_count[i]
+    # for example, we check the first turn from all retrieval results, and aggregate them.
+    # the lists are copied into NaN-padded arrays (the caller's lists are left untouched),
+    # so each turn only averages over the items that reached it
+    hits = pad_turns(retrieval_result_list, fill=np.nan)
+    rr = pad_turns(retrieval_reciprocal_rank_list, fill=np.nan)
+
+    hit_at_k_for_each_turn = np.nanmean(hits, axis=0).tolist()
+    MRR_per_turn = np.nanmean(rr, axis=0).tolist()
 
     return retrieval_result_length, hit_at_k_for_each_turn, MRR_per_turn
@@ -1,7 +1,12 @@
 from __future__ import annotations
 
 
+import copy
+import hashlib
 import json
+import re
+from dataclasses import dataclass, field, replace
+from functools import lru_cache
 from pathlib import Path
 from typing import List, Tuple, Dict, Any
 from dotenv import load_dotenv
@@ -13,17 +18,22 @@ import bm25s
 from datasets import load_dataset
 from langchain_community.chat_models import ChatOpenAI
 from langchain.prompts import PromptTemplate
-from sentence_transformers import SentenceTransformer
 from Stemmer import Stemmer
 from tqdm import tqdm
 import warnings
 import os
 from books_product_info import BooksProductInfoExtractor
+from llm_backends import make_llm, template_question
+from tracing import span, traced, instrument, event as trace_event
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 warnings.filterwarnings('ignore')
 from datasets import load_dataset
-from collections import defaultdict
+import threading
+from contextlib import contextmanager
+import time
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 
 load_dotenv()
 
@@ -38,13 +48,49 @@ SEM_K_FACTOR = 2                  # retrieve k*factor from each modality
 HYBRID_WEIGHT = 0.5               # 0.5 lexical + 0.5 semantic
 EMBED_MODEL_NAME = "BAAI/bge-small-en-v1.5"
 EMBED_DIM = 384
+VEC_STORAGE = "flat"              # "flat" (float32) | "sq8" | "sqfp16" | "fp16" (NumPy float16)
+MULTI_VECTOR = False              # True → embed passages, max-sim aggregate per product
+PASSAGE_WORDS = 200               # words per passage (fits bge-small's 512-token window)
+MAX_PASSAGES = 8                  # per-product passage cap
+PASSAGE_STORAGE = "sq8"           # storage for the passage index (see VEC_STORAGE_FILES)
+FILTER_EXACT_MAX = 50_000         # filtered semantic search scores ≤ this many rows directly
+HYBRID_MODE = "parallel"          # "parallel" (BM25 + ANN) | "cascade" (BM25 → stored-embedding rescoring)
+CASCADE_CANDIDATES = 200          # BM25 candidates re-scored per query in cascade mode
+RERANK = False                    # cross-encoder rerank of the fused candidates
+RERANK_MODEL_NAME = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+RERANK_POOL_FACTOR = 3            # rerank k*factor fused candidates, keep top k
+RERANK_BUDGET_MS = 250            # per-call latency budget for the cross-encoder
+RERANK_MAX_CHARS = 1500           # document text fed to the cross-encoder
+RERANK_CACHE_SIZE = 20_000        # (query, pid) scores kept in the LRU cache
+FUSED_TURN = False                # one LLM call per turn → refined query + next question
+REWRITE_FAST_PATH = True          # skip the rewrite LLM call when the input already looks like a query
+REWRITE_MAX_WORDS = 6             # fast path: at most this many words …
+REWRITE_MAX_STOPWORD_RATIO = 0.34 # … mostly content words …
+REWRITE_MIN_VOCAB_COVERAGE = 0.75 # … and most of them known to the BM25 vocabulary
+COMPRESS_HISTORY = False          # prompts get ConversationState digests instead of the full transcript
+HISTORY_RECENT_TURNS = 2          # verbatim Q/A turns kept in the rolling digest
+MAX_CONSTRAINTS = 8               # facet → value slots kept in the constraint summary
+FUSED_MIN_OVERLAP = 0.5           # reuse the fused question if ≥ this share of the new pool was in the old one
+RESOLVE_OPTIONS_LOCALLY = True    # numbered / option-text answers refine the query without an LLM call
+SPECULATE_OPTIONS = False         # while the user reads a question, prefetch query + pool for each numbered option
+EARLY_STOP = False                # end the dialogue once retrieval is confident (TerminationPolicy); thresholds below are uncalibrated
+STOP_MIN_ROUNDS = 2               # … but only after the user answered at least one question
+STOP_SCORE_GAP = 0.6              # (top1 − top2) / (top1 − top‑k) of the fused scores ≥ this → clear winner
+STOP_MAX_ENTROPY = 0.35           # normalised entropy of softmax(min‑max scores / τ) ≤ this → peaked pool
+STOP_ENTROPY_TEMP = 0.1           # τ for the entropy signal
+STOP_STABLE_ROUNDS = 2            # identical top‑4 for this many consecutive answers → answers stopped helping
+TURN_BUDGET_MS = 8000             # per-turn deadline for sessions built with turn_budget=True (session_server only)
+DEGRADED_SNIPPET_WORDS = 30       # product snippet length in the question prompt once the budget is tight
+QUESTION_CACHE_SIZE = 4096        # pool → generated question, reused when there is no time for the LLM
+SPECULATION_WORKERS = 4           # threads for speculative prefetch (shared by all sessions)
+EVAL_SAMPLE_PATHS = [Path("./sample_data/magazine_users.jsonl")]
 
 
-def _iter_products(limit: int | None = None):
+def _iter_products(limit: int | None = None, category: str = "Magazine_Subscriptions"):
     # 1) 메타 정보
     meta_ds = load_dataset(
         "McAuley-Lab/Amazon-Reviews-2023",
-        'raw_meta_Magazine_Subscriptions',
+        f"raw_meta_{category}",
         split="full",
         trust_remote_code=True,
     )
@@ -52,7 +98,7 @@ def _iter_products(limit: int | None = None):
     # 2) 리뷰 정보 →  parent_asin ➜ [review dicts]
     review_ds = load_dataset(
         "McAuley-Lab/Amazon-Reviews-2023",
-        'raw_review_Magazine_Subscriptions',
+        f"raw_review_{category}",
         split="full",
         trust_remote_code=True,
     )
@@ -81,7 +127,13 @@ def _iter_products(limit: int | None = None):
             "hierarchical": product_info.create_enhanced_book_document().get("hierarchical", {}),
             "structured": product_info.create_enhanced_book_document().get("structured", {}),
             "search_boost_terms": product_info.search_boost_terms,
-            "negative_signals": product_info.negative_signals
+            "negative_signals": product_info.negative_signals,
+            "attributes": {
+                "price": product_info.price,
+                "average_rating": product_info.average_rating,
+                "rating_number": product_info.rating_count,
+                "categories": product_info.categories,
+            },
         }
         yield doc  # {"id": ..., "text": ..., ...}
 
@@ -90,19 +142,25 @@ def _iter_products(limit: int | None = None):
 # Index build / load
 # ──────────────────────────────────────────────────
 
-def _build_or_load_bm25_index(limit: int | None = None):
-    """Load cached BM25s index or build it if absent."""
+def _build_or_load_bm25_index(limit: int | None = None, index_dir: Path | None = None, products=None):
+    """Load cached BM25s index or build it if absent.
+
+    `index_dir` defaults to `INDEX_DIR`; `products(limit)` yields the corpus
+    documents when building (default `_iter_products`).
+    """
+    index_dir = index_dir or INDEX_DIR
     stemmer = Stemmer("english")
     tokenizer = bm25s.tokenization.Tokenizer(stemmer=stemmer, stopwords='en')
-    if INDEX_DIR.exists():
-        print("[+] Loading cached BM25s index…")
-        retriever = bm25s.BM25.load(INDEX_DIR, mmap=True, load_corpus=True)
-        tokenizer.load_vocab(INDEX_DIR)
-        tokenizer.load_stopwords(INDEX_DIR)
+    if index_dir.exists():
+        print(f"[+] Loading cached BM25s index ({index_dir})…")
+        retriever = bm25s.BM25.load(index_dir, mmap=True, load_corpus=True)
+        tokenizer.load_vocab(index_dir)
+        tokenizer.load_stopwords(index_dir)
+        precompute_snippets(retriever.corpus)
         return retriever.corpus, tokenizer, retriever
 
     print("[+] Building BM25s index (first run — please wait)…")
-    corpus = list(_iter_products(limit))
+    corpus = list((products or _iter_products)(limit))
     texts = [d["text"] for d in corpus]
 
     tokens = tokenizer.tokenize(texts)
@@ -110,66 +168,610 @@ def _build_or_load_bm25_index(limit: int | None = None):
     retriever.index(tokens)
     retriever.vocab_dict = {str(k): v for k, v in retriever.vocab_dict.items()}
 
-    INDEX_DIR.mkdir(parents=True, exist_ok=True)
-    retriever.save(INDEX_DIR, corpus=corpus)
-    tokenizer.save_vocab(INDEX_DIR)
-    tokenizer.save_stopwords(INDEX_DIR)
-    print(f"[✓] Saved index ({len(corpus):,} docs) → {INDEX_DIR}")
+    index_dir.mkdir(parents=True, exist_ok=True)
+    retriever.save(index_dir, corpus=corpus)
+    tokenizer.save_vocab(index_dir)
+    tokenizer.save_stopwords(index_dir)
+    AttributeStore.from_corpus(corpus).save(index_dir / "attributes.npz")
+    print(f"[✓] Saved index ({len(corpus):,} docs) → {index_dir}")
+    precompute_snippets(corpus)
     return corpus, tokenizer, retriever
 
 
-def _build_or_load_vector_index(corpus: List[Dict[str, str]]):
-    """Load or build FAISS index with BGE embeddings."""
-    if (VEC_DIR / "index.faiss").exists():
-        print("[+] Loading cached FAISS vector index…")
-        index = faiss.read_index(str(VEC_DIR / "index.faiss"))
-        id_map = json.loads((VEC_DIR / "id_map.json").read_text())
-        model = SentenceTransformer(EMBED_MODEL_NAME)
-        return index, id_map, model
+# ──────────────────────────────────────────────────
+# Structured attributes (price / rating / category filters)
+# ──────────────────────────────────────────────────
 
-    print("[+] Building FAISS vector index (first run — please wait)…")
-    model = SentenceTransformer(EMBED_MODEL_NAME)
-    model.max_seq_length = 512
-    texts = [d["text"] for d in corpus]
+@dataclass
+class SearchFilters:
+    """Attribute constraints collected over a conversation (None = unconstrained)."""
+    min_price: float | None = None
+    max_price: float | None = None
+    min_rating: float | None = None
+    min_rating_number: int | None = None
+    categories: List[str] = field(default_factory=list)
+
+    def is_empty(self) -> bool:
+        return self == SearchFilters()
+
+    def merge(self, newer: "SearchFilters") -> "SearchFilters":
+        """Later answers override numeric bounds; categories accumulate."""
+        merged = replace(self, categories=list(dict.fromkeys(self.categories + newer.categories)))
+        for name in ("min_price", "max_price", "min_rating", "min_rating_number"):
+            if getattr(newer, name) is not None:
+                setattr(merged, name, getattr(newer, name))
+        return merged
+
+
+class AttributeStore:
+    """Column store of filterable attributes, row-aligned with the BM25 corpus.
+
+    Missing values (NaN) pass numeric filters, so products with incomplete
+    metadata are not silently dropped. Categories are kept as a CSR layout
+    (`cat_indptr`, `cat_ids`) over a label vocabulary.
+    """
+
+    def __init__(self, price, average_rating, rating_number, cat_vocab, cat_indptr, cat_ids):
+        self.price = price
+        self.average_rating = average_rating
+        self.rating_number = rating_number
+        self.cat_vocab = list(cat_vocab)
+        self.cat_indptr = cat_indptr
+        self.cat_ids = cat_ids
+        self._cat_lookup = {c.lower(): i for i, c in enumerate(self.cat_vocab)}
+        self._cat_rows = np.repeat(np.arange(len(price)), np.diff(cat_indptr))
+
+    def __len__(self):
+        return len(self.price)
+
+    @classmethod
+    def from_corpus(cls, corpus) -> "AttributeStore":
+        cols = {"price": [], "average_rating": [], "rating_number": []}
+        vocab: dict[str, int] = {}
+        indptr, ids = [0], []
+        for d in corpus:
+            attrs = d.get("attributes") or {}
+            for name, col in cols.items():
+                col.append(np.nan if attrs.get(name) is None else float(attrs[name]))
+            for c in attrs.get("categories") or []:
+                ids.append(vocab.setdefault(c, len(vocab)))
+            indptr.append(len(ids))
+        return cls(
+            *(np.asarray(cols[n], dtype=np.float32) for n in ("price", "average_rating", "rating_number")),
+            list(vocab),
+            np.asarray(indptr, dtype=np.int64),
+            np.asarray(ids, dtype=np.int32),
+        )
+
+    def save(self, path: Path):
+        np.savez(path, price=self.price, average_rating=self.average_rating,
+                 rating_number=self.rating_number, cat_vocab=np.asarray(self.cat_vocab, dtype=str),
+                 cat_indptr=self.cat_indptr, cat_ids=self.cat_ids)
+
+    @classmethod
+    def load(cls, path: Path) -> "AttributeStore":
+        z = np.load(path)
+        return cls(z["price"], z["average_rating"], z["rating_number"],
+                   z["cat_vocab"].tolist(), z["cat_indptr"], z["cat_ids"])
+
+    def match_categories(self, text: str) -> List[str]:
+        """Category labels that appear verbatim (case-insensitive) in `text`."""
+        low = f" {text.lower()} "
+        return [self.cat_vocab[i] for c, i in self._cat_lookup.items() if f" {c} " in low]
+
+    def mask(self, filters: SearchFilters) -> np.ndarray | None:
+        """Boolean row mask for `filters`.
+
+        Returns None when nothing is constrained or when no product satisfies
+        the filters, in which case callers search the full catalog.
+        """
+        if filters.is_empty():
+            return None
+        keep = np.ones(len(self), dtype=bool)
+        bounds = [
+            (self.price, filters.min_price, np.greater_equal),
+            (self.price, filters.max_price, np.less_equal),
+            (self.average_rating, filters.min_rating, np.greater_equal),
+            (self.rating_number, filters.min_rating_number, np.greater_equal),
+        ]
+        for col, bound, op in bounds:
+            if bound is not None:
+                keep &= np.isnan(col) | op(col, bound)
+        if filters.categories:
+            wanted = [self._cat_lookup[c.lower()] for c in filters.categories if c.lower() in self._cat_lookup]
+            in_cat = np.zeros(len(self), dtype=bool)
+            in_cat[self._cat_rows[np.isin(self.cat_ids, wanted)]] = True
+            keep &= in_cat
+        return keep if keep.any() else None
+
+
+def _build_or_load_attribute_store(corpus, index_dir: Path | None = None) -> AttributeStore:
+    """Load the attribute store saved next to the BM25 index, or build it from `corpus`."""
+    path = (index_dir or INDEX_DIR) / "attributes.npz"
+    if path.exists():
+        return AttributeStore.load(path)
+    store = AttributeStore.from_corpus(corpus)
+    store.save(path)
+    return store
+
+
+# 가격은 통화 표시($ / dollars / usd / bucks)가 있어야만 인정 ("up to 10 years", "max 3 subscriptions" 는 가격 아님)
+_NUM = r"(\d+(?:\.\d+)?)"
+_CURRENCY = r"(?:dollars?|usd|bucks)\b"
+_PRICE = rf"(?=\$|\d+(?:\.\d+)?\s*{_CURRENCY})\$?\s*{_NUM}\s*(?:{_CURRENCY})?"
+_BARE_PRICE = rf"\$?\s*{_NUM}"
+_FILTER_PATTERNS = [
+    (re.compile(rf"\b(?:between|from)\s+{_PRICE}\s*(?:and|to|-)\s*{_BARE_PRICE}", re.I), ("min_price", "max_price")),
+    (re.compile(rf"\b(?:between|from)\s+{_NUM}\s*(?:and|to|-)\s*{_PRICE}", re.I), ("min_price", "max_price")),
+    (re.compile(rf"\$\s*{_NUM}\s*-\s*\$?\s*{_NUM}", re.I), ("min_price", "max_price")),
+    (re.compile(rf"(?<![\d.])\b{_NUM}\s*(?:to|-)\s*{_PRICE}", re.I), ("min_price", "max_price")),
+    (re.compile(rf"\b(?:under|below|less than|cheaper than|at most|up to|max(?:imum)?)\s+{_PRICE}", re.I), ("max_price",)),
+    (re.compile(rf"\b(?:over|above|more than|at least|min(?:imum)?)\s+{_PRICE}", re.I), ("min_price",)),
+    # "4 out of 5 stars" → 4 ("out of 5" 는 평점 척도이지 평점이 아님)
+    (re.compile(r"(?<!out of )\b([1-5](?:\.\d)?)\s*(?:\+|or more|and up|or higher)?\s*(?:out of\s+5\s*)?\bstars?\b",
+                re.I), ("min_rating",)),
+    (re.compile(r"\b(?:at least|over|more than)\s+(\d+)\s+(?:ratings|reviews)\b", re.I), ("min_rating_number",)),
+]
+
+
+def extract_filters(text: str, store: AttributeStore | None = None) -> SearchFilters:
+    """Parse price / rating / category constraints stated in free text.
+
+    >>> extract_filters("under $25, 4+ stars").max_price, extract_filters("under $25, 4+ stars").min_rating
+    (25.0, 4.0)
+    >>> extract_filters("between 10 and 20 dollars").min_price
+    10.0
+    >>> extract_filters("10 to 20 dollars").max_price, extract_filters("$10-$20").min_price
+    (20.0, 10.0)
+    >>> extract_filters("rated 4 out of 5 stars").min_rating, extract_filters("out of 5 stars").min_rating
+    (4.0, None)
+    >>> extract_filters("toys for kids up to 10 years old").is_empty()
+    True
+    >>> extract_filters("under 5 years").is_empty(), extract_filters("max 3 subscriptions").is_empty()
+    (True, True)
+    >>> extract_filters("1 starter kit").is_empty(), extract_filters("between 5 and 10 years").is_empty()
+    (True, True)
+    """
+    filters = SearchFilters()
+    for pattern, names in _FILTER_PATTERNS:
+        m = pattern.search(text)
+        if not m:
+            continue
+        for name, value in zip(names, m.groups()):
+            if getattr(filters, name) is None:
+                setattr(filters, name, int(value) if name == "min_rating_number" else float(value))
+    if store is not None:
+        filters.categories = store.match_categories(text)
+    return filters
+
+
+def _load_embed_model():
+    # sentence_transformers 는 torch 를 끌어오므로 (수 초) 실제로 필요할 때 import
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(EMBED_MODEL_NAME)
+
+
+# 저장 방식별 파일 이름 (flat 은 기존 캐시와 호환되도록 index.faiss 유지)
+VEC_STORAGE_FILES = {
+    "flat": "index.faiss",
+    "sq8": "index_sq8.faiss",
+    "sqfp16": "index_sqfp16.faiss",
+    "fp16": "embeddings_fp16.npy",
+}
+_FP16_BLOCK = 65536               # rows upcast to float32 at a time in Float16FlatIndex
+
+
+class Float16FlatIndex:
+    """Exact inner-product search over a (N, d) float16 matrix.
+
+    Mirrors the part of the FAISS API used here (`ntotal`, `d`, `search`) so it
+    can sit in `vec_tuple` in place of a FAISS index. Rows are upcast block by
+    block, so peak extra memory stays at `_FP16_BLOCK × d` floats.
+    """
+
+    def __init__(self, vectors: np.ndarray):
+        self.vectors = vectors
+        self.ntotal, self.d = vectors.shape
+
+    def search(self, queries: np.ndarray, k: int, mask: np.ndarray | None = None):
+        rows = np.arange(self.ntotal) if mask is None else np.flatnonzero(mask)
+        queries = np.asarray(queries, dtype=np.float32)
+        scores = np.empty((len(queries), len(rows)), dtype=np.float32)
+        for start in range(0, len(rows), _FP16_BLOCK):
+            sel = rows[start:start + _FP16_BLOCK]
+            block = self.vectors[start:start + len(sel)] if mask is None else self.vectors[sel]
+            scores[:, start:start + len(sel)] = queries @ np.asarray(block, dtype=np.float32).T
+        return _topk(scores, rows, k)
+
+
+def _topk(scores: np.ndarray, rows: np.ndarray, k: int):
+    """FAISS-style (D, I) for the k best columns of `scores`; `rows` maps columns to ids."""
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.empty((len(scores), 0), dtype=np.float32), np.empty((len(scores), 0), dtype=np.int64)
+    cols = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top = np.take_along_axis(scores, cols, axis=1)
+    order = np.argsort(-top, axis=1)
+    cols = np.take_along_axis(cols, order, axis=1)
+    return np.take_along_axis(top, order, axis=1), rows[cols].astype(np.int64)
+
+
+def _index_search(index, queries: np.ndarray, k: int, mask: np.ndarray | None = None):
+    """`index.search` restricted to rows where `mask` is True.
 
+    Small candidate sets are scored exactly from reconstructed vectors
+    (cost O(candidates)); larger ones go through a FAISS `IDSelector`.
+    """
+    if mask is None:
+        return index.search(queries, k)
+    if not isinstance(index, faiss.Index):
+        return index.search(queries, k, mask=mask)
+    rows = np.flatnonzero(mask).astype(np.int64)
+    if len(rows) <= FILTER_EXACT_MAX:
+        return _topk(queries @ index.reconstruct_batch(rows).T, rows, k)
+    params = faiss.SearchParameters(sel=faiss.IDSelectorBatch(rows))
+    return index.search(queries, k, params=params)
+
+
+def _make_vector_index(embeddings: np.ndarray, storage: str = VEC_STORAGE):
+    """Build an in-memory index over unit vectors using the given storage type."""
+    dim = embeddings.shape[1]
+    if storage == "flat":
+        index = faiss.IndexFlatIP(dim)
+    elif storage in ("sq8", "sqfp16"):
+        qtype = faiss.ScalarQuantizer.QT_8bit if storage == "sq8" else faiss.ScalarQuantizer.QT_fp16
+        index = faiss.IndexScalarQuantizer(dim, qtype, faiss.METRIC_INNER_PRODUCT)
+        index.train(embeddings)
+    elif storage == "fp16":
+        return Float16FlatIndex(embeddings.astype(np.float16))
+    else:
+        raise ValueError(f"Unknown vector storage: {storage!r}")
+    index.add(embeddings)
+    return index
+
+
+def _save_vector_index(index, path: Path):
+    if isinstance(index, Float16FlatIndex):
+        np.save(path, index.vectors)
+    else:
+        faiss.write_index(index, str(path))
+
+
+def _read_vector_index(path: Path):
+    if path.suffix == ".npy":
+        return Float16FlatIndex(np.load(path, mmap_mode="r"))
+    return faiss.read_index(str(path))
+
+
+def _vector_bytes_per_item(index) -> float:
+    if isinstance(index, Float16FlatIndex):
+        return index.vectors.itemsize * index.d
+    return faiss.serialize_index(index).nbytes / max(index.ntotal, 1)
+
+
+def _encode_corpus(model, texts: List[str]) -> np.ndarray:
     # Embed in batches to avoid OOM
     embeddings = []
     for i in tqdm(range(0, len(texts), 256), desc="Embedding"):
         batch_emb = model.encode(texts[i:i+256], show_progress_bar=False, normalize_embeddings=True)
         embeddings.append(batch_emb)
-    embeddings = np.vstack(embeddings).astype('float32')
+    return np.vstack(embeddings).astype('float32')
+
+
+def _build_or_load_vector_index(corpus: List[Dict[str, str]], storage: str = VEC_STORAGE,
+                                vec_dir: Path | None = None):
+    """Load or build the vector index with BGE embeddings.
+
+    `storage` selects how vectors are kept in memory (see `VEC_STORAGE_FILES`).
+    A quantized index is derived from a cached float32 index when one exists,
+    so switching storage does not require re-embedding the corpus.
+    With `MULTI_VECTOR` set, the passage index is returned instead.
+    `vec_dir` defaults to `VEC_DIR`.
+    """
+    vec_dir = vec_dir or VEC_DIR
+    if MULTI_VECTOR:
+        return VectorIndex(*_build_or_load_passage_index(corpus, vec_dir=vec_dir), vec_dir=vec_dir)
+
+    index_path = vec_dir / VEC_STORAGE_FILES[storage]
+    flat_path = vec_dir / VEC_STORAGE_FILES["flat"]
+    if index_path.exists():
+        print(f"[+] Loading cached vector index ({storage})…")
+        index = _read_vector_index(index_path)
+        id_map = json.loads((vec_dir / "id_map.json").read_text())
+        model = _load_embed_model()
+        return VectorIndex(index, id_map, model, vec_dir=vec_dir)
+
+    model = _load_embed_model()
+    if flat_path.exists():
+        print(f"[+] Deriving {storage} vector index from cached float32 index…")
+        flat = faiss.read_index(str(flat_path))
+        embeddings = flat.reconstruct_n(0, flat.ntotal)
+        id_map = json.loads((vec_dir / "id_map.json").read_text())
+    else:
+        print("[+] Building FAISS vector index (first run — please wait)…")
+        model.max_seq_length = 512
+        embeddings = _encode_corpus(model, [d["text"] for d in corpus])
+        id_map = [d["id"] for d in corpus]
+
+    # inner product on unit vectors == cosine sim
+    index = _make_vector_index(embeddings, storage)
+
+    # Persist (raw vectors too, mmap'd by cascade_search; fp16 storage already is that file)
+    vec_dir.mkdir(parents=True, exist_ok=True)
+    _save_vector_index(index, index_path)
+    if storage != "fp16" and not (vec_dir / "embeddings.npy").exists():
+        np.save(vec_dir / "embeddings.npy", embeddings)
+    (vec_dir / "id_map.json").write_text(json.dumps(id_map))
+    print(f"[✓] Saved {storage} vector index ({len(id_map):,} vectors, "
+          f"{_vector_bytes_per_item(index):,.0f} B/vector) → {index_path}")
+    return VectorIndex(index, id_map, model, vec_dir=vec_dir)
+
+
+class VectorIndex(tuple):
+    """The (index, id_map, model) vec_tuple, plus the directory it was loaded from.
+
+    Unpacks like the plain 3-tuple; `vec_dir` tells cascade_search /
+    target_rank where this index's `embeddings.npy` lives.
+    """
+    vec_dir: Path | None
+
+    def __new__(cls, index, id_map, model, vec_dir: Path | None = None):
+        self = super().__new__(cls, (index, id_map, model))
+        self.vec_dir = vec_dir
+        return self
+
+
+def _doc_embeddings(vec_tuple) -> np.ndarray | None:
+    # 디렉터리를 모르는 vec_tuple (직접 만든 3-tuple) 이면 다른 카테고리의 임베딩을 쓰지 않도록 None
+    vec_dir = getattr(vec_tuple, "vec_dir", None)
+    return None if vec_dir is None else _load_doc_embeddings(vec_dir)
+
+
+# ──────────────────────────────────────────────────
+# Multi-vector (passage) index
+# ──────────────────────────────────────────────────
+
+def _split_passages(text: str, words: int = PASSAGE_WORDS, cap: int = MAX_PASSAGES) -> List[str]:
+    """Split `text` into word windows; keep at most `cap`, spread over the document."""
+    tokens = text.split()
+    passages = [" ".join(tokens[i:i + words]) for i in range(0, len(tokens), words)] or [""]
+    if len(passages) > cap:
+        # 첫 passage(제목·특징)는 항상 유지하고 나머지는 리뷰 전체에 고르게 분포
+        keep = np.unique(np.linspace(0, len(passages) - 1, cap).round().astype(int))
+        passages = [passages[i] for i in keep]
+    return passages
+
+
+class MaxSimIndex:
+    """Product-level view over a passage index: score(product) = max over its passages.
+
+    `search` returns product rows (positions in `id_map`), so `semantic_search`
+    works unchanged whether `vec_tuple` holds this or a plain FAISS index.
+    """
+
+    def __init__(self, passage_index, passage_doc: np.ndarray, n_docs: int):
+        self.passage_index = passage_index
+        self.passage_doc = passage_doc
+        self.ntotal = n_docs
+        self.d = passage_index.d
+
+    def search(self, queries: np.ndarray, k: int, mask: np.ndarray | None = None):
+        # 상품당 passage 가 최대 MAX_PASSAGES 개이므로 k * MAX_PASSAGES 면 서로 다른 상품 k 개가 보장됨
+        p_mask = None if mask is None else mask[self.passage_doc]
+        p_scores, p_idxs = _index_search(self.passage_index, queries,
+                                         min(k * MAX_PASSAGES, self.passage_index.ntotal), p_mask)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        idxs = np.full((len(queries), k), -1, dtype=np.int64)
+        for q in range(len(queries)):
+            seen = {}
+            # passage 결과는 점수 내림차순 → 상품별 첫 등장 점수가 곧 max-sim
+            for s, p in zip(p_scores[q], p_idxs[q]):
+                if p < 0:
+                    continue
+                doc = int(self.passage_doc[p])
+                if doc not in seen:
+                    seen[doc] = float(s)
+                    if len(seen) == k:
+                        break
+            for j, (doc, s) in enumerate(seen.items()):
+                idxs[q, j], scores[q, j] = doc, s
+        return scores, idxs
 
-    # Build FAISS index (inner product on unit vectors == cosine sim)
-    index = faiss.IndexFlatIP(EMBED_DIM)
-    index.add(embeddings)
 
-    # Persist
-    VEC_DIR.mkdir(parents=True, exist_ok=True)
-    faiss.write_index(index, str(VEC_DIR / "index.faiss"))
-    (VEC_DIR / "id_map.json").write_text(json.dumps([d["id"] for d in corpus]))
-    print(f"[✓] Saved FAISS index ({len(corpus):,} vectors) → {VEC_DIR}")
-    return index, [d["id"] for d in corpus], model
-
-def bm25_search(query: str, idx_tuple, k: int) -> List[Tuple[str, str, float]]:
-    _, tok, ret = idx_tuple
-    q_tokens = tok.tokenize([query], update_vocab=False)
-    docs_mat, scores_mat = ret.retrieve(q_tokens, k=k)
-    docs, scores = docs_mat[0], scores_mat[0]
+def _build_or_load_passage_index(corpus: List[Dict[str, str]], storage: str = PASSAGE_STORAGE,
+                                 vec_dir: Path | None = None):
+    """Load or build the passage-level index used by `MULTI_VECTOR` mode."""
+    pas_dir = (vec_dir or VEC_DIR) / "passages"
+    index_path = pas_dir / VEC_STORAGE_FILES[storage]
+    if index_path.exists():
+        print(f"[+] Loading cached passage index ({storage})…")
+        passage_index = _read_vector_index(index_path)
+        passage_doc = np.load(pas_dir / "passage_doc.npy")
+        id_map = json.loads((pas_dir / "id_map.json").read_text())
+        model = _load_embed_model()
+        return MaxSimIndex(passage_index, passage_doc, len(id_map)), id_map, model
+
+    print("[+] Building passage vector index (first run — please wait)…")
+    model = _load_embed_model()
+    model.max_seq_length = 512
+    passages, passage_doc = [], []
+    for row, d in enumerate(corpus):
+        chunks = _split_passages(d["text"])
+        passages.extend(chunks)
+        passage_doc.extend([row] * len(chunks))
+    passage_doc = np.asarray(passage_doc, dtype=np.int32)
+
+    passage_index = _make_vector_index(_encode_corpus(model, passages), storage)
+    id_map = [d["id"] for d in corpus]
+
+    pas_dir.mkdir(parents=True, exist_ok=True)
+    _save_vector_index(passage_index, index_path)
+    np.save(pas_dir / "passage_doc.npy", passage_doc)
+    (pas_dir / "id_map.json").write_text(json.dumps(id_map))
+    print(f"[✓] Saved passage index ({len(passages):,} passages for {len(id_map):,} products, "
+          f"{_vector_bytes_per_item(passage_index):,.0f} B/passage) → {index_path}")
+    return MaxSimIndex(passage_index, passage_doc, len(id_map)), id_map, model
+
+
+def vector_storage_report(vec_idx, sample_paths: List[Path] = EVAL_SAMPLE_PATHS,
+                          storages=("sq8", "sqfp16", "fp16"), k: int = 10):
+    """Compare quantized storages against the float32 index on the eval samples.
+
+    `vec_idx` must be the float32 ("flat") tuple from `_build_or_load_vector_index`.
+    Each sample's title is used as the query and its `parent_asin` as the target.
+    Reports, per storage: bytes per vector, overlap@k with the float32 top-k,
+    and target Hit@k / MRR@k next to the float32 numbers.
+    """
+    flat, id_map, model = vec_idx
+    embeddings = flat.reconstruct_n(0, flat.ntotal)
+
+    metas = []
+    for path in sample_paths:
+        with open(path, "r", encoding="utf-8") as f:
+            metas.extend(json.loads(line) for line in f)
+    titles = [str((m.get("metadata") or m).get("title") or "") for m in metas]
+    targets = [m["parent_asin"] for m in metas]
+    queries = model.encode(titles, normalize_embeddings=True).astype('float32')
+
+    def _evaluate(index):
+        _, idxs = index.search(queries, k)
+        hits, rr = [], []
+        for row, target in zip(idxs, targets):
+            ranked = [id_map[int(i)] for i in row if i >= 0]
+            rank = ranked.index(target) + 1 if target in ranked else 0
+            hits.append(rank > 0)
+            rr.append(1 / rank if rank else 0.0)
+        return idxs, float(np.mean(hits)), float(np.mean(rr))
+
+    ref_idxs, ref_hit, ref_mrr = _evaluate(flat)
+    report = {"flat": {"bytes_per_vector": _vector_bytes_per_item(flat), "overlap": 1.0,
+                       "hit": ref_hit, "mrr": ref_mrr}}
+    for storage in storages:
+        index = _make_vector_index(embeddings, storage)
+        idxs, hit, mrr = _evaluate(index)
+        overlap = np.mean([len(set(a) & set(b)) / k for a, b in zip(ref_idxs.tolist(), idxs.tolist())])
+        report[storage] = {"bytes_per_vector": _vector_bytes_per_item(index), "overlap": float(overlap),
+                           "hit": hit, "mrr": mrr}
+
+    print(f"\n===== Vector storage vs float32 ({len(metas)} samples, k={k}) =====")
+    for storage, row in report.items():
+        print(f"{storage:>7}:  {row['bytes_per_vector']:7.0f} B/vec   |   overlap@{k} = {row['overlap']:.4f}"
+              f"   |   Hit@{k} = {row['hit']:.4f}   |   MRR@{k} = {row['mrr']:.4f}")
+    return report
+
+def _vector_index_cached(vec_dir: Path | None = None) -> bool:
+    vec_dir = vec_dir or VEC_DIR
+    if MULTI_VECTOR:
+        return (vec_dir / "passages" / VEC_STORAGE_FILES[PASSAGE_STORAGE]).exists()
+    return (vec_dir / VEC_STORAGE_FILES[VEC_STORAGE]).exists()
+
+
+def load_indexes_async(limit: int | None = None, index_dir: Path | None = None,
+                       vec_dir: Path | None = None, products=None) -> tuple[Future, Future]:
+    """Start loading the BM25 and vector indexes in background threads.
+
+    Returns `(bm25_future, vec_future)`; call `.result()` right before the
+    first retrieval. On the cached path the two loads run in parallel; when
+    the vector index still has to be built it waits for the BM25 corpus.
+    Directories default to `INDEX_DIR` / `VEC_DIR` (see engine.py for profiles).
+    """
+    pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="index-loader")
+    bm25_fut = pool.submit(_build_or_load_bm25_index, limit, index_dir, products)
+    if _vector_index_cached(vec_dir):
+        vec_fut = pool.submit(_build_or_load_vector_index, None, VEC_STORAGE, vec_dir)
+    else:
+        vec_fut = pool.submit(lambda: _build_or_load_vector_index(bm25_fut.result()[0], VEC_STORAGE, vec_dir))
+    pool.shutdown(wait=False)
+    return bm25_fut, vec_fut
+
+
+@lru_cache(maxsize=4)
+def _row_ids(n: int) -> np.ndarray:
+    return np.arange(n)
+
+
+# 동시 세션의 검색 요청을 묶어 처리하는 RetrievalBatcher (retrieval_batcher.py); None 이면 단건 처리
+_RETRIEVAL_BATCHER = None
+
+
+def set_retrieval_batcher(batcher):
+    """Route `bm25_search_rows` / `semantic_search` / cascade encodes through `batcher` (None → off)."""
+    global _RETRIEVAL_BATCHER
+    _RETRIEVAL_BATCHER = batcher
+
+
+def bm25_search_rows(query: str, idx_tuple, k: int, mask: np.ndarray | None = None):
+    """BM25 top-k as (corpus rows, scores) arrays; `mask` restricts the candidates."""
+    if _RETRIEVAL_BATCHER is not None and _RETRIEVAL_BATCHER.serves(idx_tuple):
+        with span("bm25", batched=True) as sp:
+            rows, scores = _RETRIEVAL_BATCHER.bm25_rows(query, k, mask)
+            sp.set(candidates=len(rows))
+        return rows, scores
+    corpus, tok, ret = idx_tuple
+    with span("bm25") as sp:
+        q_tokens = tok.tokenize([query], update_vocab=False)
+        k = min(k, len(corpus))
+        kwargs = {}
+        if mask is not None:
+            k = min(k, int(mask.sum()))
+            kwargs["weight_mask"] = mask.astype(np.float32)
+        # corpus 대신 행 번호 배열을 넘기면 bm25s 가 문서 대신 행 번호를 돌려줌
+        rows_mat, scores_mat = ret.retrieve(q_tokens, corpus=_row_ids(len(corpus)), k=k, **kwargs)
+        rows, scores = rows_mat[0], scores_mat[0]
+        if mask is not None:
+            # weight_mask 는 점수를 0 으로 만들 뿐이므로 후보 밖 문서가 섞일 수 있음
+            keep = mask[rows]
+            rows, scores = rows[keep], scores[keep]
+        sp.set(candidates=len(rows))
+    return rows, scores
+
+
+def bm25_search(query: str, idx_tuple, k: int, mask: np.ndarray | None = None) -> List[Tuple[str, str, float]]:
+    corpus = idx_tuple[0]
+    rows, scores = bm25_search_rows(query, idx_tuple, k, mask)
+    docs = [corpus[int(r)] for r in rows]
     return [(d["id"], d["text"], float(s)) for d, s in zip(docs, scores)]
 
 
-def semantic_search(query: str, vec_tuple, k: int) -> List[Tuple[str, float]]:
+def semantic_search(query: str, vec_tuple, k: int, mask: np.ndarray | None = None) -> List[Tuple[str, float]]:
     index, id_map, model = vec_tuple
-    q_emb = model.encode([query], normalize_embeddings=True)[0].astype('float32')
-    scores, idxs = index.search(q_emb[None, :], k)
-    return [(id_map[int(i)], float(s)) for i, s in zip(idxs[0], scores[0])]
+    if _RETRIEVAL_BATCHER is not None and _RETRIEVAL_BATCHER.serves(vec_tuple):
+        with span("faiss", batched=True) as sp:
+            scores, idxs = _RETRIEVAL_BATCHER.semantic(query, k, mask)
+            sp.set(candidates=int((idxs[0] >= 0).sum()))
+        return [(id_map[int(i)], float(s)) for i, s in zip(idxs[0], scores[0]) if i >= 0]
+    with span("encode"):
+        q_emb = model.encode([query], normalize_embeddings=True)[0].astype('float32')
+    with span("faiss") as sp:
+        scores, idxs = _index_search(index, q_emb[None, :], k, mask)
+        sp.set(candidates=int((idxs[0] >= 0).sum()))
+    return [(id_map[int(i)], float(s)) for i, s in zip(idxs[0], scores[0]) if i >= 0]
+
+
+def hybrid_search(query: str, idx_tuple, vec_tuple, k: int, w: float = HYBRID_WEIGHT,
+                  mask: np.ndarray | None = None):
+    with span("retrieval", mode=HYBRID_MODE) as sp:
+        if HYBRID_MODE == "cascade":
+            hits = cascade_search(query, idx_tuple, vec_tuple, k, w, mask)
+        else:
+            hits = parallel_hybrid_search(query, idx_tuple, vec_tuple, k, w, mask)
+        sp.set(candidates=len(hits))
+    return hits
 
 
-def hybrid_search(query: str, idx_tuple, vec_tuple, k: int, w: float = HYBRID_WEIGHT):
-    # Retrieve from each modality
-    bm25_hits = bm25_search(query, idx_tuple, k=k*SEM_K_FACTOR)
-    sem_hits = semantic_search(query, vec_tuple, k=k*SEM_K_FACTOR)
+def parallel_hybrid_search(query: str, idx_tuple, vec_tuple, k: int, w: float = HYBRID_WEIGHT,
+                           mask: np.ndarray | None = None):
+    # Retrieve from each modality (mask: AttributeStore.mask 결과, None 이면 전체 카탈로그)
+    bm25_hits = bm25_search(query, idx_tuple, k=k*SEM_K_FACTOR, mask=mask)
+    sem_hits = semantic_search(query, vec_tuple, k=k*SEM_K_FACTOR, mask=mask)
+
+    with span("fusion") as sp:
+        topk = _fuse_scores(bm25_hits, sem_hits, idx_tuple, k, w)
+        sp.set(candidates=len(topk))
+    return topk
 
+
+def _fuse_scores(bm25_hits, sem_hits, idx_tuple, k: int, w: float):
     # Build score dicts
     bm25_dict = {pid: s for pid, _, s in bm25_hits}
     sem_dict = {pid: s for pid, s in sem_hits}
@@ -212,6 +814,231 @@ def hybrid_search(query: str, idx_tuple, vec_tuple, k: int, w: float = HYBRID_WE
     return topk
 
 
+@lru_cache(maxsize=8)
+def _load_doc_embeddings(vec_dir: Path | None = None) -> np.ndarray | None:
+    """Memory-map the (N, d) document embeddings stored next to the vector index.
+
+    Falls back to the float16 store, then to reconstructing (once) from a
+    cached float32 FAISS index. Returns None when no source is available.
+    """
+    vec_dir = vec_dir or VEC_DIR
+    for name in ("embeddings.npy", VEC_STORAGE_FILES["fp16"]):
+        if (vec_dir / name).exists():
+            return np.load(vec_dir / name, mmap_mode="r")
+    flat_path = vec_dir / VEC_STORAGE_FILES["flat"]
+    if flat_path.exists():
+        print("[+] Writing embeddings.npy from cached float32 index…")
+        flat = faiss.read_index(str(flat_path))
+        np.save(vec_dir / "embeddings.npy", flat.reconstruct_n(0, flat.ntotal))
+        return np.load(vec_dir / "embeddings.npy", mmap_mode="r")
+    return None
+
+
+def cascade_search(query: str, idx_tuple, vec_tuple, k: int, w: float = HYBRID_WEIGHT,
+                   mask: np.ndarray | None = None):
+    """Two-stage hybrid: BM25 candidates re-scored with their stored embeddings.
+
+    The semantic side is a single (candidates × d) @ d product over rows of
+    the mmap'd `embeddings.npy`, instead of a second full-index search.
+    Falls back to `parallel_hybrid_search` when BM25 matches nothing (the
+    candidate set would be arbitrary) or no stored embeddings exist.
+    """
+    emb = _doc_embeddings(vec_tuple)
+    rows, bm = bm25_search_rows(query, idx_tuple, max(k * SEM_K_FACTOR, CASCADE_CANDIDATES), mask)
+    if emb is None or len(rows) == 0 or bm.max() <= 0:
+        return parallel_hybrid_search(query, idx_tuple, vec_tuple, k, w, mask)
+
+    _, _, model = vec_tuple
+    with span("encode"):
+        if _RETRIEVAL_BATCHER is not None and _RETRIEVAL_BATCHER.serves(vec_tuple):
+            q_emb = _RETRIEVAL_BATCHER.encode(query)
+        else:
+            q_emb = model.encode([query], normalize_embeddings=True)[0].astype('float32')
+    # mmap 에서는 정렬된 행 순서로 읽는 편이 페이지 접근이 적음
+    order = np.argsort(rows)
+    rows, bm = rows[order], bm[order]
+    with span("cascade_rescore", candidates=len(rows)):
+        sem = np.asarray(emb[rows], dtype=np.float32) @ q_emb
+
+    def norm(vals):
+        rng = vals.max() - vals.min()
+        return np.zeros_like(vals) if rng == 0 else (vals - vals.min()) / rng
+
+    hybrid = w * norm(bm.astype(np.float32)) + (1 - w) * norm(sem)
+    top = np.argsort(-hybrid)[:k]
+    corpus = idx_tuple[0]
+    docs = [corpus[int(rows[i])] for i in top]
+    return [(d["id"], d["text"], float(hybrid[i])) for d, i in zip(docs, top)]
+
+
+# ──────────────────────────────────────────────────
+# Exact target rank (평가용: 전체 랭킹을 만들지 않고 점수 벡터에서 순위 계산)
+# ──────────────────────────────────────────────────
+_PID_ROWS: dict[int, tuple[list, dict[str, int]]] = {}
+_PID_ROWS_LOCK = threading.Lock()
+
+
+def pid_rows(corpus) -> dict[str, int]:
+    """pid → corpus row, built once per loaded corpus."""
+    with _PID_ROWS_LOCK:
+        entry = _PID_ROWS.get(id(corpus))
+        if entry is None or entry[0] is not corpus:
+            entry = _PID_ROWS[id(corpus)] = (corpus, {d["id"]: i for i, d in enumerate(corpus)})
+        return entry[1]
+
+
+def bm25_score_vector(query: str, idx_tuple) -> np.ndarray:
+    """BM25 score of every corpus row, shape (N,); no top-k selection."""
+    corpus, tok, ret = idx_tuple
+    q_ids = [int(t) for t in tok.tokenize([query], update_vocab=False, show_progress=False)[0]]
+    if not q_ids:
+        return np.zeros(len(corpus), dtype=np.float32)
+    return np.asarray(ret.get_scores(q_ids), dtype=np.float32)
+
+
+def semantic_score_vector(query: str, vec_tuple) -> np.ndarray | None:
+    """Cosine similarity of every corpus row (stored embeddings @ query), or None without `embeddings.npy`."""
+    emb = _doc_embeddings(vec_tuple)
+    if emb is None:
+        return None
+    q_emb = vec_tuple[2].encode([query], normalize_embeddings=True)[0].astype('float32')
+    return np.asarray(emb @ q_emb, dtype=np.float32)
+
+
+def _minmax(vals: np.ndarray, mask: np.ndarray | None = None) -> np.ndarray:
+    ref = vals if mask is None else vals[mask]
+    if len(ref) == 0 or ref.max() == ref.min():
+        return np.zeros_like(vals)
+    return (vals - ref.min()) / (ref.max() - ref.min())
+
+
+def exact_rank(scores: np.ndarray, row: int, mask: np.ndarray | None = None) -> int:
+    """1 + number of rows scored strictly above `row` (0 if `row` is outside `mask`)."""
+    if mask is None:
+        return 1 + int(np.count_nonzero(scores > scores[row]))
+    if not mask[row]:
+        return 0
+    return 1 + int(np.count_nonzero((scores > scores[row]) & mask))
+
+
+def target_rank(query: str, target_pid: str, idx_tuple, vec_tuple=None, w: float = HYBRID_WEIGHT,
+                mask: np.ndarray | None = None) -> dict[str, tuple[float, int] | None]:
+    """Score and exact catalog rank of `target_pid` per modality, without retrieving a ranking.
+
+    Returns {"bm25": (score, rank), "semantic": …, "hybrid": …}; rank 0 means
+    the target is not in the corpus (or outside `mask`). Each rank is one
+    comparison pass over the score vector. Tied rows do not count, so the
+    rank is optimistic under ties. "hybrid" min-max normalises both vectors
+    over the whole catalog (or over `mask`) and fuses them with weight `w`.
+    It therefore ranks the same way as `cascade_search` over all rows, not
+    the top-k·SEM_K_FACTOR pools of `parallel_hybrid_search`. "semantic"
+    and "hybrid" are None when no `vec_tuple` / stored embeddings exist.
+    """
+    row = pid_rows(idx_tuple[0]).get(target_pid)
+    with span("target_rank") as sp:
+        vectors = {"bm25": bm25_score_vector(query, idx_tuple),
+                   "semantic": semantic_score_vector(query, vec_tuple) if vec_tuple is not None else None}
+        if vectors["semantic"] is not None:
+            vectors["hybrid"] = w * _minmax(vectors["bm25"], mask) + (1 - w) * _minmax(vectors["semantic"], mask)
+        out: dict[str, tuple[float, int] | None] = {"bm25": None, "semantic": None, "hybrid": None}
+        for name, scores in vectors.items():
+            if scores is not None:
+                out[name] = (0.0, 0) if row is None else (float(scores[row]), exact_rank(scores, row, mask))
+        sp.set(rank=(out["hybrid"] or out["bm25"])[1])
+    return out
+
+
+# ──────────────────────────────────────────────────
+# Cross-encoder rerank
+# ──────────────────────────────────────────────────
+
+class CrossEncoderReranker:
+    """CPU cross-encoder over (query, document) pairs with a latency budget.
+
+    All uncached pairs of a call go through one `predict` batch. Scores are
+    cached per (query, pid). The observed cost per pair is tracked, and when
+    the next batch would exceed `budget_ms` the candidate list is truncated
+    (lowest fused ranks first); truncated candidates keep their fused order
+    after the reranked ones.
+    """
+
+    def __init__(self, model_name: str = RERANK_MODEL_NAME, budget_ms: float = RERANK_BUDGET_MS,
+                 cache_size: int = RERANK_CACHE_SIZE):
+        self.model_name = model_name
+        self.budget_ms = budget_ms
+        self.cache_size = cache_size
+        self._model = None
+        self._cache: OrderedDict[tuple[str, str], float] = OrderedDict()
+        self._ms_per_pair: float | None = None
+        # 세션 서버에서 여러 스레드가 캐시 / 비용 추정을 공유 (predict 자체는 lock 밖에서 병렬로)
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    from sentence_transformers import CrossEncoder
+                    self._model = CrossEncoder(self.model_name, device="cpu")
+        return self._model
+
+    def rerank(self, query: str, docs: List[Tuple[str, str, float]], min_keep: int = 0):
+        """Return `docs` reordered by cross-encoder score.
+
+        At least `min_keep` candidates are scored even if that overshoots the budget.
+        The lock covers only the cache and the cost estimate, so concurrent calls
+        run `predict` in parallel.
+        """
+        scores = {}
+        with self._lock:
+            for pid, _, _ in docs:
+                if (query, pid) in self._cache:
+                    self._cache.move_to_end((query, pid))
+                    scores[pid] = self._cache[(query, pid)]
+        todo = [(pid, text) for pid, text, _ in docs if pid not in scores]
+
+        with span("rerank", candidates=len(docs), cache_hits=len(scores)) as sp:
+            self._score(query, todo, scores, min_keep)
+            sp.set(scored=len(scores))
+        reranked = sorted((d for d in docs if d[0] in scores), key=lambda d: scores[d[0]], reverse=True)
+        skipped = [d for d in docs if d[0] not in scores]
+        return [(pid, text, scores[pid]) for pid, text, _ in reranked] + skipped
+
+    def _score(self, query: str, todo: List[Tuple[str, str]], scores: dict, min_keep: int):
+        """Score as many of `todo` as the budget allows, into `scores` and the cache."""
+        ms_per_pair = self._ms_per_pair
+        if todo and ms_per_pair:
+            allowed = max(int(self.budget_ms / ms_per_pair), min_keep - len(scores), 0)
+            todo = todo[:allowed]
+        if todo:
+            model = self.model
+            t0 = time.perf_counter()
+            pair_scores = model.predict([(query, text[:RERANK_MAX_CHARS]) for _, text in todo],
+                                        batch_size=len(todo), show_progress_bar=False)
+            ms = (time.perf_counter() - t0) * 1000 / len(todo)
+            with self._lock:
+                self._ms_per_pair = ms if self._ms_per_pair is None else 0.8 * self._ms_per_pair + 0.2 * ms
+                for (pid, _), sc in zip(todo, pair_scores):
+                    scores[pid] = float(sc)
+                    self._cache[(query, pid)] = float(sc)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+
+_RERANKER: CrossEncoderReranker | None = None
+
+
+def ranked_search(query: str, idx_tuple, vec_tuple, k: int, mask: np.ndarray | None = None):
+    """`hybrid_search`, followed by the cross-encoder rerank when `RERANK` is on."""
+    global _RERANKER
+    if not RERANK:
+        return hybrid_search(query, idx_tuple, vec_tuple, k, mask=mask)
+    if _RERANKER is None:
+        _RERANKER = CrossEncoderReranker()
+    hits = hybrid_search(query, idx_tuple, vec_tuple, k * RERANK_POOL_FACTOR, mask=mask)
+    return _RERANKER.rerank(query, hits, min_keep=k)[:k]
+
+
 # ──────────────────────────────────────────────────
 # ❶ 초기 질문 ‑> 검색용 쿼리로 ‘재작성’
 # ──────────────────────────────────────────────────
@@ -225,8 +1052,156 @@ REWRITE_PROMPT = PromptTemplate(
         "Search‑query:"
     )
 )
-def rewrite_query(llm: ChatOpenAI, user_input: str) -> str:
-    return llm.invoke(REWRITE_PROMPT.format(user_input=user_input)).content.strip()
+_QUESTION_WORDS = {"what", "which", "who", "whom", "where", "when", "why", "how", "can", "could",
+                   "should", "would", "is", "are", "do", "does", "recommend", "suggest", "help", "please"}
+_STOPWORDS_EN = set(bm25s.stopwords.STOPWORDS_EN) | {"i", "im", "me", "my", "want", "need", "looking", "something"}
+
+# rewrite_query 호출 중 LLM 을 건너뛴 비율 (metrics 출력용)
+REWRITE_STATS = {"calls": 0, "skipped": 0}
+
+
+def needs_rewrite(user_input: str, tokenizer=None) -> bool:
+    """Cheap check whether `user_input` needs the LLM rewrite.
+
+    Short keyword-style input (few words, few stopwords, no question words or
+    sentence punctuation) is already a good BM25 query. With the BM25
+    `tokenizer`, the content words must also be mostly in the index vocabulary.
+    """
+    words = re.findall(r"[a-z0-9][a-z0-9'\-]*", user_input.lower())
+    if not words or len(words) > REWRITE_MAX_WORDS or re.search(r"[?!;]|[.,](\s|$)", user_input):
+        return True
+    if any(w in _QUESTION_WORDS for w in words):
+        return True
+    content = [w for w in words if w not in _STOPWORDS_EN]
+    if not content or 1 - len(content) / len(words) > REWRITE_MAX_STOPWORD_RATIO:
+        return True
+    if tokenizer is not None:
+        vocab = tokenizer.get_vocab_dict()
+        stem = tokenizer.stemmer or (lambda w: w)   # Tokenizer 가 stemWord 를 그대로 보관
+        known = sum(stem(w) in vocab for w in content)
+        if known / len(content) < REWRITE_MIN_VOCAB_COVERAGE:
+            return True
+    return False
+
+
+def rewrite_query(llm: ChatOpenAI, user_input: str, tokenizer=None) -> str:
+    REWRITE_STATS["calls"] += 1
+    with span("rewrite") as sp:
+        if REWRITE_FAST_PATH and not needs_rewrite(user_input, tokenizer):
+            REWRITE_STATS["skipped"] += 1
+            sp.set(skipped=True)
+            return " ".join(user_input.split())
+        return llm.invoke(REWRITE_PROMPT.format(user_input=user_input)).content.strip()
+
+
+def rewrite_skip_rate() -> float:
+    return REWRITE_STATS["skipped"] / REWRITE_STATS["calls"] if REWRITE_STATS["calls"] else 0.0
+
+
+# ──────────────────────────────────────────────────
+# Conversation state (constant-size history for prompts)
+# ──────────────────────────────────────────────────
+_FACET_STOPWORDS = {
+    "what", "which", "who", "how", "do", "does", "did", "you", "your", "are", "is", "the", "a", "an",
+    "of", "for", "to", "in", "on", "would", "prefer", "like", "looking", "kind", "type", "any",
+    "question", "most", "important", "there", "specific", "particular", "want", "these", "be",
+}
+
+
+def parse_options(question: str) -> List[str]:
+    """Numbered answer choices ("1. …") in a clarifying question, in order."""
+    return [o.strip() for o in re.findall(r"^\s*\d+[.)]\s*(.+)$", question, re.M)]
+
+
+_NO_PREFERENCE = re.compile(r"^(no (particular )?preference|any(thing)?|none( of (these|the above))?|other|"
+                            r"not sure|(it )?doesn'?t matter|either|all of (these|the above))\b", re.I)
+
+
+def resolve_option_answer(question: str, answer: str) -> str | None:
+    """Constraint text chosen by `answer` among the question's numbered options.
+
+    "2", "2." or the option's own text map to that option; a "no preference"
+    style option maps to "" (nothing to add). Returns None for free-text
+    answers, which still need `reformulate_query`.
+    """
+    options = parse_options(question)
+    if not options:
+        return None
+    key = answer.strip().rstrip(".)").strip()
+    choice = None
+    if key.isdigit() and 1 <= int(key) <= len(options):
+        choice = options[int(key) - 1]
+    else:
+        norm = " ".join(key.lower().split())
+        choice = next((o for o in options if " ".join(o.lower().split()) == norm), None)
+    if choice is None:
+        return None
+    return "" if _NO_PREFERENCE.match(choice.strip()) else choice.strip()
+
+
+def append_constraint(query: str, constraint: str) -> str:
+    """`query` plus the words of `constraint` it does not contain yet."""
+    seen = {w.lower() for w in query.split()}
+    extra = [w for w in re.findall(r"[\w$%.\-']+", constraint) if w.lower() not in seen]
+    return " ".join([query, *extra]).strip()
+
+
+def _question_text(question: str) -> str:
+    """The question line without its options or the "Question:" label."""
+    first = next((l for l in question.splitlines() if l.strip()), "")
+    return re.sub(r"^\s*Question:\s*", "", first).strip()
+
+
+class ConversationState:
+    """Compact, incrementally updated summary of a clarification dialogue.
+
+    Keeps the initial request, a facet → value constraint map (newest value
+    per facet, at most `MAX_CONSTRAINTS` facets) and the last
+    `HISTORY_RECENT_TURNS` turns verbatim, so prompts built from `context()`
+    stay the same size however long the session runs. Supports `append` and
+    `len` so it can stand in for the `qa_turns` list.
+    """
+
+    def __init__(self, initial_query: str = "", recent_turns: int = HISTORY_RECENT_TURNS,
+                 max_constraints: int = MAX_CONSTRAINTS):
+        self.initial_query = initial_query
+        self.constraints: OrderedDict[str, str] = OrderedDict()
+        self.recent: deque[tuple[str, str]] = deque(maxlen=recent_turns)
+        self.max_constraints = max_constraints
+        self.n_turns = 0
+
+    def __len__(self):
+        return self.n_turns
+
+    def append(self, turn: tuple[str, str]):
+        self.update(*turn)
+
+    def update(self, question: str, answer: str):
+        q_text = _question_text(question)
+        value = answer.strip()
+        options = parse_options(question)
+        if value.isdigit() and 1 <= int(value) <= len(options):
+            value = options[int(value) - 1]
+        value = " ".join(value.split()[:12])
+
+        words = [w for w in re.findall(r"[a-z]+", q_text.lower()) if w not in _FACET_STOPWORDS]
+        facet = " ".join(words[:3]) or f"turn {self.n_turns + 1}"
+        self.constraints.pop(facet, None)
+        self.constraints[facet] = value
+        while len(self.constraints) > self.max_constraints:
+            self.constraints.popitem(last=False)
+
+        self.recent.append((" ".join(q_text.split()[:25]), value))
+        self.n_turns += 1
+
+    def context(self) -> str:
+        lines = []
+        if self.initial_query:
+            lines.append(f"Initial request: {self.initial_query}")
+        if self.constraints:
+            lines.append("Known constraints: " + "; ".join(f"{f} = {v}" for f, v in self.constraints.items()))
+        lines.extend(f"Q: {q}\nA: {a}" for q, a in self.recent)
+        return "\n".join(lines)
 
 
 # ──────────────────────────────────────────────────
@@ -241,9 +1216,13 @@ REFORM_PROMPT = PromptTemplate(
         "or explicit in the conversation. Return ONLY the query."
     )
 )
-def reformulate_query(llm: ChatOpenAI, turns: list[tuple[str, str]]) -> str:
-    """turns = [(question, answer), ...]"""
-    history_txt = "\n".join(f"Q: {q}\nA: {a}" for q, a in turns)
+@traced("reformulate")
+def reformulate_query(llm: ChatOpenAI, turns: list[tuple[str, str]] | ConversationState) -> str:
+    """turns = [(question, answer), ...] or a ConversationState"""
+    if isinstance(turns, ConversationState):
+        history_txt = turns.context()
+    else:
+        history_txt = "\n".join(f"Q: {q}\nA: {a}" for q, a in turns)
     return llm.invoke(REFORM_PROMPT.format(history=history_txt)).content.strip()
 
 
@@ -259,9 +1238,34 @@ SUMMARY_PROMPT = PromptTemplate(
         "Return exactly 4 bullet points."
     )
 )
-def summarise_docs(llm: ChatOpenAI, docs: list[tuple[str, str]]) -> str:
+def _summary_prompt(docs: list[tuple[str, str]]) -> str:
     flat = "\n\n".join(f"[{pid}]\n{text}" for pid, text in docs)
-    return llm.invoke(SUMMARY_PROMPT.format(docs=flat)).content.strip()
+    return SUMMARY_PROMPT.format(docs=flat)
+
+
+@traced("summary")
+def summarise_docs(llm: ChatOpenAI, docs: list[tuple[str, str]]) -> str:
+    return llm.invoke(_summary_prompt(docs)).content.strip()
+
+
+@traced("summary")
+def stream_summary(llm: ChatOpenAI, docs: list[tuple[str, str]], prefix: str = "") -> str:
+    """`summarise_docs`, printing tokens as they arrive; returns the full text."""
+    return _stream_print(llm, _summary_prompt(docs), prefix)
+
+
+def _stream_print(llm: ChatOpenAI, prompt: str, prefix: str = "") -> str:
+    """Stream `llm` output to stdout chunk by chunk and return the stripped full text."""
+    print(prefix, end="", flush=True)
+    parts = []
+    for chunk in llm.stream(prompt):
+        # 앞쪽 공백/개행은 출력하지 않음 (.invoke().content.strip() 과 같은 결과)
+        text = chunk.content if parts else chunk.content.lstrip()
+        if text:
+            parts.append(text)
+            print(text, end="", flush=True)
+    print()
+    return "".join(parts).strip()
 
 
 QUESTION_PROMPT = PromptTemplate(
@@ -297,77 +1301,623 @@ QUESTION_PROMPT = PromptTemplate(
     ),
 )
 
-def ask_disambiguation(llm: ChatOpenAI, docs, qa_turns):
-    # build product snippets
+# pid → DEGRADED_SNIPPET_WORDS 단어 스니펫 (인덱스 로드 시 미리 계산; 예산이 빠듯한 턴에서 사용)
+_SNIPPETS: dict[str, str] = {}
+
+
+def _short_snippet(text: str, words: int) -> str:
+    parts = text.split(maxsplit=words)
+    return " ".join(parts[:words]) + (" …" if len(parts) > words else "")
+
+
+def precompute_snippets(corpus, words: int = DEGRADED_SNIPPET_WORDS):
+    """Fill the pid → short snippet table for `corpus` (runs on the index loader thread)."""
+    _SNIPPETS.update((d["id"], _short_snippet(d["text"], words)) for d in corpus)
+
+
+def _snippet(pid: str, text: str, words: int) -> str:
+    if words == DEGRADED_SNIPPET_WORDS and pid in _SNIPPETS:
+        return _SNIPPETS[pid]
+    return _short_snippet(text, words)
+
+
+def _product_snippets(docs, max_words: int | None = None) -> str:
+    # build product snippets (max_words: 시간 예산이 빠듯할 때 쓰는 짧은 스니펫)
     snippets = []
     for pid, text, _ in docs:
         # head = " ".join(text.split()[:20]) + (" …" if len(text.split()) > 20 else "")
-        head = text
+        head = text if max_words is None else _snippet(pid, text, max_words)
         snippets.append(f"{pid} · {head}")
+    return "\n".join(snippets)
+
+
+def _format_context(qa_turns) -> str:
+    if isinstance(qa_turns, ConversationState) and qa_turns:
+        return qa_turns.context()
+    return "None so far." if not qa_turns else "\n".join(f"Q: {turn[0]} A: {turn[1]}" for turn in qa_turns)
 
-    context =  "None so far." if not qa_turns else "\n".join(f"Q: {turn[0]} A: {turn[1]}" for turn in qa_turns)
+
+def _disambiguation_prompt(docs, qa_turns, snippet_words: int | None = None) -> str:
     # history = "None so far." if not prev_qs else "\n".join(f"- {q}" for q in prev_qs)
-    prompt = QUESTION_PROMPT.format(items="\n".join(snippets), context=context)
+    return QUESTION_PROMPT.format(items=_product_snippets(docs, snippet_words), context=_format_context(qa_turns))
+
+
+@traced("question")
+def ask_disambiguation(llm: ChatOpenAI, docs, qa_turns, snippet_words: int | None = None):
+    return llm.invoke(_disambiguation_prompt(docs, qa_turns, snippet_words)).content.strip()
+
+
+@traced("question")
+def stream_disambiguation(llm: ChatOpenAI, docs, qa_turns, prefix: str = "Agent: ",
+                          snippet_words: int | None = None) -> str:
+    """`ask_disambiguation`, printing the question as it is generated."""
+    return _stream_print(llm, _disambiguation_prompt(docs, qa_turns, snippet_words), prefix)
+
+
+# 객관식 QUESTION_PROMPT 이전에 러너별로 쓰던 질문 프롬프트 (engine 의 "free_form" / "previous_questions" 단계)
+FREE_FORM_QUESTION_PROMPT = PromptTemplate(
+    input_variables=["items", "context"],
+    template=(
+        # 역할
+        "You are a helpful product‑search assistant.\n\n"
+        # 컨텍스트 설명
+        "The products listed below were retrieved after considering the entire prior conversation with the user.\n\n"
+        # 상품 목록
+        "Products (id · snippet):\n{items}\n\n"
+        # 대화 맥락
+        "Conversation context:\n{context}\n\n"
+        # 요청
+        "Using BOTH the conversation context and the product list, ask **one** concise follow‑up question "
+        "that will help the user further specify what they want.\n"
+        "• Do **not** recommend any specific item.\n"
+        "• Return **only** the question text.\n"
+        "• Do **not** ask something already answered or obvious from the context.\n\n"
+    ),
+)
+
+PREVIOUS_QUESTIONS_PROMPT = PromptTemplate(
+    input_variables=["items", "history"],
+    template=(
+        "You are a helpful product-search assistant. Without recommending any specific item, "
+        "ask **one** concise question that best distinguishes among the products below.\n\n"
+        "Products (id · snippet):\n{items}\n\nReturn **only** the consie question."
+
+        "Previously asked questions:\n{history}\n\n"
+        "Never repeat similar question asked before."
+        "If you think there's no need to ask a new question, return [END]"
+    ),
+)
+
+
+@traced("question")
+def ask_free_form_question(llm: ChatOpenAI, docs, qa_turns) -> str:
+    """Open follow-up question (no answer options) from full product texts and the Q/A context."""
+    prompt = FREE_FORM_QUESTION_PROMPT.format(items=_product_snippets(docs), context=_format_context(qa_turns))
     return llm.invoke(prompt).content.strip()
 
 
+@traced("question")
+def ask_after_questions(llm: ChatOpenAI, docs, questions: List[str]) -> str | None:
+    """Question from 20-word snippets and the questions asked so far; None when the LLM answers [END]."""
+    history = "None so far." if not questions else "\n".join(f"- {q}" for q in questions)
+    prompt = PREVIOUS_QUESTIONS_PROMPT.format(items=_product_snippets(docs, 20), history=history)
+    question = llm.invoke(prompt).content.strip()
+    return None if question == "[END]" else question
+
+
+# ──────────────────────────────────────────────────
+# ❹ Fused turn: 쿼리 재구성 + 다음 질문을 한 번의 호출로
+# ──────────────────────────────────────────────────
+FUSED_PROMPT = PromptTemplate(
+    input_variables=["items", "context"],
+    template=(
+        "You are a helpful product-search assistant.\n\n"
+        "Products retrieved for the conversation so far (id · snippet):\n{items}\n\n"
+        "Conversation context (the last answer is new):\n{context}\n\n"
+        "Do two things at once:\n"
+        "1. Compose ONE refined search query that captures all constraints implicit "
+        "or explicit in the conversation, including the last answer.\n"
+        "2. Among the products above that still fit the refined query, ask **one** concise follow-up question "
+        "that best distinguishes them, with up to 4 numbered, mutually exclusive answer choices "
+        "(format: 'Question: <question>' then '1. <option>' lines). Do not recommend any item "
+        "and do not repeat earlier questions.\n\n"
+        "Return ONLY a JSON object: {{\"query\": \"<refined query>\", \"question\": \"<question with options>\"}}"
+    ),
+)
+
+
+def _parse_json_object(raw: str) -> dict | None:
+    m = re.search(r"\{.*\}", raw, re.S)
+    if not m:
+        return None
+    try:
+        parsed = json.loads(m.group(0))
+    except json.JSONDecodeError:
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+
+@traced("fused_turn")
+def fused_turn(llm: ChatOpenAI, docs, qa_turns) -> tuple[str, str] | None:
+    """Refined query and a candidate next question from the current pool, in one call.
+
+    Returns None when the output cannot be parsed; callers then fall back to
+    `reformulate_query` + `ask_disambiguation`.
+    """
+    prompt = FUSED_PROMPT.format(items=_product_snippets(docs), context=_format_context(qa_turns))
+    parsed = _parse_json_object(llm.invoke(prompt).content)
+    if not parsed:
+        return None
+    query, question = str(parsed.get("query") or "").strip(), str(parsed.get("question") or "").strip()
+    return (query, question) if query and question else None
+
+
+def _pool_overlap(new_docs, old_pids: set[str]) -> float:
+    """Share of the new pool that was already in the pool the question was drawn from."""
+    if not new_docs:
+        return 0.0
+    return sum(pid in old_pids for pid, _, _ in new_docs) / len(new_docs)
+
+
 #### main loop
 
 
+# ──────────────────────────────────────────────────
+# Turn latency budget
+# ──────────────────────────────────────────────────
+# 단계별 예상 소요 시간 (ms) 의 초기값 — 세션마다 복사해 그 세션의 관측값 EMA 로 갱신
+# (느린 세션 / 백엔드의 추정치가 다른 세션으로 넘어가지 않도록 전역 값은 바꾸지 않음)
+STAGE_COST_MS = {"reformulate": 1500.0, "fused": 2500.0, "question": 2500.0, "summary": 3000.0,
+                 "retrieval": 300.0, "lexical": 100.0}
+STAGE_COST_CLAMP = 2.0            # one observation moves its estimate by at most ×/÷ this factor
+_QUESTION_CACHE: OrderedDict[tuple[frozenset, bytes], str] = OrderedDict()
+_QUESTION_CACHE_LOCK = threading.Lock()
 
-def conversational_search():
-    # ㊀ 인덱스 / LLM 초기화
-    bm25_idx = _build_or_load_bm25_index(MAX_PRODUCTS)
-    vec_idx  = _build_or_load_vector_index(bm25_idx[0])
-    llm      = ChatOpenAI(model_name=MODEL_NAME,
-                          temperature=TEMPERATURE,
-                          streaming=True)
 
-    print("=== Hybrid Conversational Product‑Search ===")
-    raw_input = input("You: ").strip()
-    if not raw_input or raw_input == "/exit":
-        return
+@contextmanager
+def _measure(costs: dict[str, float], stage: str):
+    t0 = time.perf_counter()
+    yield
+    ms = (time.perf_counter() - t0) * 1000
+    est = costs[stage]
+    # 느린 호출 하나가 세션 전체를 degraded 로 만들지 않도록 관측값을 추정치 주변으로 제한
+    ms = min(max(ms, est / STAGE_COST_CLAMP), est * STAGE_COST_CLAMP)
+    costs[stage] = 0.8 * est + 0.2 * ms
+
+
+class TurnBudget:
+    """Deadline for one turn and the degradations taken to meet it.
+
+    Before each expensive stage the session asks `allows(stage, …)`, which
+    compares the time left with the running cost estimates of the remaining
+    stages. When the answer is no, it takes the next cheaper option and calls
+    `degrade(step)`, which is recorded here and as a trace event. In order:
+    local reformulation, BM25-only retrieval, smaller k, short snippets,
+    then a cached or template question (or a template summary).
+    `budget_ms=None` (the default) never degrades. `costs` are the owning
+    session's stage estimates.
+    """
+
+    def __init__(self, budget_ms: float | None = None, costs: dict[str, float] | None = None):
+        self.deadline = None if budget_ms is None else time.perf_counter() + budget_ms / 1000
+        self.costs = costs if costs is not None else STAGE_COST_MS
+        self.degradations: list[str] = []
+
+    def remaining_ms(self) -> float:
+        return float("inf") if self.deadline is None else (self.deadline - time.perf_counter()) * 1000
+
+    def allows(self, *stages: str) -> bool:
+        return self.remaining_ms() >= sum(self.costs[s] for s in stages)
+
+    def degrade(self, step: str):
+        self.degradations.append(step)
+        trace_event("degrade", step=step, remaining_ms=round(self.remaining_ms(), 1))
+
+
+def _question_key(docs, qa_turns) -> tuple[frozenset, bytes]:
+    # pool + 대화 맥락이 모두 같을 때만 재사용 (다른 사용자 / 이미 답한 질문이 나오지 않도록)
+    context = hashlib.blake2b(_format_context(qa_turns).encode("utf-8"), digest_size=16).digest()
+    return frozenset(pid for pid, _, _ in docs), context
+
+
+def _cached_question(docs, qa_turns) -> str | None:
+    key = _question_key(docs, qa_turns)
+    with _QUESTION_CACHE_LOCK:
+        return _QUESTION_CACHE.get(key)
+
+
+def _cache_question(docs, qa_turns, question: str):
+    key = _question_key(docs, qa_turns)
+    with _QUESTION_CACHE_LOCK:
+        _QUESTION_CACHE[key] = question
+        while len(_QUESTION_CACHE) > QUESTION_CACHE_SIZE:
+            _QUESTION_CACHE.popitem(last=False)
+
+
+def _template_summary(docs: list[tuple[str, str]]) -> str:
+    return "\n".join(f"- {pid}: {_snippet(pid, text, DEGRADED_SNIPPET_WORDS)}" for pid, text in docs)
+
 
-    # ㊁ Generation‑1: 초기 쿼리 재작성
-    search_query = rewrite_query(llm, raw_input)
-    print(f"[ rewritten‑query ] → {search_query}")
+class TerminationPolicy:
+    """Decides from retrieval signals alone whether another question is worth asking.
 
-    # 대화 이력
-    qa_turns: list[tuple[str, str]] = []
-    # prev_questions: list[str] = []
+    `observe(docs)` is fed each round's ranked pool and returns a stop reason
+    ("score_gap", "entropy", "stable_top4") or None:
 
-    # ㊂‑㊇ 반복
-    for round_idx, k in enumerate(TOP_KS, start=1):
+    * score_gap   – top‑1 is far ahead of top‑2 relative to the pool's score range
+    * entropy     – the pool's score mass sits on very few items
+    * stable_top4 – the top‑4 did not change for `STOP_STABLE_ROUNDS` answers
+    """
 
-        # Retrieval
-        docs_k = hybrid_search(search_query, bm25_idx, vec_idx, k)
-        # Generation: Clarifying question
-        question = ask_disambiguation(llm, docs_k, qa_turns)
-        # prev_questions.append(question)
+    def __init__(self, min_rounds: int = STOP_MIN_ROUNDS, score_gap: float = STOP_SCORE_GAP,
+                 max_entropy: float = STOP_MAX_ENTROPY, stable_rounds: int = STOP_STABLE_ROUNDS):
+        self.min_rounds = min_rounds
+        self.score_gap = score_gap
+        self.max_entropy = max_entropy
+        self.stable_rounds = stable_rounds
+        self.rounds = 0
+        self.stable = 0
+        self._prev_top: tuple[str, ...] | None = None
 
-        if question == "[END]" or round_idx == len(TOP_KS):
-            #   ↳ 마지막 iteration: 문서 4개 요약 후 종료
-            final_hits = hybrid_search(search_query, bm25_idx, vec_idx, 4)
+    @staticmethod
+    def signals(docs) -> tuple[float, float]:
+        """(score gap, normalised entropy) of a ranked pool."""
+        scores = np.array([s for _, _, s in docs], dtype=np.float64)
+        if len(scores) < 2:
+            return 1.0, 0.0
+        spread = scores[0] - scores[-1]
+        if spread <= 0:
+            return 0.0, 1.0
+        gap = (scores[0] - scores[1]) / spread
+        z = (scores - scores[-1]) / spread / STOP_ENTROPY_TEMP
+        p = np.exp(z - z.max())
+        p /= p.sum()
+        entropy = float(-(p * np.log(p + 1e-12)).sum() / np.log(len(p)))
+        return float(gap), entropy
 
-            pids = [pid for pid, _, _ in final_hits]   # keep order if you like
-            # images_by_pid = fetch_images_for_pids(pids)
+    def observe(self, docs) -> str | None:
+        self.rounds += 1
+        top = tuple(pid for pid, _, _ in docs[:4])
+        self.stable = self.stable + 1 if top == self._prev_top else 0
+        self._prev_top = top
+        if self.rounds < self.min_rounds or len(docs) < 4:
+            return None
+        gap, entropy = self.signals(docs)
+        if gap >= self.score_gap:
+            return "score_gap"
+        if entropy <= self.max_entropy:
+            return "entropy"
+        if self.stable >= self.stable_rounds:
+            return "stable_top4"
+        return None
 
-            summary = summarise_docs(llm, [(pid, txt) for pid, txt, _ in final_hits])
-            print("\n🔎  Top‑4 summary\n" + summary)
 
-            # print("\n🖼  Image URLs for the Top‑4 products")
-            # print(str(images_by_pid))
-            # for pid in pids:
-            #     print(images_by_pid)
-            #     # print(f"{pid}: {images_by_pid.get(pid, [])[:3]}")   # first 3 URLs (or tweak)
+_SPECULATION_POOL: ThreadPoolExecutor | None = None
 
+
+def _speculation_pool() -> ThreadPoolExecutor:
+    global _SPECULATION_POOL
+    if _SPECULATION_POOL is None:
+        _SPECULATION_POOL = ThreadPoolExecutor(max_workers=SPECULATION_WORKERS, thread_name_prefix="speculate")
+    return _SPECULATION_POOL
+
+
+class ConversationSession:
+    """One clarification dialogue as a step-wise state machine.
+
+    `start(raw_input)` → first question, `answer(text)` → next question, and
+    at the last round (or on `finish()`) the Top‑4 summary. Every
+    step returns a dict: {"question": str, "done": False} or
+    {"summary": str, "products": [pid, …], "done": True}.
+
+    Indexes and the LLM are shared and read-only, so many sessions can run
+    side by side (see session_server.py). With `stream=True` questions and
+    the summary are printed as they are generated (CLI).
+
+    With `SPECULATE_OPTIONS`, the reformulated query and next pool for each
+    numbered option are computed in the background while the user decides;
+    picking an option serves its result directly and the rest are dropped.
+
+    With `EARLY_STOP`, a `TerminationPolicy` may end the dialogue before
+    `len(top_ks)` rounds; the final step then carries its "stop_reason".
+
+    With `turn_budget=True` (session_server) each step runs under a
+    `TurnBudget` of `TURN_BUDGET_MS`, read at step time, with this session's
+    own stage cost estimates. Degradations taken to meet it are listed under
+    "degraded" in the step result. Without it (CLI, evaluation) no step
+    degrades, so results do not depend on timing.
+
+    `top_ks` (round pool sizes) and `search(query, k, mask)` default to
+    `TOP_KS` and `ranked_search`; engine.py passes a profile's own. `stages`
+    replaces the LLM steps with a profile's: {"rewrite": f(raw_input),
+    "refine": f(query, qa_turns), "question": f(docs, qa_turns),
+    "summarizer": f([(pid, text)])}. With `summarise=False` the final step
+    skips the summary (evaluation). The final search uses the last round's
+    pool size (`final_k`, at least 4) and the summary covers its Top‑4; the
+    whole final pool stays in `docs_k`. A "question" stage may return None
+    (nothing left to ask), which ends the dialogue like `finish()`.
+    """
+
+    def __init__(self, llm, bm25_idx, vec_idx, attr_store: AttributeStore, stream: bool = False,
+                 top_ks: List[int] | None = None, search=None, stages: dict | None = None,
+                 summarise: bool = True, turn_budget: bool = False):
+        self.llm = llm
+        self.bm25_idx = bm25_idx
+        self.vec_idx = vec_idx
+        self.attr_store = attr_store
+        self.stream = stream
+        self.top_ks = list(top_ks or TOP_KS)
+        self._ranked = search or (lambda query, k, mask: ranked_search(query, bm25_idx, vec_idx, k, mask=mask))
+        self._stages = dict(stages or {})
+        self.summarise = summarise
+        self.search_query = ""
+        self.qa_turns: list[tuple[str, str]] | ConversationState = []
+        self.filters = SearchFilters()
+        self.round_idx = 0
+        self.question: str | None = None
+        self.docs_k: list = []
+        # fused 모드: 이전 pool 에서 미리 만든 다음 질문과 그 pool 의 id
+        self.pending_question, self.pending_pool = None, set()
+        self.done = False
+        # 옵션 번호 → Future[(query, filters, k, docs)], 그리고 채택된 prefetch 결과
+        self._speculative: dict[str, Future] = {}
+        self._prefetched: tuple | None = None
+        self.policy = TerminationPolicy() if EARLY_STOP else None
+        self.turn_budget = turn_budget
+        self.stage_cost = dict(STAGE_COST_MS)
+        self.budget = TurnBudget(None, self.stage_cost)
+
+    def _new_budget(self) -> TurnBudget:
+        return TurnBudget(TURN_BUDGET_MS if self.turn_budget else None, self.stage_cost)
+
+    def start(self, raw_input: str, search_query: str | None = None) -> dict:
+        """Begin with the user's first message (`search_query`: an already rewritten query)."""
+        self.budget = self._new_budget()
+        # ㊁ Generation‑1: 초기 쿼리 재작성
+        if search_query is None:
+            search_query = (self._stages["rewrite"](raw_input) if "rewrite" in self._stages
+                            else rewrite_query(self.llm, raw_input, self.bm25_idx[1]))
+        self.search_query = search_query
+        if self.stream:
+            print(f"[ rewritten‑query ] → {self.search_query}")
+        # 대화 이력 + 누적된 속성 제약 (가격/평점/카테고리)
+        self.qa_turns = ConversationState(raw_input) if COMPRESS_HISTORY else []
+        self.filters = extract_filters(raw_input, self.attr_store)
+        return self._next_round()
+
+    def answer(self, answer: str) -> dict:
+        if self.done or self.question is None:
+            raise RuntimeError("session has no open question")
+        self.budget = self._new_budget()
+        spec = self._take_speculation(answer)
+        question = self.question
+        self.qa_turns.append((question, answer))
+        if spec is not None:
+            # 미리 계산해 둔 옵션 결과 사용 (reformulate + 검색 생략)
+            self.search_query, self.filters = spec[0], spec[1]
+            self._prefetched = spec
+            self.pending_question = None
+            return self._next_round()
+        constraint = resolve_option_answer(question, answer) if RESOLVE_OPTIONS_LOCALLY else None
+        if constraint is not None:
+            # 옵션 선택: LLM 없이 쿼리에 제약 추가 + 속성 필터 반영
+            self.search_query, self.filters = self._refine_locally(constraint)
+            self.pending_question = None
+            return self._next_round()
+        self.filters = self.filters.merge(extract_filters(answer, self.attr_store))
+        # Generation: 대화 이력 기반 쿼리 재구성 (+ fused 모드면 다음 질문 후보까지 한 번에)
+        if not self.budget.allows("reformulate", "retrieval", "question"):
+            # 재구성 LLM 호출까지 하면 다음 질문을 제때 못 만듦 → 답변을 쿼리에 그대로 추가
+            self.budget.degrade("local_reformulate")
+            self.search_query = append_constraint(self.search_query, answer)
+            self.pending_question = None
+            return self._next_round()
+        fused = None
+        if FUSED_TURN and self.round_idx + 1 < len(self.top_ks):
+            with _measure(self.stage_cost, "fused"):
+                fused = fused_turn(self.llm, self.docs_k, self.qa_turns)
+        if fused:
+            self.search_query, self.pending_question = fused
+            self.pending_pool = {pid for pid, _, _ in self.docs_k}
+        else:
+            with _measure(self.stage_cost, "reformulate"):
+                self.search_query = self._reformulate(self.qa_turns)
+            self.pending_question = None
+        return self._next_round()
+
+    @property
+    def final_k(self) -> int:
+        return max(4, self.top_ks[-1])
+
+    def finish(self) -> dict:
+        """Top‑4 summary for the current query; ends the session."""
+        self.budget = self._new_budget()
+        return self._finish()
+
+    def _finish(self) -> dict:
+        self._cancel_speculation()
+        self.docs_k = self._search(self.final_k)
+        docs = [(pid, txt) for pid, txt, _ in self.docs_k[:4]]
+        if not self.summarise:
+            summary = None
+        elif "summarizer" in self._stages:
+            summary = self._stages["summarizer"](docs)
+            if self.stream:
+                print("\n🔎  Top‑4 summary\n" + summary)
+        elif not self.budget.allows("summary"):
+            self.budget.degrade("template_summary")
+            summary = _template_summary(docs)
+            if self.stream:
+                print("\n🔎  Top‑4 summary\n" + summary)
+        else:
+            with _measure(self.stage_cost, "summary"):
+                if self.stream:
+                    summary = stream_summary(self.llm, docs, prefix="\n🔎  Top‑4 summary\n")
+                else:
+                    summary = summarise_docs(self.llm, docs)
+        self.done, self.question = True, None
+        return self._result({"summary": summary, "products": [pid for pid, _ in docs], "done": True})
+
+    def _result(self, out: dict) -> dict:
+        if self.budget.degradations:
+            out["degraded"] = list(self.budget.degradations)
+        return out
+
+    def _next_round(self) -> dict:
+        # ㊂‑㊇ 한 라운드: 마지막 라운드는 질문을 만들지 않고 바로 요약
+        self.round_idx += 1
+        if self.round_idx >= len(self.top_ks):
+            return self._finish()
+        k = self.top_ks[self.round_idx - 1]
+        lexical_only = False
+        if not self.budget.allows("retrieval", "question"):
+            self.budget.degrade("skip_semantic")
+            lexical_only = True
+            if not self.budget.allows("lexical", "question"):
+                self.budget.degrade("shrink_k")
+                k = max(4, k // 2)
+        self.docs_k = self._search(k, lexical_only)
+        reason = self.policy.observe(self.docs_k) if self.policy else None
+        if reason:
+            # 검색 결과가 이미 확실 → 질문 없이 바로 Top‑4 요약 (현재 pool 이 충분히 크면 그 상위를 재사용)
+            trace_event("early_stop", reason=reason, round=self.round_idx)
+            if self.stream:
+                print(f"[ early stop: {reason} ]")
+            if k >= self.final_k:
+                self._prefetched = (self.search_query, self.filters, self.final_k, self.docs_k[:self.final_k])
+            return {**self._finish(), "stop_reason": reason}
+        if self.pending_question and _pool_overlap(self.docs_k, self.pending_pool) >= FUSED_MIN_OVERLAP:
+            # pool 이 크게 바뀌지 않았으면 fused 호출에서 받은 질문을 그대로 사용
+            question = self.pending_question
+            if self.stream:
+                print(f"Agent: {question}")
+        elif not self.budget.allows("question"):
+            # LLM 을 부를 시간이 없음 → 같은 pool 에 대해 만들어 둔 질문, 없으면 템플릿 질문
+            question = _cached_question(self.docs_k, self.qa_turns)
+            if question is not None:
+                self.budget.degrade("cached_question")
+            else:
+                self.budget.degrade("template_question")
+                asked = {w for q, _ in getattr(self.qa_turns, "recent", self.qa_turns) for w in q.lower().split()}
+                question = template_question([t for _, t, _ in self.docs_k], exclude=asked)
+            if self.stream:
+                print(f"Agent: {question}")
+        elif "question" in self._stages:
+            question = self._stages["question"](self.docs_k, self.qa_turns)
+            if question is None:
+                # 질문 단계가 더 물을 것이 없다고 판단 ([END]) → 바로 최종 검색 / 요약
+                return {**self._finish(), "stop_reason": "no_question"}
+            if self.stream:
+                print(f"Agent: {question}")
+        else:
+            snippet_words = None
+            if not self.budget.allows("question", "question"):
+                self.budget.degrade("short_snippets")
+                snippet_words = DEGRADED_SNIPPET_WORDS
+            with _measure(self.stage_cost, "question"):
+                if self.stream:
+                    # Generation: Clarifying question — 생성되는 대로 바로 출력
+                    question = stream_disambiguation(self.llm, self.docs_k, self.qa_turns,
+                                                     snippet_words=snippet_words)
+                else:
+                    question = ask_disambiguation(self.llm, self.docs_k, self.qa_turns, snippet_words)
+            _cache_question(self.docs_k, self.qa_turns, question)
+        self.question = question
+        self._speculate(question)
+        return self._result({"question": question, "done": False})
+
+    def _reformulate(self, turns) -> str:
+        if "refine" in self._stages:
+            return self._stages["refine"](self.search_query, turns)
+        return reformulate_query(self.llm, turns)
+
+    def _search(self, k: int, lexical_only: bool = False):
+        """`ranked_search` for the current query/filters, unless a prefetch already did it.
+
+        `lexical_only` (budget degradation) skips the semantic branch and the rerank.
+        """
+        prefetched, self._prefetched = self._prefetched, None
+        if prefetched is not None and prefetched[:3] == (self.search_query, self.filters, k):
+            return prefetched[3]
+        mask = self.attr_store.mask(self.filters)
+        if lexical_only:
+            with _measure(self.stage_cost, "lexical"):
+                return bm25_search(self.search_query, self.bm25_idx, k, mask)
+        with _measure(self.stage_cost, "retrieval"):
+            return self._ranked(self.search_query, k, mask)
+
+    # ── speculative prefetch per answer option ──────
+    def _speculate(self, question: str):
+        self._cancel_speculation()
+        if not SPECULATE_OPTIONS or FUSED_TURN:
             return
+        k = self.top_ks[self.round_idx] if self.round_idx + 1 < len(self.top_ks) else 4
+        for i, _ in enumerate(parse_options(question), 1):
+            turns = copy.deepcopy(self.qa_turns)
+            turns.append((question, str(i)))
+            self._speculative[str(i)] = _speculation_pool().submit(self._prefetch, turns, question, str(i), k)
+
+    def _refine_locally(self, constraint: str) -> tuple[str, SearchFilters]:
+        return (append_constraint(self.search_query, constraint),
+                self.filters.merge(extract_filters(constraint, self.attr_store)))
+
+    def _prefetch(self, turns, question: str, answer: str, k: int):
+        # answer() 와 같은 순서/입력으로 계산해야 결과를 그대로 쓸 수 있음
+        # (turns 는 list 또는 ConversationState 이므로 질문은 인덱싱하지 않고 직접 받음)
+        constraint = resolve_option_answer(question, answer) if RESOLVE_OPTIONS_LOCALLY else None
+        if constraint is not None:
+            query, filters = self._refine_locally(constraint)
+        else:
+            query = self._reformulate(turns)
+            filters = self.filters.merge(extract_filters(answer, self.attr_store))
+        docs = self._ranked(query, k, self.attr_store.mask(filters))
+        return query, filters, k, docs
 
+    def _take_speculation(self, answer: str):
+        """Prefetched (query, filters, k, docs) if `answer` picks an option; the others are dropped.
+
+        Only a bare option number hits: the prefetch reformulated with exactly
+        that answer, so its query is what `reformulate_query` would return now.
+        """
+        fut = self._speculative.pop(answer.strip(), None)
+        self._cancel_speculation()
+        if fut is None or fut.cancelled():
+            return None
+        try:
+            return fut.result()
+        except Exception as e:  # 추측 실패는 평소 경로로 대체하되 원인은 남김
+            print(f"[speculation] prefetch for option {answer.strip()!r} failed: {e!r}")
+            return None
+
+    def _cancel_speculation(self):
+        for fut in self._speculative.values():
+            fut.cancel()
+        self._speculative.clear()
+
+
+def conversational_search():
+    # ㊀ 인덱스 / LLM 초기화 — 인덱스는 백그라운드에서 로드하고 첫 입력을 바로 받음
+    bm25_fut, vec_fut = load_indexes_async(MAX_PRODUCTS)
+    llm      = instrument(make_llm(MODEL_NAME, TEMPERATURE, streaming=True))
+
+    print("=== Hybrid Conversational Product‑Search ===")
+    raw_input = input("You: ").strip()
+    if not raw_input or raw_input == "/exit":
+        return
+
+    # 인덱스가 이미 로드됐으면 어휘 커버리지까지 보고 재작성 여부 결정
+    tokenizer = bm25_fut.result()[1] if bm25_fut.done() else None
+    search_query = rewrite_query(llm, raw_input, tokenizer)
+
+    # 검색 직전에만 인덱스 로드 완료를 기다림 (재작성 LLM 호출과 겹쳐서 진행됨)
+    bm25_idx = bm25_fut.result()
+    vec_idx  = vec_fut.result()
+    session = ConversationSession(llm, bm25_idx, vec_idx, _build_or_load_attribute_store(bm25_idx[0]),
+                                  stream=True)
+
+    # 질문/요약은 세션이 스트리밍으로 직접 출력
+    step = session.start(raw_input, search_query)
+    while not step["done"]:
         # User prompt ↔ answer 수집
-        print(f"Agent: {question}")
         answer = input("You: ").strip()
-
-        qa_turns.append((question, answer))
-        # Generation: 대화 이력 기반 쿼리 재구성
-        search_query = reformulate_query(llm, qa_turns)
-        # print(f"[ refined‑query ] → {search_query}\n")
+        step = session.answer(answer)